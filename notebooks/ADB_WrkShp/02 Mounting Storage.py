@@ -66,7 +66,11 @@ dbutils.fs.mount(
 
 # COMMAND ----------
 
-# MAGIC %fs ls /mnt/training-sources/
+# MAGIC %run ./Includes/Listing-Cache
+
+# COMMAND ----------
+
+display(listingCache.ls("/mnt/training-sources/"))
 
 # COMMAND ----------
 
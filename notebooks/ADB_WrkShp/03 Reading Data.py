@@ -55,6 +55,10 @@
 
 # COMMAND ----------
 
+# MAGIC %run ./Includes/Parquet-Ingest
+
+# COMMAND ----------
+
 #%fs ls /mnt/training-sources/initech/
 
 # COMMAND ----------
@@ -86,13 +90,15 @@ display(tempDF)
 # MAGIC %md
 # MAGIC ### Step #2 - Infer the Schema
 # MAGIC 
-# MAGIC Lastly, we can add an option that tells the reader to infer each column's data type (aka the schema)
+# MAGIC Lastly, we can ask for each column's data type (aka the schema) to be inferred.
+# MAGIC 
+# MAGIC Inference is a full pass over the data, so `cached_schema(..)` from the schema registry infers it once and stores it. Later runs reuse the stored schema until a file under `csvFile` is added, removed or changes.
 
 # COMMAND ----------
 
 df = (spark.read                        # The DataFrameReader
    .option("header", "true")       # Use first line of all files as header
-   .option("inferSchema", "true")  # Automatically infer data types
+   .schema(cached_schema(csvFile)) # Inferred data types, only re-inferred when the files change
    .csv(csvFile)                   # Creates a DataFrame from CSV after reading in the file
 )
 
@@ -105,13 +111,17 @@ display(df)
 # MAGIC %md
 # MAGIC ### Step #2 (SQL) - Infer the Schema with SQL
 
+# MAGIC 
+# MAGIC The registry already holds the inferred schema, so we pass it as the column list rather than asking SQL to infer it a second time.
+
 # COMMAND ----------
 
-# MAGIC %sql 
-# MAGIC DROP TABLE IF EXISTS kp_products; 
-# MAGIC CREATE TABLE kp_products
-# MAGIC USING CSV
-# MAGIC OPTIONS (path "/mnt/training-sources/initech/productsCsv/", header "true", inferSchema "true")
+spark.sql("DROP TABLE IF EXISTS kp_products")
+spark.sql("""
+CREATE TABLE kp_products ({})
+USING CSV
+OPTIONS (path "/mnt/training-sources/initech/productsCsv/", header "true")
+""".format(schema_ddl(cached_schema(csvFile))))
 
 # COMMAND ----------
 
@@ -165,22 +175,16 @@ display(df)
 # MAGIC Declare the schema.
 # MAGIC 
 # MAGIC This is just a list of field names and data types.
+# MAGIC 
+# MAGIC Rather than typing it out, we take it from the schema registry and print the equivalent `StructType` declaration so it can be pasted into a job.
 
 # COMMAND ----------
 
 # Required for StructField, StringType, IntegerType, etc.
 from pyspark.sql.types import *
 
-csvSchema = StructType([
-  StructField("product_id", LongType(), True),
-  StructField("category", StringType(), True),
-  StructField("brand", StringType(), True),
-  StructField("model", StringType(), True),
-  StructField("price", DoubleType(), True),
-  StructField("processor", StringType(), True),
-  StructField("size", StringType(), True),
-  StructField("display", StringType(), True)
- ])
+csvSchema = cached_schema(csvFile)
+print(schema_source(csvSchema))
 
 # COMMAND ----------
 
@@ -274,9 +278,27 @@ df_from_sql = table("kp_products")
 # MAGIC 
 # MAGIC Documentation on <a href="https://spark.apache.org/docs/latest/api/python/pyspark.sql.html?highlight=dataframe%20reader#pyspark.sql.DataFrameReader" target="_blank">DataFrameReader</a>
 
+# MAGIC 
+# MAGIC Rather than re-parsing the CSV on every run, `ingest_csv(..)` converts each source file to Parquet once. A manifest records which files have been converted, so the next run only picks up new or changed files.
+# MAGIC 
+# MAGIC The layout matters as much as the format: partitioning by `category`, sorting by `product_id` and sizing the files lets `select ... where category = ...` prune whole directories and row groups.
+
 # COMMAND ----------
 
-productDF.write.mode("overwrite").parquet("dbfs:/tmp/training-msft/initech/Products.parquet")    
+parquetFile = "dbfs:/tmp/training-msft/initech/Products.parquet"
+ingest_csv(csvFile, parquetFile, csvSchema,
+  partitionBy=["category"],                # one directory per category - filters on category skip the rest
+  sortBy=["product_id"],                   # tight product_id min/max per file and row group
+  targetFileBytes=128 * 1024 * 1024)       # evenly sized files instead of one per input partition
+
+# COMMAND ----------
+
+# MAGIC %md From here on `products` reads the columnar copy instead of the CSV
+
+# COMMAND ----------
+
+productDF = spark.read.parquet(parquetFile).drop("source_file")  # bookkeeping for ingest_csv, not product data
+productDF.createOrReplaceTempView("products")
 
 # COMMAND ----------
 
@@ -293,17 +315,20 @@ productDF.write.mode("overwrite").parquet("dbfs:/tmp/training-msft/initech/Produ
 
 # COMMAND ----------
 
+# MAGIC %md The table points at the same ingested copy, so it stays current without rewriting it from `kp_products`
+
+# COMMAND ----------
+
 # MAGIC %sql 
 # MAGIC DROP TABLE IF EXISTS kp_products_parquet;
 # MAGIC CREATE TABLE kp_products_parquet
 # MAGIC USING parquet
-# MAGIC OPTIONS (path = "dbfs:/tmp/sql/training-msft/initech/Products.parquet")
-# MAGIC AS 
-# MAGIC SELECT * FROM kp_products
+# MAGIC OPTIONS (path = "dbfs:/tmp/training-msft/initech/Products.parquet");
+# MAGIC MSCK REPAIR TABLE kp_products_parquet
 
 # COMMAND ----------
 
-# MAGIC %fs ls dbfs:/tmp/sql/training-msft/initech/Products.parquet
+# MAGIC %sql select * from kp_products_parquet
 
 # COMMAND ----------
 
@@ -55,6 +55,20 @@
 
 # COMMAND ----------
 
+# MAGIC %md
+# MAGIC Record the progress of every streaming query in this notebook, so batch latency and state size can be looked at after the fact.
+
+# COMMAND ----------
+
+# MAGIC %run ./Includes/Streaming-Metrics
+
+# COMMAND ----------
+
+metricsPath = "dbfs:/tmp/streaming/training-msft/initech/metrics/filesystem/"
+install_progress_exporter(metricsPath)
+
+# COMMAND ----------
+
 #schema for our streaming DataFrame
 
 from pyspark.sql.types import *
@@ -68,16 +82,26 @@ schema = StructType([ \
 
 # COMMAND ----------
 
-# MAGIC %fs ls /mnt/training-sources/initech/streaming/orders/data/
+# MAGIC %md The orders directory holds a lot of part files. Listings are cached for a minute, and the stream lists only the files that are new since its last trigger. Checkpoints of the queries that read the files directly before can't be reused with this source, so the queries below write to `_v2` paths. A part file that is written again brings its orders in a second time, so orders are deduplicated on `orderUUID`, remembering each for 10 minutes of event time.
+
+# COMMAND ----------
+
+# MAGIC %run ./Includes/Listing-Cache
+
+# COMMAND ----------
+
+# MAGIC %run ./Includes/Order-Dedup
+
+# COMMAND ----------
+
+display(listingCache.ls("/mnt/training-sources/initech/streaming/orders/data/"))
 
 # COMMAND ----------
 
 #streaming DataFrame reader for data on Azure Storage
 
-streaming_df = spark.readStream \
-    .schema(schema) \
-    .option("maxFilesPerTrigger", 1) \
-    .csv("dbfs:/mnt/training-sources/initech/streaming/orders/data/part-*")
+streaming_df = dedupe_orders(read_files_stream("dbfs:/mnt/training-sources/initech/streaming/orders/data/", schema,
+                                               pattern="part-*", maxFilesPerTrigger=1))
 
 # COMMAND ----------
 
@@ -135,10 +159,16 @@ display(top_products)
 # COMMAND ----------
 
 # MAGIC %md Load the product lookup data from Azure Storage
+# MAGIC * Only `ProductID`, `Name` and `StandardCost` are kept, cached in memory and broadcast to the join
+# MAGIC * It is reloaded when the files change, instead of being re-read in every micro-batch
+
+# COMMAND ----------
+
+# MAGIC %run ./Includes/Product-Dimension
 
 # COMMAND ----------
 
-product_lookup = spark.read.parquet("/mnt/training-sources/initech/productsFull/")
+product_lookup = ProductDimension("/mnt/training-sources/initech/productsFull/", refreshSeconds=300)
 
 # COMMAND ----------
 
@@ -148,7 +178,7 @@ product_lookup = spark.read.parquet("/mnt/training-sources/initech/productsFull/
 # COMMAND ----------
 
 #TO-DO
-joined_df = streaming_df.join(product_lookup, "ProductID")
+joined_df = streaming_df.join(product_lookup.broadcast(), "ProductID")
 
 # COMMAND ----------
 
@@ -177,3 +207,168 @@ display(top_products)
 
 # COMMAND ----------
 
+# MAGIC %md ### Top 10 Without Re-Sorting Everything
+# MAGIC 
+# MAGIC The `orderBy` above runs in complete mode, so every trigger re-sorts the revenue of every product seen so far. `TopN` keeps the running totals in state, and on each trigger it only looks at the products that changed and the current top 10.
+# MAGIC * Note: there is no `orderBy` on the aggregate, `TopN` does the ranking
+
+# COMMAND ----------
+
+# MAGIC %run ./Includes/Streaming-TopN
+
+# COMMAND ----------
+
+topRevenue = TopN(k=10, key="Name", value="total_revenue_by_product", path="dbfs:/tmp/streaming/training-msft/initech/fs_top_revenue/")
+topRevenueQuery = topRevenue.start(
+  joined_df.groupBy("Name").agg(sum(col("quantity")*col("StandardCost")).alias("total_revenue_by_product")),
+  checkpointLocation="dbfs:/tmp/streaming/training-msft/initech/fs_top_revenue/checkpoint/")
+
+# COMMAND ----------
+
+# MAGIC %md The current top 10, and the products whose rank changed in each trigger
+
+# COMMAND ----------
+
+await_progress(topRevenueQuery)
+display(topRevenue.current())
+
+# COMMAND ----------
+
+display(topRevenue.changes().orderBy(desc("batchId"), "rank"))
+
+# COMMAND ----------
+
+# MAGIC %md ### Hot Products
+# MAGIC 
+# MAGIC Product popularity is very uneven, and in a flash sale a handful of products get most of the orders. `SkewAwareTotals` keeps the same revenue totals as the `groupBy("Name")` above, without a state store: each trigger's totals, already added up within every task, are merged into a Delta table, touching only the products that had orders.
+
+# COMMAND ----------
+
+# MAGIC %run ./Includes/Skew-Aggregation
+
+# COMMAND ----------
+
+hotRevenue = SkewAwareTotals(key="Name", value=col("quantity")*col("StandardCost"), alias="total_revenue_by_product",
+                             path="dbfs:/tmp/streaming/training-msft/initech/fs_hot_revenue/")
+hotRevenueQuery = hotRevenue.start(joined_df, checkpointLocation="dbfs:/tmp/streaming/training-msft/initech/fs_hot_revenue/checkpoint/")
+
+# COMMAND ----------
+
+await_progress(hotRevenueQuery)
+display(hotRevenue.current())
+
+# COMMAND ----------
+
+# MAGIC %md ### Costs That Change
+# MAGIC 
+# MAGIC `product_lookup` prices every order at the cost in the current snapshot of `productsFull`. When cost changes arrive as a stream of their own, `CostAsOfJoin` prices each order at the cost in effect at its `orderTimestamp`. Only the orders' watermark moves event time, so orders keep coming out while no cost changes arrive. Products that haven't changed since the snapshot keep its cost.
+# MAGIC * For the lab, a few hundred random cost changes are written over the time span of the orders
+# MAGIC * An order comes out once the watermark is 10 minutes past it, the time a cost change has to arrive, so 10 minutes of event time after the static join would have emitted it
+
+# COMMAND ----------
+
+# MAGIC %run ./Includes/Cost-AsOf-Join
+
+# COMMAND ----------
+
+costChangesPath = "dbfs:/tmp/streaming/training-msft/initech/product_costs/"
+orderTimes = (spark.read.schema(schema).csv("dbfs:/mnt/training-sources/initech/streaming/orders/data/")
+  .agg(min("orderTimestamp"), max("orderTimestamp")).first())
+write_sample_cost_changes(spark.read.parquet("dbfs:/mnt/training-sources/initech/productsFull/"), costChangesPath,
+                          orderTimes[0], orderTimes[1])
+
+asofJoined = CostAsOfJoin(orderWatermark=None).join(
+  streaming_df, read_cost_changes(costChangesPath, maxFilesPerTrigger=1), snapshot=product_lookup.broadcast())
+
+asofRevenue = TopN(k=10, key="Name", value="total_revenue_by_product", path="dbfs:/tmp/streaming/training-msft/initech/fs_asof_revenue/")
+asofRevenueQuery = asofRevenue.start(
+  asofJoined.groupBy("Name").agg(sum(col("quantity")*col("StandardCost")).alias("total_revenue_by_product")),
+  checkpointLocation="dbfs:/tmp/streaming/training-msft/initech/fs_asof_revenue/checkpoint/")
+
+# COMMAND ----------
+
+await_progress(asofRevenueQuery)
+display(asofRevenue.current())
+
+# COMMAND ----------
+
+# MAGIC %md ### Bounded State with Event-Time Windows
+# MAGIC 
+# MAGIC The aggregations above group over all time, so their state grows for as long as the stream runs. Grouping by a window of `orderTimestamp` with a watermark lets Spark drop a window's state once the watermark has passed it.
+# MAGIC * Tumbling: units per product per hour
+# MAGIC * Sliding: revenue per product over the last hour, every 15 minutes
+# MAGIC * Orders more than 10 minutes late are dropped: the stream already carries the 10 minute watermark from deduplication
+
+# COMMAND ----------
+
+# MAGIC %run ./Includes/Windowed-Aggregates
+
+# COMMAND ----------
+
+hourlyUnits = windowed_totals(streaming_df, "productId", col("quantity"), "total_units_by_product",
+  window_="1 hour", watermark=None, timeColumn="orderTimestamp")
+
+slidingRevenue = windowed_totals(joined_df, "Name", col("quantity")*col("StandardCost"), "total_revenue_by_product",
+  window_="1 hour", slide="15 minutes", watermark=None, timeColumn="orderTimestamp")
+
+# COMMAND ----------
+
+hourlyUnitsQuery = start_windowed_sink(hourlyUnits,
+  "dbfs:/tmp/streaming/training-msft/initech/fs_hourly_units_v2/data/",
+  "dbfs:/tmp/streaming/training-msft/initech/fs_hourly_units_v2/checkpoint/")
+
+slidingRevenueQuery = start_windowed_sink(slidingRevenue,
+  "dbfs:/tmp/streaming/training-msft/initech/fs_sliding_revenue_v2/data/",
+  "dbfs:/tmp/streaming/training-msft/initech/fs_sliding_revenue_v2/checkpoint/")
+
+# COMMAND ----------
+
+# MAGIC %md Each closed window is written once
+
+# COMMAND ----------
+
+await_progress(slidingRevenueQuery)
+display(read_windowed_sink(slidingRevenue, "dbfs:/tmp/streaming/training-msft/initech/fs_sliding_revenue_v2/data/").orderBy(desc("window_start"), desc("total_revenue_by_product")))
+
+# COMMAND ----------
+
+# MAGIC %md ##![Spark Logo Tiny](https://kpistoropen.blob.core.windows.net/collateral/roadshow/logo_spark_tiny.png) *Part-5:* Catching Up on a Backlog
+# MAGIC 
+# MAGIC `maxFilesPerTrigger=1` keeps batches small, but after an outage it means one file per trigger however many are waiting.
+# MAGIC * `AdmissionController` watches the batch durations and restarts the query from its checkpoint with a higher `maxFilesPerTrigger` while there is a backlog, and a lower one if batches run past the 15 second target
+
+# COMMAND ----------
+
+# MAGIC %run ./Includes/Admission-Control
+
+# COMMAND ----------
+
+def start_orders_copy(maxFilesPerTrigger):
+  return (dedupe_orders(read_files_stream("dbfs:/mnt/training-sources/initech/streaming/orders/data/", schema,
+                                          pattern="part-*", maxFilesPerTrigger=maxFilesPerTrigger))
+    .join(product_lookup.broadcast(), "ProductID")
+    .writeStream
+    .format("parquet")
+    .option("checkpointLocation", "dbfs:/tmp/streaming/training-msft/initech/order_fs_v2/checkpoint/")
+    .option("path", "dbfs:/tmp/streaming/training-msft/initech/order_fs_v2/data/")
+    .trigger(processingTime="15 seconds")
+    .start())
+
+ordersCopy = AdmissionController(start_orders_copy, initial=1, minValue=1, maxValue=1000, targetBatchSeconds=15).run()
+
+# COMMAND ----------
+
+display(ordersCopy.decisionsDF())
+
+# COMMAND ----------
+
+# MAGIC %md ### Batch History
+# MAGIC * Every progress event recorded so far, slowest batches first. For p50/p95/p99 per query, copy `metricsPath` out and run `python tools/stream_metrics.py`
+
+# COMMAND ----------
+
+progressExporter.flush()
+display(spark.read.json(metricsPath).orderBy(desc("triggerExecutionMs")))
+
+# COMMAND ----------
+
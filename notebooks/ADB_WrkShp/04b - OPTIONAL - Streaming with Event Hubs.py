@@ -156,6 +156,34 @@
 
 # COMMAND ----------
 
+# MAGIC %md
+# MAGIC Record the progress of every streaming query in this notebook, so batch latency and state size can be looked at after the fact.
+
+# COMMAND ----------
+
+# MAGIC %run ./Includes/Streaming-Metrics
+
+# COMMAND ----------
+
+metricsPath = "dbfs:/tmp/streaming/training-msft/initech/metrics/eventhubs/"
+install_progress_exporter(metricsPath)
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC No Event Hubs namespace to hand? Set the `eventSource` widget to `local` to run everything below against a local stand-in with the same columns. It generates `localEventsPerSecond` random orders over `eventhubs.partition.count` partitions.
+
+# COMMAND ----------
+
+# MAGIC %run ./Includes/Local-Event-Hub
+
+# COMMAND ----------
+
+dbutils.widgets.dropdown("eventSource", "eventhubs", ["eventhubs", "local"], "Event source")
+dbutils.widgets.text("localEventsPerSecond", "1000", "Local events per second")
+
+# COMMAND ----------
+
 eventHubNamespace = "gbb-workshop"
 progressDir = "/tmp/gbb-workshop/eventhub-orders-progress"
 policyName = "consumer"
@@ -165,17 +193,28 @@ consumerGroup = "$Default"
 
 # COMMAND ----------
 
-inputStream = (spark.readStream
-.format("eventhubs")
-.option("eventhubs.policyname", policyName)
-.option("eventhubs.policykey", policyKey)
-.option("eventhubs.namespace", eventHubNamespace)
-.option("eventhubs.name", eventHubName)
-.option("eventhubs.partition.count", "2")
-.option("eventhubs.maxRate", "100")
-.option("eventhubs.consumergroup", consumerGroup)
-.option("eventhubs.progressTrackingDir", progressDir)
-.load())
+eventHubOptions = {
+  "eventhubs.policyname": policyName,
+  "eventhubs.policykey": policyKey,
+  "eventhubs.namespace": eventHubNamespace,
+  "eventhubs.name": eventHubName,
+  "eventhubs.partition.count": "2",
+  "eventhubs.consumergroup": consumerGroup,
+  "eventhubs.progressTrackingDir": progressDir
+}
+
+# maxRate is kept separate so the writer in Part-5 can adjust it
+def read_event_hub(maxRate=100):
+  if dbutils.widgets.get("eventSource") == "local":
+    return read_local_event_hub(partitions=int(eventHubOptions["eventhubs.partition.count"]),
+                                eventsPerSecond=int(dbutils.widgets.get("localEventsPerSecond")))
+  return (spark.readStream
+  .format("eventhubs")
+  .options(**eventHubOptions)
+  .option("eventhubs.maxRate", str(maxRate))
+  .load())
+
+inputStream = read_event_hub(100)
 
 # COMMAND ----------
 
@@ -212,8 +251,27 @@ schema = StructType([ \
 
 # COMMAND ----------
 
+# MAGIC %md
+# MAGIC Malformed events would come through as rows of nulls. `OrderDecoder` drops them from `sDf`. The order writer in Part 5 keeps them, with their offsets, in a side table. Event Hubs may deliver an event more than once, so orders are then deduplicated on `orderUUID`, remembering each for 10 minutes of event time.
+
+# COMMAND ----------
+
+# MAGIC %run ./Includes/Order-Decoding
+
+# COMMAND ----------
+
+# MAGIC %run ./Includes/Order-Dedup
+
+# COMMAND ----------
+
 from  pyspark.sql.functions import *
-sDf = inputStream.select(from_json(inputStream.body.cast("string"), schema).alias('fields'), "enqueuedTime").select("fields.*", col("enqueuedTime").cast("timestamp"))
+
+orderDecoder = OrderDecoder(schema, quarantinePath="dbfs:/tmp/streaming/training-msft/initech/order/quarantine/")
+
+def to_orders(stream):
+  return dedupe_orders(orderDecoder.decode(stream))
+
+sDf = to_orders(inputStream)
 
 # COMMAND ----------
 
@@ -295,14 +353,19 @@ sDf.createOrReplaceTempView("streaming_table")
 # MAGIC %md ### Streaming Joins
 # MAGIC 
 # MAGIC Grouping by unkown product IDs is not that that exciting. Let's join the stream with the product lookup data set
+# MAGIC * The lookup is cached, column-pruned and broadcast, and only reloaded when its files change
 
 # COMMAND ----------
 
-productLookUp = spark.read.parquet("/mnt/training-sources/initech/productsFull/")
+# MAGIC %run ./Includes/Product-Dimension
 
 # COMMAND ----------
 
-joinedDf = sDf.join(productLookUp, "ProductID")
+productLookUp = ProductDimension("/mnt/training-sources/initech/productsFull/", refreshSeconds=300)
+
+# COMMAND ----------
+
+joinedDf = sDf.join(productLookUp.broadcast(), "ProductID")
 
 # COMMAND ----------
 
@@ -324,10 +387,31 @@ display(joinedDf)
 # MAGIC * Now that we have the product `Name` let's use that instead of the `productId` to `groupBy`
 # MAGIC * Also let's calculate the total revenue instead of just units sold
 # MAGIC   * Use the `quanity` column and the `StandardCost` column 
+# MAGIC * The `costs` widget picks where `StandardCost` comes from: the `productsFull` snapshot, or `stream` to price each order at the cost in effect at its `orderTimestamp` from a stream of cost changes (see the as-of join in the file system lab). For the lab, a few hundred random changes are written, effective over the hour around now
 
 # COMMAND ----------
 
-joinedTopProducts = joinedDf.groupBy("Name").agg(sum(col("quantity")*col("StandardCost")).alias("total_revenue_by_product")).orderBy(desc("total_revenue_by_product"))
+# MAGIC %run ./Includes/Cost-AsOf-Join
+
+# COMMAND ----------
+
+import datetime as dt
+
+dbutils.widgets.dropdown("costs", "snapshot", ["snapshot", "stream"], "Product costs")
+
+pricedDf = joinedDf
+if dbutils.widgets.get("costs") == "stream":
+  costChangesPath = "dbfs:/tmp/streaming/training-msft/initech/eh_product_costs/"
+  now = dt.datetime.now()
+  write_sample_cost_changes(spark.read.parquet("dbfs:/mnt/training-sources/initech/productsFull/"), costChangesPath,
+                            now - dt.timedelta(minutes=30), now + dt.timedelta(minutes=30))
+  # sDf already carries the 10 minute watermark from deduplication
+  pricedDf = CostAsOfJoin(orderWatermark=None).join(
+    sDf, read_cost_changes(costChangesPath, maxFilesPerTrigger=1), snapshot=productLookUp.broadcast())
+
+# COMMAND ----------
+
+joinedTopProducts = pricedDf.groupBy("Name").agg(sum(col("quantity")*col("StandardCost")).alias("total_revenue_by_product")).orderBy(desc("total_revenue_by_product"))
 
 # COMMAND ----------
 
@@ -340,23 +424,171 @@ display(joinedTopProducts)
 
 # COMMAND ----------
 
+# MAGIC %md ### Top 10 Without Re-Sorting Everything
+# MAGIC 
+# MAGIC The `orderBy` above runs in complete mode, so every trigger re-sorts the revenue of every product seen so far. `TopN` keeps the running totals in state, and on each trigger it only looks at the products that changed and the current top 10.
+# MAGIC * Note: there is no `orderBy` on the aggregate, `TopN` does the ranking
+
+# COMMAND ----------
+
+# MAGIC %run ./Includes/Streaming-TopN
+
+# COMMAND ----------
+
+topRevenue = TopN(k=10, key="Name", value="total_revenue_by_product", path="dbfs:/tmp/streaming/training-msft/initech/eh_top_revenue/")
+topRevenueQuery = topRevenue.start(
+  joinedDf.groupBy("Name").agg(sum(col("quantity")*col("StandardCost")).alias("total_revenue_by_product")),
+  checkpointLocation="dbfs:/tmp/streaming/training-msft/initech/eh_top_revenue/checkpoint/")
+
+# COMMAND ----------
+
+# MAGIC %md The current top 10, and the products whose rank changed in each trigger
+
+# COMMAND ----------
+
+await_progress(topRevenueQuery)
+display(topRevenue.current())
+
+# COMMAND ----------
+
+display(topRevenue.changes().orderBy(desc("batchId"), "rank"))
+
+# COMMAND ----------
+
+# MAGIC %md ### Hot Products
+# MAGIC 
+# MAGIC Product popularity is very uneven, and in a flash sale a handful of products get most of the orders. `SkewAwareTotals` keeps the same revenue totals as the `groupBy("Name")` above, without a state store: each trigger's totals, already added up within every task, are merged into a Delta table, touching only the products that had orders.
+
+# COMMAND ----------
+
+# MAGIC %run ./Includes/Skew-Aggregation
+
+# COMMAND ----------
+
+hotRevenue = SkewAwareTotals(key="Name", value=col("quantity")*col("StandardCost"), alias="total_revenue_by_product",
+                             path="dbfs:/tmp/streaming/training-msft/initech/eh_hot_revenue/")
+hotRevenueQuery = hotRevenue.start(joinedDf, checkpointLocation="dbfs:/tmp/streaming/training-msft/initech/eh_hot_revenue/checkpoint/")
+
+# COMMAND ----------
+
+await_progress(hotRevenueQuery)
+display(hotRevenue.current())
+
+# COMMAND ----------
+
+# MAGIC %md ### Bounded State with Event-Time Windows
+# MAGIC 
+# MAGIC The aggregations above group over all time, so their state grows for as long as the stream runs. Grouping by a window of `orderTimestamp` with a watermark lets Spark drop a window's state once the watermark has passed it.
+# MAGIC * Tumbling: units per product per hour
+# MAGIC * Sliding: revenue per product over the last hour, every 15 minutes
+# MAGIC * Orders more than 10 minutes late are dropped: the stream already carries the 10 minute watermark from deduplication
+
+# COMMAND ----------
+
+# MAGIC %run ./Includes/Windowed-Aggregates
+
+# COMMAND ----------
+
+hourlyUnits = windowed_totals(sDf, "productId", col("quantity"), "total_units_by_product",
+  window_="1 hour", watermark=None, timeColumn="orderTimestamp")
+
+slidingRevenue = windowed_totals(joinedDf, "Name", col("quantity")*col("StandardCost"), "total_revenue_by_product",
+  window_="1 hour", slide="15 minutes", watermark=None, timeColumn="orderTimestamp")
+
+# COMMAND ----------
+
+hourlyUnitsQuery = start_windowed_sink(hourlyUnits,
+  "dbfs:/tmp/streaming/training-msft/initech/eh_hourly_units/data/",
+  "dbfs:/tmp/streaming/training-msft/initech/eh_hourly_units/checkpoint/")
+
+slidingRevenueQuery = start_windowed_sink(slidingRevenue,
+  "dbfs:/tmp/streaming/training-msft/initech/eh_sliding_revenue/data/",
+  "dbfs:/tmp/streaming/training-msft/initech/eh_sliding_revenue/checkpoint/")
+
+# COMMAND ----------
+
+# MAGIC %md Each closed window is written once
+
+# COMMAND ----------
+
+await_progress(slidingRevenueQuery)
+display(read_windowed_sink(slidingRevenue, "dbfs:/tmp/streaming/training-msft/initech/eh_sliding_revenue/data/").orderBy(desc("window_start"), desc("total_revenue_by_product")))
+
+# COMMAND ----------
+
 # MAGIC %md ##![Spark Logo Tiny](https://kpistoropen.blob.core.windows.net/collateral/roadshow/logo_spark_tiny.png) *Part-5:* Stream Data to Azure Storage / Azure Data Lake
 # MAGIC * Optimial Parquet: make the data available for everyone
+# MAGIC * `AdmissionController` raises `eventhubs.maxRate` while there is a backlog and lowers it when batches run past 15 seconds
+# MAGIC * No `repartition(1)`: every task writes in parallel to a Delta table partitioned by order date, and small files are compacted in the background in their own atomic commits
+# MAGIC * The writer reads and parses each event once, and routes it either into the table, merged on `orderUUID` so a redelivered order isn't added twice, or to quarantine
+
+# COMMAND ----------
+
+# MAGIC %run ./Includes/Admission-Control
+
+# COMMAND ----------
+
+# MAGIC %run ./Includes/Compacting-Sink
+
+# COMMAND ----------
+
+orderTablePath = "dbfs:/tmp/streaming/training-msft/initech/order/delta/"
+orderSink = CompactingSink(orderTablePath)
+
+def write_orders(orders, batchId):
+  orderSink.append(orders.join(productLookUp.broadcast(), "ProductID"), batchId)
+
+# One query reads and parses each event once: malformed events go to quarantine, orders to the table
+def start_order_writer(maxRate):
+  return orderDecoder.start(read_event_hub(maxRate), "dbfs:/tmp/streaming/training-msft/initech/order/writer_checkpoint/",
+                            writeOrders=write_orders, processingTime='15 seconds')
+
+orderWriter = AdmissionController(start_order_writer, initial=100, minValue=50, maxValue=20000, targetBatchSeconds=15).run()
+orderCompactor = Compactor(orderTablePath, lookbackDays=2, intervalSeconds=600).start()
+
+# COMMAND ----------
+
+await_progress(orderWriter.query)
+
+# COMMAND ----------
+
+# MAGIC %fs ls dbfs:/tmp/streaming/training-msft/initech/order/delta/
+
+# COMMAND ----------
+
+display(orderSink.read())
+
+# COMMAND ----------
+
+# MAGIC %md Every intake decision the controller made
+
+# COMMAND ----------
+
+display(orderWriter.decisionsDF())
+
+# COMMAND ----------
+
+# MAGIC %md ### Quarantined Orders
+# MAGIC * Events that didn't parse, or are missing `orderUUID`, `productId`, `quantity` or `orderTimestamp`
+# MAGIC * Plus, for every batch, the time spent reading it and parsing it
+
+# COMMAND ----------
+
+display(orderDecoder.quarantined())
+
+# COMMAND ----------
+
+display(orderDecoder.stats())
 
 # COMMAND ----------
 
-joinedDf \
-    .repartition(1) \
-    .writeStream \
-    .format("parquet") \
-    .option("checkpointLocation", "dbfs:/tmp/streaming/training-msft/initech/order/checkpoint/") \
-    .option("path", "dbfs:/tmp/streaming/training-msft/initech/order/data/") \
-    .trigger(processingTime='15 seconds') \
-    .start()
+# MAGIC %md ### Batch History
+# MAGIC * Every progress event recorded so far, slowest batches first. For p50/p95/p99 per query, copy `metricsPath` out and run `python tools/stream_metrics.py`
 
 # COMMAND ----------
 
-# MAGIC %fs ls dbfs:/tmp/streaming/training-msft/initech/order/data/
+progressExporter.flush()
+display(spark.read.json(metricsPath).orderBy(desc("triggerExecutionMs")))
 
 # COMMAND ----------
 
@@ -227,6 +227,25 @@ regEval = RegressionEvaluator(labelCol="rating", metricName="rmse")
 
 # COMMAND ----------
 
+# MAGIC %md
+# MAGIC ### Choosing the Parameters
+# MAGIC 
+# MAGIC A rank of 2 and a `regParam` of 0.1 are only a starting point. `ALSSearch` tries a grid of ranks, regularization and iteration counts against `validationDF`, several fits at a time, and drops the weaker half of the candidates after each round of iterations. `als` is then set to the best parameters found.
+
+# COMMAND ----------
+
+# MAGIC %run ./Includes/ALS-Tuning
+
+# COMMAND ----------
+
+alsSearch = ALSSearch(als, regEval, ranks=[2, 4, 8, 12], regParams=[0.01, 0.05, 0.1, 0.3], maxIters=[2, 5, 10],
+                      parallelism=4)
+alsSearch.fit(trainingDF, validationDF)
+als = alsSearch.bestEstimator
+display(alsSearch.leaderboard)
+
+# COMMAND ----------
+
 model = als.fit(trainingWithMyRatingsDF)
 
 # COMMAND ----------
@@ -243,17 +262,80 @@ display(predictDF)
 
 # COMMAND ----------
 
+# MAGIC %md
+# MAGIC `display` shows the first 1000 rows. To work with more of `predictDF` on the driver, `collect()` or `toPandas()` would build a Python object per row, and nothing stops them at the driver's memory. `ArrowTransfer` fetches Arrow batches into pandas instead, up to a row and a byte budget, and reports how much came over and how long it took.
+
+# COMMAND ----------
+
+# MAGIC %run ./Includes/Arrow-Transfer
+
+# COMMAND ----------
+
+driverTransfer = ArrowTransfer(maxRows=500000, maxBytes=512 * 1024 * 1024)
+predictPDF = driverTransfer.to_pandas(predictDF)
+print(driverTransfer.report())
+predictPDF.describe()
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ### Retraining Without Starting Over
+# MAGIC 
+# MAGIC The fit above starts from random factors, although only my handful of ratings is new. `ALSWarmStart` takes the model from the last full retrain, which never saw user `0`, and folds in just the users and products that have new ratings. Everything else keeps its factors. Compare its validation RMSE with the full refit.
+
+# COMMAND ----------
+
+# MAGIC %run ./Includes/ALS-Warm-Start
+
+# COMMAND ----------
+
+alsBasePath = "dbfs:/tmp/training-msft/als/base/"
+alsWarmPath = "dbfs:/tmp/training-msft/als/warm/"
+
+# Stands in for last night's full retrain, which didn't have my ratings yet
+try:
+  dbutils.fs.ls(alsBasePath)
+except Exception:
+  als.fit(trainingDF).write().overwrite().save(alsBasePath)
+
+warmModel = ALSWarmStart(als).update(alsBasePath, trainingWithMyRatingsDF, myRatingsDF, alsWarmPath)
+print("full refit RMSE: {:.4f}, warm start RMSE: {:.4f}".format(
+  regEval.evaluate(predictDF), regEval.evaluate(warmModel.transform(validationDF))))
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ### Ranking Quality on the Test Set
+# MAGIC 
+# MAGIC A low RMSE doesn't mean the top of the list is any good. Score the top 10 recommendations against the ratings held out in `testDF`: precision, recall, NDCG and MAP at 10, and how much of the catalog gets recommended at all. Products already rated in training are left out of the lists.
+
+# COMMAND ----------
+
+# MAGIC %run ./Includes/ALS-Ranking-Metrics
+
+# COMMAND ----------
+
+rankingMetrics = RankingEvaluator(k=10).evaluate(model, testDF, exclude=trainingWithMyRatingsDF, catalog=product_df)
+rankingMetrics
+
+# COMMAND ----------
+
 # MAGIC %md
 # MAGIC ## ![Spark Logo Tiny](https://s3-us-west-2.amazonaws.com/curriculum-release/wiki-book/general/logo_spark_tiny.png) *Part 2:* My Recommendations:
 # MAGIC Let's look at what ALS recommended for my user `0` based on my ratings
 
 # COMMAND ----------
 
-myPredictions = model.recommendForAllUsers(10)
+# MAGIC %md `recommendForAllUsers` would score every user just to show ours. `BlockedRecommender` scores only the users we ask for, using the model's factors in NumPy.
 
 # COMMAND ----------
 
-myPredictions = model.recommendForAllUsers(10)
+# MAGIC %run ./Includes/ALS-Recommender
+
+# COMMAND ----------
+
+recommender = BlockedRecommender(model)
+myPredictions = recommender.recommend_for_users([myUserId], 10)
 display(myPredictions.filter("user_id = 0"))
 
 # COMMAND ----------
@@ -263,7 +345,18 @@ myRecs = myPredictions.filter("user_id = 0").select("user_id", explode("recommen
 
 # COMMAND ----------
 
-display(myRecs)
+display(driverTransfer.to_pandas(myRecs))
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ### Serving Recommendations
+# MAGIC 
+# MAGIC The storefront can't start a Spark job for every page view. Save the model where the serving component watches for it. `tools/recommendation_service.py` keeps the factors and the product metadata in memory and answers `recommend(user_id, k)` and `similar_items(product_id, k)` in well under a millisecond. It swaps in every new model written here without a restart.
+
+# COMMAND ----------
+
+model.write().overwrite().save("dbfs:/tmp/training-msft/als/current/")
 
 # COMMAND ----------
 
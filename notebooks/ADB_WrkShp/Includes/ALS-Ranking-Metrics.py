@@ -0,0 +1,97 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC # ALS Ranking Metrics
+# MAGIC 
+# MAGIC RMSE measures how close the predicted ratings are. It doesn't show whether the products we actually recommend are ones the user went on to like.
+# MAGIC 
+# MAGIC `RankingEvaluator(k).evaluate(model, testDF)` scores the model's top `k` recommendations for every user with held-out ratings. A product counts as relevant to a user if they rated it `relevanceThreshold` or higher in the test data:
+# MAGIC * `precisionAtK`: relevant products among the `k` recommended, divided by `k`,
+# MAGIC * `recallAtK`: relevant products recommended, divided by the user's relevant products,
+# MAGIC * `ndcgAtK`: like recall, but a hit near the top of the list counts more, relative to the best possible ordering,
+# MAGIC * `map`: mean average precision at `k`,
+# MAGIC * `coverage`: the share of the catalog that appears in anyone's recommendations.
+# MAGIC 
+# MAGIC No per-user data is collected to the driver. The work runs as a few Spark jobs: with `exclude`, one counts each user's excluded products and takes their quantile and maximum (see below); the recommendations are cached and joined to the relevant ratings, aggregated per user and then over all users into one row of metrics; and a last job counts the distinct recommended products for `coverage`. Pass the training ratings as `exclude` so products a user already rated don't count as recommendations.
+# MAGIC 
+# MAGIC Excluding products means asking the model for more than `k` per user, enough to be left with `k`. Asking every user for `k` plus the largest number any one user has rated would make every list as long as the heaviest rater's. Instead, users are asked for `k` plus the `slackQuantile` (by default the 95th percentile) of those counts, and only the few users above it are asked for `k` plus the maximum.
+# MAGIC 
+# MAGIC Use it from another notebook with `%run ./Includes/ALS-Ranking-Metrics`
+
+# COMMAND ----------
+
+from pyspark.sql import Window
+from pyspark.sql import functions as F
+
+class RankingEvaluator(object):
+
+  def __init__(self, k=10, relevanceThreshold=4.0, userCol="user_id", itemCol="product_id", ratingCol="rating",
+               slackQuantile=0.95):
+    self.k = k
+    self.slackQuantile = slackQuantile
+    self.relevanceThreshold = relevanceThreshold
+    self.userCol = userCol
+    self.itemCol = itemCol
+    self.ratingCol = ratingCol
+
+  def recommendations(self, model, users, exclude=None):
+    """(user, pos, item) for the top `k` products of each user, skipping (user, item) pairs in `exclude`."""
+    u, i = self.userCol, self.itemCol
+    if exclude is None:
+      return self._top(model, users, self.k).where(F.col("pos") < self.k)
+
+    exclude = exclude.select(u, i).join(users, u)
+    counts = exclude.groupBy(u).count().localCheckpoint()
+    # Ask for enough extra products that users still have `k` once their excluded ones are dropped:
+    # most users get the quantile's worth, and only the heavy raters above it get more
+    quantile = counts.approxQuantile("count", [self.slackQuantile], 0.01)
+    slack = int(quantile[0]) if quantile else 0
+    heavy = counts.where(F.col("count") > slack)
+    recs = self._top(model, users.join(heavy, u, "left_anti"), self.k + slack)
+    heavySlack = heavy.agg(F.max("count")).first()[0]
+    if heavySlack is not None:
+      recs = recs.union(self._top(model, heavy.select(u), self.k + heavySlack))
+    recs = (recs.join(exclude, [u, i], "left_anti")
+      .withColumn("pos", F.row_number().over(Window.partitionBy(u).orderBy("pos")) - 1))
+    return recs.where(F.col("pos") < self.k)
+
+  def _top(self, model, users, n):
+    u, i = self.userCol, self.itemCol
+    return (model.recommendForUserSubset(users, n)
+      .select(u, F.posexplode("recommendations").alias("pos", "rec"))
+      .select(u, "pos", F.col("rec." + i).alias(i)))
+
+  def evaluate(self, model, test, exclude=None, catalog=None):
+    """A dict of the ranking metrics over users with at least one relevant product in `test`."""
+    u, i, k = self.userCol, self.itemCol, self.k
+    relevant = test.where(F.col(self.ratingCol) >= self.relevanceThreshold).select(u, i).distinct()
+    relevantCounts = relevant.groupBy(u).agg(F.count("*").alias("relevant"))
+    recs = self.recommendations(model, relevantCounts.select(u), exclude).cache()
+
+    hitsSoFar = F.sum("hit").over(Window.partitionBy(u).orderBy("pos"))
+    perUser = (recs
+      .join(relevant.withColumn("hit", F.lit(1)), [u, i], "left")
+      .withColumn("hit", F.coalesce(F.col("hit"), F.lit(0)))
+      .withColumn("precisionAtHit", F.when(F.col("hit") == 1, hitsSoFar / (F.col("pos") + 1)).otherwise(0.0))
+      .groupBy(u)
+      .agg(F.sum("hit").alias("hits"),
+           F.sum(F.col("hit") / F.log2(F.col("pos") + 2)).alias("dcg"),
+           F.sum("precisionAtHit").alias("apSum")))
+
+    # Users with relevant products but no recommendations still count, with zeros
+    metrics = (relevantCounts
+      .join(perUser, u, "left")
+      .fillna(0, ["hits", "dcg", "apSum"])
+      .withColumn("ideal", F.least(F.col("relevant"), F.lit(k)))
+      .withColumn("idcg", F.expr("aggregate(sequence(0, ideal - 1), 0D, (acc, n) -> acc + 1 / log2(n + 2))"))
+      .agg(F.avg(F.col("hits") / k).alias("precisionAtK"),
+           F.avg(F.col("hits") / F.col("relevant")).alias("recallAtK"),
+           F.avg(F.col("dcg") / F.col("idcg")).alias("ndcgAtK"),
+           F.avg(F.col("apSum") / F.col("ideal")).alias("map"),
+           F.count("*").alias("users"))
+      .first().asDict())
+
+    catalog = catalog if catalog is not None else model.itemFactors.select(F.col("id").alias(i))
+    metrics["coverage"] = recs.select(i).distinct().count() / float(catalog.select(i).distinct().count())
+    metrics["k"] = k
+    recs.unpersist()
+    return metrics
@@ -0,0 +1,109 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC # ALS Recommender
+# MAGIC 
+# MAGIC `model.recommendForAllUsers(10)` scores every user against every product. Calling it just to show one user's list does all of that work for one row.
+# MAGIC 
+# MAGIC `BlockedRecommender` scores with NumPy on the exported factors:
+# MAGIC * the item factors are fetched once, as Arrow batches (`ArrowTransfer`), into a contiguous `float32` matrix,
+# MAGIC * users are scored a block at a time (`blockSize` users), with one matrix multiply per block against all items. `argpartition` then finds each user's top `k` without sorting the whole row, and only those `k` are sorted,
+# MAGIC * `recommend_for_users(userIds, k)` reads just the requested users' factor rows and scores them on the driver, so its cost does not depend on how many users there are,
+# MAGIC * `recommend_for_all_users(k)` broadcasts the item matrix and scores every partition of `userFactors` the same way on the executors.
+# MAGIC 
+# MAGIC Both return the same columns as `recommendForAllUsers`. `top_k(userIds, k)` returns plain arrays instead: user ids, item ids (users x `k`) and scores.
+# MAGIC 
+# MAGIC Use it from another notebook with `%run ./Includes/ALS-Recommender`
+
+# COMMAND ----------
+
+# MAGIC %run ./Python-Builtins
+
+# COMMAND ----------
+
+# MAGIC %run ./Arrow-Transfer
+
+# COMMAND ----------
+
+import numpy as np
+
+from pyspark.sql.functions import col
+from pyspark.sql.types import ArrayType, FloatType, IntegerType, StructField, StructType
+
+def factor_arrays(rows):
+  """Ids and a contiguous float32 factor matrix from (id, features) rows."""
+  ids = np.array([r[0] for r in rows], dtype=np.int64)
+  rank = len(rows[0][1]) if rows else 0
+  factors = np.array([r[1] for r in rows], dtype=np.float32).reshape(len(rows), rank)
+  return ids, np.ascontiguousarray(factors)
+
+def top_k_indices(scores, k):
+  """Column indices and values of the `k` largest scores in each row, best first."""
+  k = py_min(k, scores.shape[1])
+  if k <= 0:
+    return np.empty((scores.shape[0], 0), dtype=np.int64), np.empty((scores.shape[0], 0), dtype=scores.dtype)
+  idx = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+  top = np.take_along_axis(scores, idx, axis=1)
+  order = np.argsort(-top, axis=1)
+  return np.take_along_axis(idx, order, axis=1), np.take_along_axis(top, order, axis=1)
+
+def score_blocks(userIds, userMatrix, itemIds, itemMatrix, k, blockSize):
+  """Yield (userId, [(itemId, score), ..]) for every user, scoring `blockSize` users per matrix multiply."""
+  for start in range(0, len(userIds), blockSize):
+    idx, scores = top_k_indices(userMatrix[start:start + blockSize].dot(itemMatrix.T), k)
+    items = itemIds[idx]
+    for i, userId in enumerate(userIds[start:start + blockSize]):
+      yield int(userId), [(int(item), float(score)) for item, score in zip(items[i], scores[i])]
+
+def _score_partition(items, k, blockSize):
+  def score(rows):
+    rows = list(rows)
+    if not rows:
+      return iter([])
+    userIds, userMatrix = factor_arrays(rows)
+    itemIds, itemMatrix = items.value
+    return score_blocks(userIds, userMatrix, itemIds, itemMatrix, k, blockSize)
+  return score
+
+class BlockedRecommender(object):
+
+  def __init__(self, model, blockSize=1024):
+    self.userCol = model.getUserCol()
+    self.itemCol = model.getItemCol()
+    self.userFactors = model.userFactors
+    self.itemIds, self.itemMatrix = self._factors(model.itemFactors)
+    self.blockSize = blockSize
+    self.schema = StructType([
+      StructField(self.userCol, IntegerType()),
+      StructField("recommendations", ArrayType(StructType([
+        StructField(self.itemCol, IntegerType()),
+        StructField("rating", FloatType())])))])
+    self._items = None
+
+  @staticmethod
+  def _factors(factors):
+    arrays = ArrowTransfer(maxRows=None, maxBytes=None).to_numpy(factors, ["id", "features"])
+    return arrays["id"].astype(np.int64), arrays["features"].astype(np.float32, copy=False)
+
+  def _user_factors(self, userIds):
+    return self._factors(self.userFactors.where(col("id").isin([int(u) for u in userIds])).orderBy("id"))
+
+  def top_k(self, userIds, k):
+    """(userIds, itemIds, scores) arrays for the requested users that the model knows, in id order."""
+    ids, users = self._user_factors(userIds)
+    if not len(ids):
+      return ids, np.empty((0, k), dtype=np.int64), np.empty((0, k), dtype=np.float32)
+    idx, scores = top_k_indices(users.dot(self.itemMatrix.T), k)
+    return ids, self.itemIds[idx], scores
+
+  def recommend_for_users(self, userIds, k):
+    """Like `recommendForUserSubset`, touching only the requested users' factors."""
+    userIds, userMatrix = self._user_factors(userIds)
+    recs = list(score_blocks(userIds, userMatrix, self.itemIds, self.itemMatrix, k, self.blockSize))
+    return spark.createDataFrame(recs, self.schema)
+
+  def recommend_for_all_users(self, k):
+    """Like `recommendForAllUsers`, scoring each partition of users in blocks against a broadcast item matrix."""
+    if self._items is None:
+      self._items = spark.sparkContext.broadcast((self.itemIds, self.itemMatrix))
+    recs = self.userFactors.rdd.mapPartitions(_score_partition(self._items, k, self.blockSize))
+    return spark.createDataFrame(recs, self.schema)
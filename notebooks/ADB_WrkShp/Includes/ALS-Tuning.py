@@ -0,0 +1,88 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC # ALS Tuning
+# MAGIC 
+# MAGIC Trying every combination of `rank`, `regParam`, `maxIter` and `alpha` one after another takes hours, and most combinations are clearly worse after a few iterations.
+# MAGIC 
+# MAGIC `ALSSearch` searches the grid with successive halving:
+# MAGIC * the training and validation data are cached once and shared by every fit,
+# MAGIC * every `rank` x `regParam` x `alpha` candidate is fitted with the smallest `maxIter`, `parallelism` fits at a time. Each fit is a separate Spark job, so they share the cluster instead of queueing,
+# MAGIC * candidates are ranked by the evaluator's metric on the validation data (RMSE for `regEval`). Only the best `keepFraction` are fitted again with the next `maxIter`, and so on up to the largest,
+# MAGIC * every fit lands in `leaderboard`, best first, with its score in a column named after the evaluator's metric (`rmse` for `regEval`), and the best one is kept as `bestModel`, with its parameters in `bestParams` and a matching `ALS` in `bestEstimator`.
+# MAGIC 
+# MAGIC `alpha` only affects `implicitPrefs=True`. Leave it at one value for explicit ratings.
+# MAGIC 
+# MAGIC Use it from another notebook with `%run ./Includes/ALS-Tuning`
+
+# COMMAND ----------
+
+# MAGIC %run ./Python-Builtins
+
+# COMMAND ----------
+
+import itertools
+import math
+import time
+from multiprocessing.pool import ThreadPool
+
+leaderboardSchema = "rank int, regParam double, alpha double, maxIter int, `{metric}` double, fitSeconds double"
+
+class ALSSearch(object):
+
+  def __init__(self, als, evaluator, ranks=(2,), regParams=(0.1,), alphas=(1.0,), maxIters=(5,),
+               parallelism=4, keepFraction=0.5):
+    self.als = als
+    self.evaluator = evaluator
+    # A grid written as regParams=(0, 1) holds ints, which the double columns of the leaderboard reject
+    self.candidates = [(int(r), float(p), float(a)) for r, p, a in itertools.product(ranks, regParams, alphas)]
+    self.maxIters = sorted(maxIters)
+    self.parallelism = parallelism
+    self.keepFraction = keepFraction
+    self.results = []
+    self.leaderboard = None
+    self.bestModel = None
+    self.bestParams = None
+    self.bestEstimator = None
+
+  def _estimator(self, candidate, maxIter):
+    rank, regParam, alpha = candidate
+    return self.als.copy().setRank(rank).setRegParam(regParam).setAlpha(alpha).setMaxIter(maxIter)
+
+  def _fit(self, candidate, maxIter, training, validation):
+    started = time.time()
+    model = self._estimator(candidate, maxIter).fit(training)
+    fitSeconds = time.time() - started
+    metric = self.evaluator.evaluate(model.transform(validation))
+    return candidate + (maxIter, float(metric), fitSeconds), model
+
+  def fit(self, training, validation):
+    """Search the grid, fitting on `training` and scoring on `validation`. Returns the best model."""
+    training.persist()
+    validation.persist()
+    training.count()
+    validation.count()
+
+    sign = -1 if self.evaluator.isLargerBetter() else 1
+    survivors = list(self.candidates)
+    pool = ThreadPool(self.parallelism)
+    try:
+      for maxIter in self.maxIters:
+        fits = pool.map(lambda c: self._fit(c, maxIter, training, validation), survivors)
+        fits.sort(key=lambda f: sign * f[0][4])
+        for row, model in fits:
+          self.results.append(row)
+          if self.bestParams is None or sign * row[4] < sign * self.bestParams[4]:
+            self.bestParams, self.bestModel = row, model
+        print("maxIter={}: {} candidates, best {:.4f}".format(maxIter, len(fits), fits[0][0][4]))
+        keep = py_max(1, int(math.ceil(len(fits) * self.keepFraction)))
+        survivors = [row[:3] for row, _ in fits[:keep]]
+    finally:
+      pool.close()
+      training.unpersist()
+      validation.unpersist()
+
+    self.bestEstimator = self._estimator(self.bestParams[:3], self.bestParams[3])
+    metricName = self.evaluator.getMetricName()
+    self.leaderboard = spark.createDataFrame(self.results, leaderboardSchema.format(metric=metricName)).orderBy(
+      metricName, ascending=sign > 0)
+    return self.bestModel
@@ -0,0 +1,93 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC # ALS Warm Start
+# MAGIC 
+# MAGIC `als.fit(..)` starts from random factors every time, even when the only change since the last model is a handful of new ratings.
+# MAGIC 
+# MAGIC `ALSWarmStart` updates a saved `ALSModel` instead of refitting it:
+# MAGIC * items that the saved model has never seen are *folded in* first: with the user factors held fixed, each item's factors are the least-squares solution over all of its ratings. This is the same regularized solve ALS runs for every item in each iteration, applied to the new items only,
+# MAGIC * users with new ratings are then folded in the same way against the item factors, the new items included, so a rating of a brand-new product counts too. With `iterations` above 1, the new items and the users are solved again in turn so they can settle against each other,
+# MAGIC * every other user and item keeps its saved factors, and the result is written as a regular `ALSModel` that `ALSModel.load` can read.
+# MAGIC 
+# MAGIC A user can only be folded in through items that have factors, and a new item only through users that have them. A new user who rated nothing but new items, which in turn nobody else rated, has no way in and keeps no factors, so `transform` predicts `NaN` for them. `update` leaves those users in `notFoldedIn`, and they need a full `als.fit(..)`.
+# MAGIC 
+# MAGIC The updated model is written next to the saved one, never over it: the factors are read from `modelPath` while the new ones are written.
+# MAGIC 
+# MAGIC Each solve groups the affected ratings by user or item and solves a `rank` x `rank` system per group, so the cost grows with the number of new ratings rather than with the whole data set. Run a full `als.fit(..)` now and then, because existing factors drift out of date as ratings accumulate. Only explicit ratings (`implicitPrefs=False`) are supported.
+# MAGIC 
+# MAGIC Use it from another notebook with `%run ./Includes/ALS-Warm-Start`
+
+# COMMAND ----------
+
+import numpy as np
+
+from pyspark.ml.recommendation import ALSModel
+from pyspark.sql.functions import col
+
+def _solve_factors(rank, regParam):
+  def solve(rows):
+    rows = list(rows)
+    fixed = np.array([features for features, _ in rows], dtype=np.float64)
+    ratings = np.array([rating for _, rating in rows], dtype=np.float64)
+    # Same weighting as Spark's ALS: the penalty grows with the number of ratings
+    gram = fixed.T.dot(fixed) + regParam * len(rows) * np.eye(rank)
+    return [float(x) for x in np.linalg.solve(gram, fixed.T.dot(ratings))]
+  return solve
+
+class ALSWarmStart(object):
+
+  def __init__(self, als):
+    """`als` supplies the column names and regParam the saved model was trained with."""
+    self.userCol = als.getUserCol()
+    self.itemCol = als.getItemCol()
+    self.ratingCol = als.getRatingCol()
+    self.regParam = als.getRegParam()
+    self.notFoldedIn = None
+
+  def fold_in(self, ratings, key, other, fixedFactors, rank):
+    """Least-squares factors for every `key` in `ratings`, holding the `other` side's `fixedFactors` fixed."""
+    pairs = (ratings
+      .join(fixedFactors.select(col("id").alias(other), "features"), other)
+      .select(key, "features", col(self.ratingCol).cast("double")))
+    return (pairs.rdd
+      .map(lambda r: (r[0], (r[1], r[2])))
+      .groupByKey()
+      .mapValues(_solve_factors(rank, self.regParam))
+      .toDF("id int, features array<float>"))
+
+  def update(self, modelPath, ratings, newRatings, outputPath, iterations=1):
+    """
+    Write to `outputPath` the model at `modelPath` updated for `newRatings`, and return it.
+    `ratings` is the full set of current ratings, `newRatings` included.
+    Users of `newRatings` that couldn't be folded in are left in `notFoldedIn`, as a DataFrame of ids.
+    """
+    if outputPath.rstrip("/") == modelPath.rstrip("/"):
+      raise ValueError("outputPath must differ from modelPath: the saved factors are still being read while the new ones are written")
+    model = ALSModel.load(modelPath)
+    users = newRatings.select(col(self.userCol).alias("id")).distinct()
+    items = newRatings.select(col(self.itemCol).alias("id")).distinct().join(model.itemFactors, "id", "left_anti")
+
+    userRatings = ratings.join(users.withColumnRenamed("id", self.userCol), self.userCol).cache()
+    itemRatings = ratings.join(items.withColumnRenamed("id", self.itemCol), self.itemCol).cache()
+    hasNewItems = itemRatings.limit(1).count() > 0
+
+    userFactors, itemFactors = model.userFactors, model.itemFactors
+    for _ in range(iterations):
+      # Items first, so the users' solve already sees the products they rated that the model didn't know
+      if hasNewItems:
+        newItems = self.fold_in(itemRatings, self.itemCol, self.userCol, userFactors, model.rank)
+        itemFactors = itemFactors.join(newItems, "id", "left_anti").union(newItems).localCheckpoint()
+      newUsers = self.fold_in(userRatings, self.userCol, self.itemCol, itemFactors, model.rank)
+      userFactors = userFactors.join(newUsers, "id", "left_anti").union(newUsers).localCheckpoint()
+      if not hasNewItems:
+        break
+    self.notFoldedIn = users.join(userFactors, "id", "left_anti")
+
+    # An ALSModel on disk is its params metadata plus the two factor tables
+    dbutils.fs.rm(outputPath, True)
+    dbutils.fs.cp(modelPath.rstrip("/") + "/metadata", outputPath.rstrip("/") + "/metadata", True)
+    userFactors.write.parquet(outputPath.rstrip("/") + "/userFactors")
+    itemFactors.write.parquet(outputPath.rstrip("/") + "/itemFactors")
+    userRatings.unpersist()
+    itemRatings.unpersist()
+    return ALSModel.load(outputPath)
@@ -0,0 +1,117 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC # Admission Control
+# MAGIC 
+# MAGIC Fixed intake limits like `maxFilesPerTrigger=1` or `eventhubs.maxRate=100` are too low for a backfill and can be too high during a spike.
+# MAGIC 
+# MAGIC `AdmissionController` adjusts the limit to keep each batch close to `targetBatchSeconds`:
+# MAGIC * every `checkSeconds` it reads the batches in `StreamingQuery.recentProgress`: input rows, input and processing rows per second, and batch duration,
+# MAGIC * if batches are faster than the target and the source still has data waiting, it raises the limit, and if they are slower it lowers it, in proportion to `target / observed` and never past `minValue`/`maxValue`,
+# MAGIC * a source option can't change on a running query, so a new limit means stopping the query and starting it again from the same checkpoint. To limit those restarts, small changes (under `minChangeRatio`) are ignored,
+# MAGIC * every decision is printed and kept in `decisions`, and appended to `logPath` if one is given.
+# MAGIC 
+# MAGIC Use it from another notebook with `%run ./Includes/Admission-Control`
+
+# COMMAND ----------
+
+# MAGIC %run ./Python-Builtins
+
+# COMMAND ----------
+
+import threading
+import time
+
+decisionSchema = ("time string, batchId long, limit long, newLimit long, action string, batchSeconds double, "
+                  "numInputRows long, inputRowsPerSecond double, processedRowsPerSecond double")
+
+class AdmissionController(object):
+
+  def __init__(self, start, initial, minValue, maxValue, targetBatchSeconds=15.0,
+               checkSeconds=60, minChangeRatio=1.5, maxStepRatio=4.0, logPath=None):
+    """
+    `start(limit)` must build the stream with its intake option set to `limit`, start it against a fixed
+    checkpointLocation and return the StreamingQuery.
+    """
+    self.start = start
+    self.limit = initial
+    self.minValue = minValue
+    self.maxValue = maxValue
+    self.targetBatchSeconds = float(targetBatchSeconds)
+    self.checkSeconds = checkSeconds
+    self.minChangeRatio = minChangeRatio
+    self.maxStepRatio = maxStepRatio
+    self.logPath = logPath
+    self.decisions = []
+    self.query = None
+    self._stopped = threading.Event()
+    self._thread = None
+
+  def _completed_batches(self):
+    # The first batch after a (re)start pays for planning and warm-up, so leave it out
+    return [p for p in self.query.recentProgress[1:] if p["numInputRows"] > 0]
+
+  def decide(self, batches, dataAvailable):
+    """Return the next limit given the recent batches of the running query."""
+    durations = sorted(p["durationMs"]["triggerExecution"] / 1000.0 for p in batches)
+    observed = durations[len(durations) // 2]
+    ratio = self.targetBatchSeconds / py_max(observed, 0.001)
+    if ratio > 1 and not dataAvailable:
+      return self.limit  # fast only because there is nothing left to read
+    ratio = py_min(py_max(ratio, 1.0 / self.maxStepRatio), self.maxStepRatio)
+    return int(py_min(py_max(py_round(self.limit * ratio), self.minValue), self.maxValue))
+
+  def _log(self, batches, newLimit, action):
+    last = batches[-1]
+    decision = (
+      time.strftime("%Y-%m-%d %H:%M:%S"),
+      last["batchId"],
+      self.limit,
+      newLimit,
+      action,
+      last["durationMs"]["triggerExecution"] / 1000.0,
+      last["numInputRows"],
+      float(last.get("inputRowsPerSecond") or 0.0),
+      float(last.get("processedRowsPerSecond") or 0.0))
+    self.decisions.append(decision)
+    print("admission: {} limit {} -> {} (batch {:.1f}s, {} rows)".format(action, self.limit, newLimit, decision[5], decision[6]))
+    if self.logPath:
+      spark.createDataFrame([decision], decisionSchema).coalesce(1).write.mode("append").json(self.logPath)
+
+  def _check(self):
+    batches = self._completed_batches()
+    if not batches:
+      return
+    newLimit = self.decide(batches, self.query.status["isDataAvailable"])
+    change = float(py_max(newLimit, self.limit)) / py_max(py_min(newLimit, self.limit), 1)
+    if newLimit == self.limit or change < self.minChangeRatio:
+      self._log(batches, self.limit, "keep")
+      return
+    self._log(batches, newLimit, "restart")
+    self.query.stop()
+    self.limit = newLimit
+    self.query = self.start(self.limit)
+
+  def _run(self):
+    while not self._stopped.wait(self.checkSeconds):
+      if self.query is None or not self.query.isActive:
+        break
+      try:
+        self._check()
+      except Exception as e:
+        print("admission check failed: {}".format(e))
+
+  def run(self):
+    """Start the query at the initial limit and keep adjusting it in the background. Returns self."""
+    self.query = self.start(self.limit)
+    self._thread = threading.Thread(target=self._run, name="admission-control")
+    self._thread.daemon = True
+    self._thread.start()
+    return self
+
+  def stop(self):
+    self._stopped.set()
+    if self.query is not None:
+      self.query.stop()
+
+  def decisionsDF(self):
+    return spark.createDataFrame(self.decisions, decisionSchema)
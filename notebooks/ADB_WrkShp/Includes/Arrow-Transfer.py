@@ -0,0 +1,139 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC # Arrow Transfer
+# MAGIC 
+# MAGIC `collect()` builds a Python `Row` for every row and an object for every value in it. For a few hundred thousand wide rows that takes minutes, and an unbounded `collect()` or `toPandas()` can run the driver out of memory.
+# MAGIC 
+# MAGIC `ArrowTransfer` brings results to the driver as Arrow record batches instead:
+# MAGIC * at most `maxRows` rows are fetched. The byte budget `maxBytes` is applied on the executors, before anything is sent: it is shared equally between the partitions of the result, and each partition is cut as soon as its batches add up to more than its share. The driver never receives more than `maxBytes`, though a large partition next to small ones can be cut before the budget as a whole is used up. Either cut is reported in `truncated`, never silently,
+# MAGIC * `to_pandas(df)` converts the batches column by column, freeing the Arrow memory of each column once it is converted, with no Python object per row. Timestamps are shown in the session time zone, as `toPandas()` does,
+# MAGIC * `to_numpy(df)` returns one NumPy array per column. An array column whose arrays all have the same length, like ALS `features`, becomes a 2-D matrix,
+# MAGIC * every transfer records rows, bytes, batches and the fetch and conversion times in `last`, and `report()` formats them.
+# MAGIC 
+# MAGIC Pass `None` for either budget to turn it off. Columns Arrow can't represent fall back to a row-by-row `collect()` within the same row budget.
+# MAGIC 
+# MAGIC Use it from another notebook with `%run ./Includes/Arrow-Transfer`
+
+# COMMAND ----------
+
+# MAGIC %run ./Python-Builtins
+
+# COMMAND ----------
+
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from pyspark.sql.pandas.types import to_arrow_schema
+
+def _byte_budget(maxBytes, cut):
+  def take(batches):
+    used = 0
+    for batch in batches:
+      if used + batch.nbytes <= maxBytes:
+        used += batch.nbytes
+        yield batch
+        continue
+      # Rows in one batch are close enough in size to cut it by the average
+      fits = int((maxBytes - used) // (batch.nbytes / float(py_max(batch.num_rows, 1))))
+      if fits:
+        yield batch.slice(0, fits)
+      cut.add(1)
+      return
+  return take
+
+class ArrowTransfer(object):
+
+  def __init__(self, maxRows=100000, maxBytes=256 * 1024 * 1024):
+    self.maxRows = maxRows
+    self.maxBytes = maxBytes
+    self.last = None
+
+  def table(self, df):
+    """Up to `maxRows` rows and `maxBytes` bytes of `df` as a pyarrow Table. TypeError if Arrow can't carry a column."""
+    start = time.time()
+    schema = to_arrow_schema(df.schema)
+
+    # One extra row tells a full result from one cut at exactly `maxRows`
+    limited = df.limit(self.maxRows + 1) if self.maxRows is not None else df
+    cut = None
+    if self.maxBytes is not None and hasattr(limited, "mapInArrow"):
+      cut = spark.sparkContext.accumulator(0)
+      # Every partition is fetched at once, so each gets its share: together they can't bring more than maxBytes
+      share = py_max(1, self.maxBytes // py_max(limited.rdd.getNumPartitions(), 1))
+      limited = limited.mapInArrow(_byte_budget(share, cut), df.schema)
+    batches = limited._collect_as_arrow()
+    # The JVM tags timestamps with the session time zone, so the schema only comes from Spark when there is no batch to take it from
+    table = pa.Table.from_batches(batches) if batches else pa.Table.from_batches([], schema=schema)
+    del batches
+    fetchSeconds = time.time() - start
+
+    truncated = None
+    if self.maxRows is not None and table.num_rows > self.maxRows:
+      table, truncated = table.slice(0, self.maxRows), "rows"
+    if cut is not None and cut.value:
+      truncated = "bytes"
+    self.last = {"rows": table.num_rows, "bytes": table.nbytes, "batches": table.column(0).num_chunks if table.num_columns else 0,
+                 "fetchSeconds": fetchSeconds, "convertSeconds": 0.0, "truncated": truncated}
+    return table
+
+  def _collect_pandas(self, df):
+    start = time.time()
+    limited = df.limit(self.maxRows + 1) if self.maxRows is not None else df
+    rows = limited.collect()
+    truncated = "rows" if self.maxRows is not None and len(rows) > self.maxRows else None
+    rows = rows[:self.maxRows] if truncated else rows
+    self.last = {"rows": len(rows), "bytes": None, "batches": None, "fetchSeconds": time.time() - start,
+                 "convertSeconds": 0.0, "truncated": truncated}
+    return pd.DataFrame.from_records(rows, columns=df.columns)
+
+  def to_pandas(self, df):
+    """Up to the budgets of `df` as a pandas DataFrame."""
+    try:
+      table = self.table(df)
+    except TypeError:
+      return self._collect_pandas(df)
+    start = time.time()
+    pdf = table.to_pandas(self_destruct=True, split_blocks=True)
+    del table
+    timeZone = spark.conf.get("spark.sql.session.timeZone")
+    for c in pdf.columns:
+      if hasattr(pdf[c], "dt") and getattr(pdf[c].dt, "tz", None) is not None:
+        pdf[c] = pdf[c].dt.tz_convert(timeZone).dt.tz_localize(None)
+    self.last["convertSeconds"] = time.time() - start
+    return pdf
+
+  def to_numpy(self, df, columns=None):
+    """A dict of column name to NumPy array for `columns` (all of them by default) of `df`, within the budgets."""
+    if columns is not None:
+      df = df.select(*columns)
+    table = self.table(df)
+    start = time.time()
+    arrays = {}
+    for name in table.column_names:
+      arrays[name] = self._column_array(table.column(name).combine_chunks())
+    self.last["convertSeconds"] = time.time() - start
+    return arrays
+
+  @staticmethod
+  def _column_array(column):
+    if pa.types.is_list(column.type) and column.null_count == 0:
+      lengths = np.diff(column.offsets.to_numpy())
+      if len(lengths) and (lengths == lengths[0]).all():
+        values = column.flatten().to_numpy(zero_copy_only=False)
+        return np.ascontiguousarray(values.reshape(len(column), lengths[0]))
+      if not len(lengths):
+        return np.empty((0, 0), dtype=column.type.value_type.to_pandas_dtype())
+    return column.to_numpy(zero_copy_only=False)
+
+  def report(self):
+    """The last transfer as one line."""
+    if self.last is None:
+      return "no transfer yet"
+    r = self.last
+    size = "{:.1f} MB".format(r["bytes"] / 1e6) if r["bytes"] is not None else "row by row"
+    return "{} rows, {} in {} batches, fetched in {:.2f}s, converted in {:.2f}s{}".format(
+      r["rows"], size, r["batches"], r["fetchSeconds"], r["convertSeconds"],
+      ", cut at the {} budget".format(r["truncated"]) if r["truncated"] else "")
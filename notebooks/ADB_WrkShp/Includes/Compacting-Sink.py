@@ -0,0 +1,150 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC # Compacting Sink
+# MAGIC 
+# MAGIC `repartition(1)` in front of a file sink pushes the whole stream through one task and still leaves a small file every trigger.
+# MAGIC 
+# MAGIC `start_compacting_sink(..)` writes the stream to a Delta table partitioned by order date instead:
+# MAGIC * every task writes its own files in parallel, and optimized writes bin-pack them per partition as they are written,
+# MAGIC * auto compaction merges what is still small after each write, and `Compactor` runs `OPTIMIZE` on the most recent partitions in the background. "Recent" is counted back from the newest order date in the table, not from today, so replayed or historic orders are compacted too,
+# MAGIC * the streaming write and every compaction are separate commits to the Delta transaction log. A reader sees a partition either before or after a compaction, never the old and new files together. Compactions are recorded as `dataChange=false`, so streams reading the table don't see their rows a second time,
+# MAGIC * the stream's checkpoint and the table's transaction log record which batches have been written, so a restarted query neither skips nor repeats a batch.
+# MAGIC 
+# MAGIC Optimized writes, auto compaction and the target file size are properties of the table, set when it is created, not settings of the Spark session.
+# MAGIC 
+# MAGIC A query that has to do more with each batch than write it, like routing it with `OrderDecoder.start`, writes through `CompactingSink(path).append(df, batchId)` from its `foreachBatch` step instead. It merges on `orderUUID`, so an order already in the table, whether redelivered by Event Hubs or replayed after a restart, is not inserted again.
+# MAGIC 
+# MAGIC Without Delta, as in a local run of `tools/notebook_bench.py`, the same calls write plain Parquet partitioned by order date, and `Compactor` does nothing. A batch replayed after a restart replaces its own files (they sit under a `batchId=` directory), but an order redelivered in a later batch is not caught.
+# MAGIC 
+# MAGIC Use it from another notebook with `%run ./Includes/Compacting-Sink`
+
+# COMMAND ----------
+
+import os
+import threading
+
+from pyspark.sql.functions import col, lit, to_date
+from pyspark.sql.functions import max as max_
+
+def delta_available():
+  """Delta is built into Databricks runtimes, and plain Spark has it only with its session extension configured."""
+  return ("DATABRICKS_RUNTIME_VERSION" in os.environ
+          or "DeltaSparkSessionExtension" in spark.conf.get("spark.sql.extensions", ""))
+
+def _create_table(path, schema, partitionColumn, targetFileBytes):
+  from delta.tables import DeltaTable
+  builder = DeltaTable.createIfNotExists(spark).location(path).addColumns(schema).partitionedBy(partitionColumn)
+  for key, value in [("delta.autoOptimize.optimizeWrite", "true"),
+                     ("delta.autoOptimize.autoCompact", "true"),
+                     ("delta.targetFileSize", str(targetFileBytes))]:
+    builder = builder.property(key, value)
+  builder.execute()
+
+def start_compacting_sink(df, path, checkpointLocation, timeColumn="orderTimestamp", partitionColumn="orderDate",
+                          processingTime="15 seconds", targetFileBytes=128 * 1024 * 1024):
+  """Stream `df` into a Delta table at `path`, partitioned by the date of `timeColumn`, with parallel, size-managed writes."""
+  df = df.withColumn(partitionColumn, to_date(timeColumn))
+  writer = (df.writeStream
+    .partitionBy(partitionColumn)
+    .option("checkpointLocation", checkpointLocation)
+    .trigger(processingTime=processingTime))
+  if not delta_available():
+    return writer.format("parquet").option("path", path).start()
+  _create_table(path, df.schema, partitionColumn, targetFileBytes)
+  return writer.format("delta").start(path)
+
+# COMMAND ----------
+
+class CompactingSink(object):
+  """The same table as `start_compacting_sink`, written one batch at a time from a `foreachBatch` step."""
+
+  def __init__(self, path, timeColumn="orderTimestamp", partitionColumn="orderDate", keyColumn="orderUUID",
+               targetFileBytes=128 * 1024 * 1024):
+    self.path = path
+    self.timeColumn = timeColumn
+    self.partitionColumn = partitionColumn
+    self.keyColumn = keyColumn
+    self.targetFileBytes = targetFileBytes
+    self.delta = delta_available()
+    self._created = False
+
+  def append(self, batchDF, batchId):
+    """Insert the rows of `batchDF` whose `keyColumn` isn't in the table yet. Replaying a batch inserts nothing."""
+    rows = batchDF.dropDuplicates([self.keyColumn]).withColumn(self.partitionColumn, to_date(self.timeColumn))
+    if not self.delta:
+      self._append_parquet(rows, batchId)
+      return
+    if not self._created:
+      _create_table(self.path, rows.schema, self.partitionColumn, self.targetFileBytes)
+      self._created = True
+
+    from delta.tables import DeltaTable
+    dates = [r[0] for r in rows.select(self.partitionColumn).distinct().collect() if r[0] is not None]
+    if not dates:
+      return
+    # A redelivered order keeps its timestamp, so only the batch's own date partitions need to be searched
+    condition = "t.{p} IN ({dates}) AND t.{p} = s.{p} AND t.{k} = s.{k}".format(
+      p=self.partitionColumn, k=self.keyColumn, dates=", ".join("DATE'{}'".format(d) for d in dates))
+    (DeltaTable.forPath(spark, self.path).alias("t")
+      .merge(rows.alias("s"), condition)
+      .whenNotMatchedInsertAll()
+      .execute())
+
+  def read(self):
+    """The orders written so far, as a Delta table, or the Parquet files of the fallback without their `batchId` column."""
+    if self.delta:
+      return spark.read.format("delta").load(self.path)
+    return spark.read.parquet(self.path).drop("batchId")
+
+  def _append_parquet(self, rows, batchId):
+    previousMode = spark.conf.get("spark.sql.sources.partitionOverwriteMode", "static")
+    spark.conf.set("spark.sql.sources.partitionOverwriteMode", "dynamic")
+    try:
+      (rows.withColumn("batchId", lit(batchId))
+        .write.mode("overwrite")
+        .partitionBy(self.partitionColumn, "batchId")
+        .parquet(self.path))
+    finally:
+      spark.conf.set("spark.sql.sources.partitionOverwriteMode", previousMode)
+
+# COMMAND ----------
+
+class Compactor(object):
+  """Periodically OPTIMIZE the `lookbackDays` date partitions up to the newest one in a Delta table, where late and small files collect."""
+
+  def __init__(self, path, partitionColumn="orderDate", lookbackDays=2, intervalSeconds=600):
+    self.path = path
+    self.partitionColumn = partitionColumn
+    self.lookbackDays = lookbackDays
+    self.intervalSeconds = intervalSeconds
+    self.history = []
+    self._stopped = threading.Event()
+    self._thread = threading.Thread(target=self._run, name="delta-compactor")
+    self._thread.daemon = True
+
+  def compact(self):
+    # The orders carry their own dates, which can be far from today's, so the window ends at the newest one
+    latest = spark.read.format("delta").load(self.path).agg(max_(col(self.partitionColumn))).first()[0]
+    if latest is None:
+      return None
+    result = spark.sql("OPTIMIZE delta.`{}` WHERE {} >= date_sub(DATE'{}', {})".format(
+      self.path, self.partitionColumn, latest, self.lookbackDays))
+    self.history.append(result.collect())
+    return result
+
+  def _run(self):
+    while not self._stopped.wait(self.intervalSeconds):
+      try:
+        self.compact()
+      except Exception as e:
+        print("compaction failed, will retry next interval: {}".format(e))
+
+  def start(self):
+    if not delta_available():
+      print("no Delta in this session, so there is nothing to compact: the sink writes plain Parquet")
+      return self
+    self._thread.start()
+    return self
+
+  def stop(self):
+    self._stopped.set()
@@ -0,0 +1,200 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC # Cost As-Of Join
+# MAGIC 
+# MAGIC Joining orders to the `productsFull` snapshot prices every order at the cost in the snapshot, however old it is. Reloading the whole dimension for a handful of changes is expensive, and the costs are still wrong between reloads.
+# MAGIC 
+# MAGIC `CostAsOfJoin` treats cost changes as a second stream of `(ProductID, StandardCost, effectiveTime)` events, and gives every order the cost in effect at its `orderTimestamp`:
+# MAGIC * both streams are grouped by product into one stateful step (`applyInPandasWithState`). Per product, the state holds the cost changes, and the orders that are waiting for theirs,
+# MAGIC * only the orders carry a watermark, so only the orders move event time forward. Cost changes often stop for hours, and with a watermark of their own a quiet cost feed would hold back every order,
+# MAGIC * a cost change is expected within `costDelay` of its `effectiveTime`, measured on the orders' event time. An order is emitted once the order watermark is `costDelay` past its timestamp, with the latest change effective at or before `orderTimestamp`. A change that arrives later than that still prices the orders after it, but not the ones already emitted,
+# MAGIC * changes from before the oldest order that can still be waiting are dropped, except the latest of them, which is still in effect. State is bounded by the watermark delay, not by history. Waiting orders are kept as typed array columns, one per order column, so the state stays readable by any Spark version,
+# MAGIC * orders placed before the first change the stream has seen for their product get the cost from `snapshot`, if one is given.
+# MAGIC 
+# MAGIC Orders come out `costDelay` of event time later than with the static join. Each product's orders are handled as a batch in pandas, with one `searchsorted` per batch.
+# MAGIC 
+# MAGIC Use it from another notebook with `%run ./Includes/Cost-AsOf-Join`
+
+# COMMAND ----------
+
+from pyspark.sql import functions as F
+from pyspark.sql.streaming.state import GroupStateTimeout
+from pyspark.sql.types import (ArrayType, DoubleType, FloatType, IntegerType, LongType, ShortType, StructField,
+                               StructType, TimestampType)
+
+costChangeSchema = StructType([
+  StructField("ProductID", IntegerType(), True),
+  StructField("StandardCost", DoubleType(), True),
+  StructField("effectiveTime", TimestampType(), True)])
+
+def read_cost_changes(path, maxFilesPerTrigger=None):
+  """A stream of cost change events, from JSON files under `path`."""
+  reader = spark.readStream.schema(costChangeSchema)
+  if maxFilesPerTrigger:
+    reader = reader.option("maxFilesPerTrigger", maxFilesPerTrigger)
+  return reader.json(path)
+
+def write_sample_cost_changes(products, path, start, end, changes=200, seed=0):
+  """Write `changes` random cost changes (+/- 20%) to products in `products`, effective between `start` and `end`."""
+  picked = products.select("ProductID", "StandardCost").orderBy(F.rand(seed)).limit(changes)
+  span = F.unix_timestamp(F.lit(end)) - F.unix_timestamp(F.lit(start))
+  (picked
+    .select("ProductID",
+            F.round(F.col("StandardCost") * (0.8 + 0.4 * F.rand(seed + 1)), 4).alias("StandardCost"),
+            (F.unix_timestamp(F.lit(start)) + F.floor(F.rand(seed + 2) * span)).cast("timestamp").alias("effectiveTime"))
+    .orderBy("effectiveTime")
+    .repartition(8)
+    .write.mode("overwrite").json(path))
+
+# COMMAND ----------
+
+import numpy as np
+import pandas as pd
+
+def _state_values(series, kind):
+  """`series` as a list of plain Python values for an array column of the state."""
+  values = series.astype(object).where(series.notna(), None).tolist()
+  if kind == "int":
+    return [None if v is None else int(v) for v in values]
+  if kind == "float":
+    return [None if v is None else float(v) for v in values]
+  if kind == "timestamp":
+    return [None if v is None else pd.Timestamp(v).to_pydatetime() for v in values]
+  return values
+
+def _as_of_step(orderColumns, columnKinds, timeMsColumn, costDelayMs):
+  """
+  The per-product step. Its state is (costTimes, costs, one array per order column, the orders' times in ms).
+  `columnKinds` names each order column's kind ("int", "float", "timestamp" or "other") for writing it back to the state.
+  """
+  pendingColumns = orderColumns + [timeMsColumn]
+  kinds = columnKinds + ["int"]
+
+  def step(key, batches, state):
+    if state.exists:
+      values = state.get
+      costTimes, costs = np.array(values[0], dtype=np.int64), np.array(values[1], dtype=np.float64)
+      pending = pd.DataFrame({c: list(v) for c, v in zip(pendingColumns, values[2:])}, columns=pendingColumns)
+    else:
+      costTimes, costs = np.empty(0, dtype=np.int64), np.empty(0)
+      pending = pd.DataFrame(columns=pendingColumns)
+
+    for pdf in batches:
+      isCost = pdf["_costMs"].notna().values
+      # Appending keeps arrival order, and the stable sort below keeps it among equal times: the later change wins
+      costTimes = np.concatenate([costTimes, pdf["_costMs"].values[isCost].astype(np.int64)])
+      costs = np.concatenate([costs, pdf["_cost"].values[isCost].astype(np.float64)])
+      orders = pdf.loc[~isCost, pendingColumns]
+      pending = orders if not len(pending) else pd.concat([pending, orders], ignore_index=True)
+
+    order = np.argsort(costTimes, kind="stable")
+    costTimes, costs = costTimes[order], costs[order]
+    watermark = state.getCurrentWatermarkMs()
+
+    out = None
+    if len(pending):
+      orderMs = pending[timeMsColumn].values.astype(np.int64)
+      ready = orderMs + costDelayMs <= watermark
+      if ready.any():
+        out = pending.loc[ready, orderColumns].reset_index(drop=True)
+        if len(costs):
+          idx = np.searchsorted(costTimes, orderMs[ready], side="right") - 1
+          found, idx = idx >= 0, np.maximum(idx, 0)
+          out["StandardCost"] = np.where(found, costs[idx], np.nan)
+          out["costEffectiveMs"] = pd.Series(costTimes[idx], dtype="Int64").where(found)
+        else:
+          out["StandardCost"] = np.nan
+          out["costEffectiveMs"] = pd.Series([pd.NA] * len(out), dtype="Int64")
+        pending = pending.loc[~ready].reset_index(drop=True)
+
+    # Keep the change in effect for the oldest order that can still be waiting, and everything after it
+    keepFrom = int(np.maximum(np.searchsorted(costTimes, watermark - costDelayMs, side="right") - 1, 0))
+    costTimes, costs = costTimes[keepFrom:], costs[keepFrom:]
+
+    if len(pending) or len(costTimes):
+      state.update(tuple([costTimes.tolist(), costs.tolist()] +
+                         [_state_values(pending[c], kind) for c, kind in zip(pendingColumns, kinds)]))
+      if len(pending):
+        state.setTimeoutTimestamp(int(pending[timeMsColumn].astype(np.int64).min()) + costDelayMs)
+    else:
+      state.remove()
+
+    if out is not None:
+      yield out
+  return step
+
+# COMMAND ----------
+
+_intervalUnitMs = {"millisecond": 1, "second": 1000, "minute": 60 * 1000, "hour": 60 * 60 * 1000, "day": 24 * 60 * 60 * 1000}
+
+def _interval_ms(interval):
+  """Milliseconds in an interval written like a watermark delay, e.g. "10 minutes"."""
+  amount, unit = interval.split()
+  return int(float(amount) * _intervalUnitMs[unit.lower().rstrip("s")])
+
+def _column_kind(dataType):
+  if isinstance(dataType, (IntegerType, LongType, ShortType)):
+    return "int"
+  if isinstance(dataType, (DoubleType, FloatType)):
+    return "float"
+  if isinstance(dataType, TimestampType):
+    return "timestamp"
+  return "other"
+
+class CostAsOfJoin(object):
+
+  def __init__(self, orderWatermark="10 minutes", costDelay="10 minutes", orderKey="productId",
+               timeColumn="orderTimestamp"):
+    """Pass `orderWatermark=None` if the orders stream already has a watermark on `timeColumn`."""
+    self.orderWatermark = orderWatermark
+    self.costDelay = costDelay
+    self.orderKey = orderKey
+    self.timeColumn = timeColumn
+
+  def join(self, orders, costChanges, snapshot=None):
+    """
+    `orders` with `StandardCost` (the cost in effect at `timeColumn`) and `costEffectiveTime`.
+    With `snapshot` (ProductID, StandardCost, ..) its other columns are joined on too, and its cost fills in for orders
+    placed before any change the stream has seen.
+    """
+    # An order without a timestamp has no cost in effect, and the watermark can never release it
+    orders = orders.where(F.col(self.timeColumn).isNotNull())
+    if self.orderWatermark:
+      orders = orders.withWatermark(self.timeColumn, self.orderWatermark)
+    # No watermark on the cost changes: the orders' watermark alone decides when an order is released
+    costChanges = costChanges.where(F.col("ProductID").isNotNull() & F.col("effectiveTime").isNotNull())
+    orderColumns = [c for c in orders.columns if c not in ("StandardCost", "costEffectiveMs")]
+
+    # One stream, one row shape: orders leave the cost columns empty, cost changes leave the order columns empty
+    key = "_product"
+    unionColumns = [F.col(c) for c in orderColumns]
+    ordersSide = orders.select(F.col(self.orderKey).alias(key), *unionColumns,
+      (F.col(self.timeColumn).cast("double") * 1000).cast("long").alias("_timeMs"),
+      F.lit(None).cast("double").alias("_cost"), F.lit(None).cast("long").alias("_costMs"))
+    costSide = costChanges.select(F.col("ProductID").alias(key),
+      *[F.lit(None).cast(orders.schema[c].dataType).alias(c) for c in orderColumns],
+      F.lit(None).cast("long").alias("_timeMs"),
+      F.col("StandardCost").alias("_cost"), (F.col("effectiveTime").cast("double") * 1000).cast("long").alias("_costMs"))
+
+    outputSchema = StructType([orders.schema[c] for c in orderColumns] + [
+      StructField("StandardCost", DoubleType(), True), StructField("costEffectiveMs", LongType(), True)])
+    stateSchema = StructType(
+      [StructField("costTimes", ArrayType(LongType())), StructField("costs", ArrayType(DoubleType()))] +
+      [StructField("pending_" + c, ArrayType(orders.schema[c].dataType)) for c in orderColumns] +
+      [StructField("pending_timeMs", ArrayType(LongType()))])
+    columnKinds = [_column_kind(orders.schema[c].dataType) for c in orderColumns]
+
+    joined = (ordersSide.unionByName(costSide)
+      .groupBy(key)
+      .applyInPandasWithState(_as_of_step(orderColumns, columnKinds, "_timeMs", _interval_ms(self.costDelay)),
+                              outputSchema, stateSchema, "append", GroupStateTimeout.EventTimeTimeout)
+      .withColumn("costEffectiveTime", (F.col("costEffectiveMs") / 1000).cast("timestamp"))
+      .drop("costEffectiveMs"))
+
+    if snapshot is None:
+      return joined
+    # Renamed so the join key can't be confused with the orders' productId: column names resolve case-insensitively
+    snapshot = snapshot.withColumnRenamed("ProductID", "_snapshotProductID").withColumnRenamed("StandardCost", "_snapshotCost")
+    return (joined.join(F.broadcast(snapshot), F.col(self.orderKey) == F.col("_snapshotProductID"))
+      .withColumn("StandardCost", F.coalesce(F.col("StandardCost"), F.col("_snapshotCost")))
+      .drop("_snapshotProductID", "_snapshotCost"))
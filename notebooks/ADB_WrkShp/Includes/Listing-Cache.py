@@ -0,0 +1,91 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC # Listing Cache
+# MAGIC 
+# MAGIC Listing a blob container directory is slow when it holds hundreds of thousands of files. `%fs ls` lists it again every time, and so does every trigger of a `readStream` over `part-*`.
+# MAGIC 
+# MAGIC `ListingCache` keeps directory listings for `ttlSeconds`:
+# MAGIC * `ls(path, pattern=None, recursive=False)` returns the cached `FileInfo`s, relisting once the entry is older than the TTL. A recursive listing lists each level's subdirectories `parallelism` at a time,
+# MAGIC * `invalidate(path)` drops the cached entries under `path` after a write.
+# MAGIC 
+# MAGIC A file stream does its own listing, which a cache can't replace. `read_files_stream(..)` uses Auto Loader (`cloudFiles`) with incremental listing instead: each trigger lists only the files that sort after the last one it found. That works because the part files are named in arrival order. Where Auto Loader isn't available, it falls back to the plain file source.
+# MAGIC 
+# MAGIC A checkpoint records which source the query read from. A query that used to read `spark.readStream.csv(..)` can't be restarted on its old checkpoint once it reads through `read_files_stream`, so give it a new checkpoint, and a new output path too if it writes to a file sink, whose log is tied to the checkpoint's batch numbers.
+# MAGIC 
+# MAGIC Use it from another notebook with `%run ./Includes/Listing-Cache`
+
+# COMMAND ----------
+
+import fnmatch
+import itertools
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+class ListingCache(object):
+
+  def __init__(self, ttlSeconds=60, parallelism=16):
+    self.ttlSeconds = ttlSeconds
+    self.parallelism = parallelism
+    self.entries = {}
+    self.lock = threading.Lock()
+
+  def _list(self, path, recursive):
+    if not recursive:
+      return dbutils.fs.ls(path)
+    files, level = [], [path]
+    pool = ThreadPool(self.parallelism)
+    try:
+      while level:
+        listings = pool.map(dbutils.fs.ls, level)
+        level = []
+        for info in itertools.chain(*listings):
+          if info.name.endswith("/"):
+            level.append(info.path)
+          else:
+            files.append(info)
+    finally:
+      pool.close()
+    return files
+
+  def ls(self, path, pattern=None, recursive=False, refresh=False):
+    """The entries under `path`, from cache if listed less than `ttlSeconds` ago, filtered by a glob `pattern` on the name."""
+    key = (path.rstrip("/"), recursive)
+    with self.lock:
+      entry = self.entries.get(key)
+    if refresh or entry is None or time.time() - entry[0] > self.ttlSeconds:
+      entry = (time.time(), self._list(path, recursive))
+      with self.lock:
+        self.entries[key] = entry
+    return [f for f in entry[1] if pattern is None or fnmatch.fnmatch(f.name, pattern)]
+
+  def invalidate(self, path=None):
+    with self.lock:
+      for key in list(self.entries):
+        if path is None or key[0].startswith(path.rstrip("/")):
+          del self.entries[key]
+
+listingCache = ListingCache()
+
+# COMMAND ----------
+
+def read_files_stream(path, schema, format="csv", pattern=None, maxFilesPerTrigger=None):
+  """A file stream over `path` that lists only new files each trigger, with Auto Loader where it is available."""
+  try:
+    reader = (spark.readStream
+      .format("cloudFiles")
+      .option("cloudFiles.format", format)
+      .option("cloudFiles.useIncrementalListing", "true")
+      .schema(schema))
+    if maxFilesPerTrigger:
+      reader = reader.option("cloudFiles.maxFilesPerTrigger", maxFilesPerTrigger)
+    if pattern:
+      reader = reader.option("pathGlobFilter", pattern)
+    return reader.load(path)
+  except Exception as e:
+    if "cloudFiles" not in str(e):
+      raise
+  reader = spark.readStream.format(format).schema(schema)
+  if maxFilesPerTrigger:
+    reader = reader.option("maxFilesPerTrigger", maxFilesPerTrigger)
+  return reader.load(path.rstrip("/") + "/" + (pattern or "*"))
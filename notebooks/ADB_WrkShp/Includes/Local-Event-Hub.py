@@ -0,0 +1,77 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC # Local Event Hub
+# MAGIC 
+# MAGIC A stand-in for `spark.readStream.format("eventhubs")` so the order pipeline can be load tested without a live namespace.
+# MAGIC 
+# MAGIC `read_local_event_hub(..)` returns the same columns as the Event Hubs source (`body`, `offset`, `sequenceNumber`, `enqueuedTime`, `publisher`, `partitionKey`, `partition`), so anything built on `inputStream` runs unchanged. The source is one of:
+# MAGIC * **generator** (default): Spark's `rate` source produces `eventsPerSecond` events spread over `partitions` partitions, and each `body` is a random order as JSON,
+# MAGIC * **files**: JSON files under `path` in the same layout, e.g. captured from the real hub or written by `write_event_files(..)`, read `maxFilesPerTrigger` at a time.
+# MAGIC 
+# MAGIC Use it from another notebook with `%run ./Includes/Local-Event-Hub`
+
+# COMMAND ----------
+
+from pyspark.sql import functions as F
+from pyspark.sql.types import BinaryType, LongType, StringType, StructField, StructType, TimestampType
+
+eventHubSchema = StructType([
+  StructField("body", BinaryType(), True),
+  StructField("offset", StringType(), True),
+  StructField("sequenceNumber", LongType(), True),
+  StructField("enqueuedTime", TimestampType(), True),
+  StructField("publisher", StringType(), True),
+  StructField("partitionKey", StringType(), True),
+  StructField("partition", StringType(), True)])
+
+def _order_body(timestamp, firstProductId, products, users):
+  order = F.struct(
+    F.expr("uuid()").alias("orderUUID"),
+    (F.lit(firstProductId) + F.floor(F.rand() * products)).cast("int").alias("productId"),
+    (F.floor(F.rand() * users) + 1).cast("int").alias("userId"),
+    (F.floor(F.rand() * 5) + 1).cast("int").alias("quantity"),
+    F.round(F.rand() * 0.3, 2).alias("discount"),
+    timestamp.alias("orderTimestamp"))
+  return F.to_json(order).cast("binary")
+
+# COMMAND ----------
+
+def read_local_event_hub(partitions=2, eventsPerSecond=1000, path=None, maxFilesPerTrigger=None,
+                         firstProductId=680, products=300, users=50000):
+  """A streaming DataFrame shaped like the `eventhubs` source, fed by a generator or by files under `path`."""
+  if path:
+    reader = spark.readStream.schema(eventHubSchema)
+    if maxFilesPerTrigger:
+      reader = reader.option("maxFilesPerTrigger", maxFilesPerTrigger)
+    return reader.json(path)
+
+  rate = (spark.readStream
+    .format("rate")
+    .option("rowsPerSecond", eventsPerSecond)
+    .option("numPartitions", partitions)
+    .load())
+  partition = (F.col("value") % partitions)
+  sequence = F.floor(F.col("value") / partitions).cast("long")
+  return rate.select(
+    _order_body(F.col("timestamp"), firstProductId, products, users).alias("body"),
+    sequence.cast("string").alias("offset"),
+    sequence.alias("sequenceNumber"),
+    F.col("timestamp").alias("enqueuedTime"),
+    F.lit(None).cast("string").alias("publisher"),
+    F.lit(None).cast("string").alias("partitionKey"),
+    partition.cast("string").alias("partition"))
+
+def write_event_files(ordersDF, path, partitions=2, eventsPerFile=10000):
+  """Wrap a static orders DataFrame as Event Hubs records and write them as JSON files for the file-backed mode."""
+  numbered = ordersDF.withColumn("_n", F.monotonically_increasing_id())
+  partition = (F.col("_n") % partitions)
+  events = numbered.select(
+    F.to_json(F.struct(*[F.col(c) for c in ordersDF.columns])).cast("binary").alias("body"),
+    F.col("_n").cast("string").alias("offset"),
+    F.col("_n").alias("sequenceNumber"),
+    F.current_timestamp().alias("enqueuedTime"),
+    F.lit(None).cast("string").alias("publisher"),
+    F.lit(None).cast("string").alias("partitionKey"),
+    partition.cast("string").alias("partition"))
+  numFiles = int(ordersDF.count() // eventsPerFile) + 1
+  events.repartition(numFiles).write.mode("overwrite").json(path)
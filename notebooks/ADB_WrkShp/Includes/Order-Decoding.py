@@ -0,0 +1,106 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC # Order Decoding
+# MAGIC 
+# MAGIC `from_json(body.cast("string"), schema)` turns a malformed event into a row of nulls. Those rows then flow into the joins and revenue totals without anyone noticing.
+# MAGIC 
+# MAGIC `OrderDecoder` parses bodies in `PERMISSIVE` mode with a corrupt-record column. An order counts as valid only if it parsed and has its required fields (`orderUUID`, `productId`, `quantity`, `orderTimestamp`):
+# MAGIC * `decode(stream)` returns the valid orders only, with the same columns as before. It is for queries that only look at orders, like the lab's displays and aggregates,
+# MAGIC * `start(stream, checkpointLocation, writeOrders)` is for the query that keeps every event. Each batch is read and parsed once, then routed: the invalid events are appended to `quarantinePath`, with their raw body, partition, offset and sequence number, so they can be replayed, and the valid orders, as `decode` returns them, go to `writeOrders(ordersDF, batchId)`. For each batch it also records the row count, the invalid count, and the time spent reading the batch and parsing it in `statsPath`.
+# MAGIC 
+# MAGIC `from_json` only takes strings, so the binary body is still cast. The cast wraps the bytes rather than copying them.
+# MAGIC 
+# MAGIC Use it from another notebook with `%run ./Includes/Order-Decoding`
+
+# COMMAND ----------
+
+import time
+
+from pyspark.sql.functions import col, from_json
+from pyspark.sql.types import StringType, StructField, StructType
+
+class OrderDecoder(object):
+
+  required = ["orderUUID", "productId", "quantity", "orderTimestamp"]
+  quarantineSchema = ("body string, malformed boolean, partition string, offset string, sequenceNumber long, "
+                      "enqueuedTime timestamp, batchId long")
+  statsSchema = "rows long, invalidRows long, readSeconds double, parseSeconds double, batchId long"
+
+  def __init__(self, schema, quarantinePath, timestampFormat=None):
+    self.schema = schema
+    self.fields = [f.name for f in schema.fields]
+    self.quarantinePath = quarantinePath.rstrip("/") + "/data"
+    self.statsPath = quarantinePath.rstrip("/") + "/stats"
+    self.parseSchema = StructType(schema.fields + [StructField("_corrupt_record", StringType(), True)])
+    self.options = {"mode": "PERMISSIVE", "columnNameOfCorruptRecord": "_corrupt_record"}
+    if timestampFormat:
+      self.options["timestampFormat"] = timestampFormat
+
+  def _parse(self, stream):
+    valid = col("fields._corrupt_record").isNull()
+    for name in self.required:
+      valid = valid & col("fields." + name).isNotNull()
+    return (stream
+      .select(from_json(col("body").cast("string"), self.parseSchema, self.options).alias("fields"), "*")
+      .withColumn("_valid", valid))
+
+  def _orders(self, parsed):
+    return (parsed
+      .where(col("_valid"))
+      .select(*["fields." + f for f in self.fields] + [col("enqueuedTime").cast("timestamp")]))
+
+  def decode(self, stream):
+    """The valid orders in `stream`, as `fields.*` plus `enqueuedTime` cast to a timestamp."""
+    return self._orders(self._parse(stream))
+
+  def _route(self, writeOrders):
+    def route(batchDF, batchId):
+      started = time.time()
+      raw = batchDF.persist()
+      rows = raw.count()
+      fetched = time.time()
+      # Counting a persisted DataFrame materializes every column, so this is where each body gets parsed
+      parsed = self._parse(raw).persist()
+      parsed.count()
+      parsedAt = time.time()
+      try:
+        invalid = parsed.where(~col("_valid")).select(
+          col("body").cast("string").alias("body"),
+          col("fields._corrupt_record").isNotNull().alias("malformed"),
+          "partition", "offset", "sequenceNumber",
+          col("enqueuedTime").cast("timestamp").alias("enqueuedTime"))
+        invalidRows = invalid.count()
+        # Overwrite this batch's batchId= partition, so a batch replayed after a restart doesn't quarantine twice
+        invalid.write.mode("overwrite").parquet("{}/batchId={}".format(self.quarantinePath, batchId))
+        if writeOrders is not None:
+          writeOrders(self._orders(parsed), batchId)
+      finally:
+        parsed.unpersist()
+        raw.unpersist()
+
+      (spark.createDataFrame([(rows, invalidRows, fetched - started, parsedAt - fetched)],
+                             "rows long, invalidRows long, readSeconds double, parseSeconds double")
+        .coalesce(1).write.mode("overwrite").parquet("{}/batchId={}".format(self.statsPath, batchId)))
+    return route
+
+  def start(self, stream, checkpointLocation, writeOrders=None, processingTime="15 seconds"):
+    """Read and parse each batch of `stream` once: invalid events to quarantine, valid orders to `writeOrders(df, batchId)`."""
+    return (stream.writeStream
+      .foreachBatch(self._route(writeOrders))
+      .option("checkpointLocation", checkpointLocation)
+      .trigger(processingTime=processingTime)
+      .start())
+
+  @staticmethod
+  def _read(path, schema):
+    try:
+      return spark.read.schema(schema).parquet(path)
+    except Exception:
+      return spark.createDataFrame([], schema)  # nothing routed yet
+
+  def quarantined(self):
+    """The quarantined events so far. Empty until the first batch has been routed."""
+    return self._read(self.quarantinePath, self.quarantineSchema)
+
+  def stats(self):
+    return self._read(self.statsPath, self.statsSchema).orderBy("batchId")
@@ -0,0 +1,43 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC # Order Deduplication
+# MAGIC 
+# MAGIC Event Hubs delivers at least once, and a replayed part file brings its orders in again. Either way the same `orderUUID` is counted twice in the unit and revenue totals. `dropDuplicates(["orderUUID"])` on its own fixes that, but it remembers every UUID ever seen and its state grows forever.
+# MAGIC 
+# MAGIC `dedupe_orders(df)` drops repeated orders while keeping its state bounded:
+# MAGIC * orders are keyed by two 64-bit hashes of `orderUUID`, 16 fixed bytes per key instead of a 36 character string. At these volumes, two different orders getting the same 128-bit key is not a practical concern,
+# MAGIC * a key is only remembered until the `orderTimestamp` watermark passes it. A duplicate arriving later than `watermark` is not caught, and neither is any other order that late,
+# MAGIC * an order without an `orderUUID` is keyed on all of its other columns instead, so a redelivered copy is still caught, and a batch that is retried computes the same keys as the first attempt.
+# MAGIC 
+# MAGIC The result carries the watermark, so windowed aggregates downstream should be built with `watermark=None`. The number of duplicates dropped is reported per batch in the query progress (`numDroppedDuplicateRows`), and `duplicates_dropped(query)` lists it for the recent batches.
+# MAGIC 
+# MAGIC Use it from another notebook with `%run ./Includes/Order-Dedup`
+
+# COMMAND ----------
+
+# MAGIC %run ./Python-Builtins
+
+# COMMAND ----------
+
+from pyspark.sql.functions import coalesce, col, lit, struct, to_json, xxhash64
+
+def dedupe_orders(df, watermark="10 minutes", keyColumn="orderUUID", timeColumn="orderTimestamp"):
+  """`df` without repeated `keyColumn` values, remembering each key until the `timeColumn` watermark passes it."""
+  # A missing key falls back to the whole row, which is the same on every attempt at the batch
+  key = coalesce(col(keyColumn), to_json(struct(*[col(c) for c in df.columns if c != keyColumn])))
+  keyed = (df
+    .withWatermark(timeColumn, watermark)
+    .withColumn("_dedupKeyHi", xxhash64(key))
+    .withColumn("_dedupKeyLo", xxhash64(lit("order-dedup"), key)))
+  if hasattr(keyed, "dropDuplicatesWithinWatermark"):
+    deduped = keyed.dropDuplicatesWithinWatermark(["_dedupKeyHi", "_dedupKeyLo"])
+  else:
+    # Older runtimes evict by the event-time column, so it has to be part of the key. A redelivered order keeps its timestamp.
+    deduped = keyed.dropDuplicates(["_dedupKeyHi", "_dedupKeyLo", timeColumn])
+  return deduped.drop("_dedupKeyHi", "_dedupKeyLo")
+
+def duplicates_dropped(query):
+  """(batchId, numInputRows, duplicates dropped) for the batches in `query.recentProgress`."""
+  return [(p["batchId"], p["numInputRows"],
+           py_sum((op.get("customMetrics") or {}).get("numDroppedDuplicateRows", 0) for op in p["stateOperators"]))
+          for p in query.recentProgress]
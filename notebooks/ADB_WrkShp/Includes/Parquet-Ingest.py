@@ -0,0 +1,195 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC # Parquet Ingest
+# MAGIC 
+# MAGIC Converts a directory of CSV files to Parquet once, then only converts what changed on later runs.
+# MAGIC 
+# MAGIC A manifest of converted source files (path, size, modification time) is kept next to the data in `<target>/_manifest/` (Spark skips `_` directories when reading the Parquet). Each run:
+# MAGIC * appends the rows of **new** source files,
+# MAGIC * rewrites only the partitions that hold rows of **changed** or **removed** source files,
+# MAGIC * leaves everything else untouched.
+# MAGIC 
+# MAGIC Every row carries a `source_file` column so the rows of a changed file can be found again.
+# MAGIC 
+# MAGIC Use it from another notebook with `%run ./Includes/Parquet-Ingest`
+
+# COMMAND ----------
+
+# MAGIC %run ./Python-Builtins
+
+# COMMAND ----------
+
+# MAGIC %run ./Schema-Registry
+
+# COMMAND ----------
+
+from pyspark.sql.functions import col, input_file_name
+from pyspark.sql.types import LongType, StringType, StructField, StructType
+
+manifestSchema = StructType([
+  StructField("path", StringType(), False),
+  StructField("size", LongType(), False),
+  StructField("modificationTime", LongType(), False)])
+
+def _manifest_dir(target):
+  return target.rstrip("/") + "/_manifest"
+
+def _path_exists(path):
+  try:
+    dbutils.fs.ls(path)
+    return True
+  except Exception:
+    return False
+
+def load_manifest(target):
+  """Return {source path: (size, modificationTime)} for every file already converted into `target`."""
+  if not _path_exists(_manifest_dir(target)):
+    return {}
+  rows = spark.read.schema(manifestSchema).json(_manifest_dir(target)).collect()
+  return {r.path: (r.size, r.modificationTime) for r in rows}
+
+def _save_manifest(target, manifest):
+  rows = [(path, size, mtime) for path, (size, mtime) in manifest.items()]
+  (spark.createDataFrame(rows, manifestSchema)
+    .coalesce(1)
+    .write.mode("overwrite")
+    .json(_manifest_dir(target)))
+
+# COMMAND ----------
+
+def _read_sources(paths, schema, header):
+  return (spark.read
+    .option("header", str(header).lower())
+    .schema(schema)
+    .csv(paths)
+    .withColumn("source_file", input_file_name()))
+
+def _write(df, target, mode, partitionBy, sortBy, targetFileBytes):
+  if targetFileBytes:
+    write_layout(df, target, partitionBy, sortBy, targetFileBytes, mode)
+  else:
+    df.write.mode(mode).partitionBy(*partitionBy).parquet(target)
+
+def _rewrite_partitions(target, stale, changedDF, partitionBy, sortBy, targetFileBytes):
+  """Replace the rows of the `stale` source files in `target` with `changedDF`, touching only the affected partitions."""
+  existing = spark.read.parquet(target)
+  staleRows = existing.where(col("source_file").isin(stale))
+
+  if partitionBy:
+    affected = staleRows.select(*partitionBy).union(changedDF.select(*partitionBy)).distinct()
+    keep = existing.join(affected, partitionBy, "left_semi")
+  else:
+    keep = existing
+  rewritten = keep.where(~col("source_file").isin(stale)).unionByName(changedDF)
+
+  # We can't overwrite the files we are reading from, so stage the new partitions first
+  staging = target.rstrip("/") + "_staging"
+  _write(rewritten, staging, "overwrite", partitionBy, sortBy, targetFileBytes)
+
+  # Dynamic overwrite replaces only the partitions present in the staged data, and only once they are written.
+  # The staged files are already target-sized and sorted, and reading them back keeps them about as they are.
+  previousMode = spark.conf.get("spark.sql.sources.partitionOverwriteMode", "static")
+  spark.conf.set("spark.sql.sources.partitionOverwriteMode", "dynamic")
+  try:
+    (spark.read.parquet(staging)
+      .select(*existing.columns)
+      .write.mode("overwrite")
+      .partitionBy(*partitionBy)
+      .parquet(target))
+  finally:
+    spark.conf.set("spark.sql.sources.partitionOverwriteMode", previousMode)
+    dbutils.fs.rm(staging, True)
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Layout
+# MAGIC 
+# MAGIC `write_layout(..)` controls the file layout instead of taking whatever the input partitions happen to be:
+# MAGIC * `partitionBy` columns become directories, so `WHERE category = ...` skips every other directory.
+# MAGIC * Rows are range-partitioned and sorted on `partitionBy + sortBy`, so each file (and each row group in it) covers a narrow `sortBy` range and its min/max statistics let readers skip it.
+# MAGIC * The number of files is derived from `targetFileBytes`, so files come out about the same size instead of thousands of tiny ones.
+
+# COMMAND ----------
+
+import math
+import uuid
+
+def estimate_parquet_bytes_per_row(df, sampleRows=100000):
+  """Write a sample of `df` to Parquet and measure how many bytes a row takes once encoded and compressed."""
+  # One directory per call, so concurrent runs don't measure each other's files
+  scratch = "dbfs:/tmp/training-msft/layout-sample/{}/".format(uuid.uuid4().hex)
+  try:
+    df.limit(sampleRows).coalesce(1).write.parquet(scratch)
+    rows = spark.read.parquet(scratch).count()  # from the footers, without reading the sample again
+    if rows == 0:
+      return 1.0
+    size = py_sum(f.size for f in list_data_files(scratch))
+    return py_max(1.0, float(size) / rows)
+  finally:
+    dbutils.fs.rm(scratch, True)
+
+def write_layout(df, target, partitionBy=(), sortBy=(), targetFileBytes=128 * 1024 * 1024, mode="overwrite"):
+  """Write `df` as Parquet partitioned by `partitionBy`, sorted by `sortBy`, in files of roughly `targetFileBytes`."""
+  partitionBy, sortBy = list(partitionBy), list(sortBy)
+  # Sampling, counting and writing would each parse the source again
+  df = df.persist()
+  try:
+    rowsPerFile = py_max(1, int(targetFileBytes / estimate_parquet_bytes_per_row(df)))
+    numFiles = py_max(1, int(math.ceil(df.count() / float(rowsPerFile))))
+    keys = partitionBy + sortBy
+
+    if keys:
+      laidOut = df.repartitionByRange(numFiles, *keys).sortWithinPartitions(*keys)
+    else:
+      laidOut = df.repartition(numFiles)
+
+    (laidOut.write
+      .mode(mode)
+      .option("maxRecordsPerFile", rowsPerFile)                              # never more than one target-sized file per task
+      .option("parquet.block.size", py_min(targetFileBytes, 128 * 1024 * 1024)) # row group size
+      .partitionBy(*partitionBy)
+      .parquet(target))
+  finally:
+    df.unpersist()
+
+# COMMAND ----------
+
+def ingest_csv(source, target, schema, partitionBy=(), header=True, sortBy=(), targetFileBytes=None):
+  """
+  Bring the Parquet copy of the CSV files under `source` up to date and return the number of source files converted.
+
+  With `targetFileBytes` set, files are written through `write_layout(..)` and new files are merged into the
+  partitions they land in rather than appended as extra small files.
+  """
+  partitionBy, sortBy = list(partitionBy), list(sortBy)
+  current = {f.path: (f.size, getattr(f, "modificationTime", 0)) for f in list_data_files(source)}
+  manifest = load_manifest(target)
+  targetExists = bool(manifest) or _path_exists(target)
+
+  new = [p for p in current if p not in manifest]
+  changed = [p for p in current if p in manifest and manifest[p] != current[p]]
+  removed = [p for p in manifest if p not in current]
+
+  if new and targetExists:
+    # A run that died after writing data but before saving the manifest leaves rows behind - treat those files as changed
+    landed = {r.source_file for r in spark.read.parquet(target)
+                .where(col("source_file").isin(new)).select("source_file").distinct().collect()}
+    changed += [p for p in new if p in landed]
+    new = [p for p in new if p not in landed]
+
+  if not targetExists:
+    if new:
+      _write(_read_sources(new, schema, header), target, "overwrite", partitionBy, sortBy, targetFileBytes)
+  else:
+    merged = changed + new if targetFileBytes else changed
+    appended = [] if targetFileBytes else new
+    if merged or removed:
+      changedDF = _read_sources(merged, schema, header) if merged else spark.read.parquet(target).limit(0)
+      _rewrite_partitions(target, changed + removed, changedDF, partitionBy, sortBy, targetFileBytes)
+    if appended:
+      _write(_read_sources(appended, schema, header), target, "append", partitionBy, sortBy, targetFileBytes)
+
+  if new or changed or removed:
+    _save_manifest(target, current)
+  return len(new) + len(changed)
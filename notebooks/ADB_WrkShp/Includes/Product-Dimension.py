@@ -0,0 +1,67 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC # Product Dimension
+# MAGIC 
+# MAGIC A stream-static join re-plans the static side in every micro-batch, so `spark.read.parquet(".../productsFull/")` is listed and scanned again for each batch.
+# MAGIC 
+# MAGIC `ProductDimension` keeps the lookup small and in memory instead:
+# MAGIC * only the columns the order pipeline needs (`ProductID`, `Name`, `StandardCost`) are read,
+# MAGIC * the result is cached, so each batch reads the cache rather than the files,
+# MAGIC * `broadcast()` marks it for a broadcast hash join instead of leaving that to the optimizer,
+# MAGIC * every `refreshSeconds` a background check compares the directory listing and reloads the cache only if the files changed.
+# MAGIC 
+# MAGIC Use it from another notebook with `%run ./Includes/Product-Dimension`
+
+# COMMAND ----------
+
+# MAGIC %run ./Schema-Registry
+
+# COMMAND ----------
+
+import threading
+import time
+
+from pyspark.sql.functions import broadcast
+
+class ProductDimension(object):
+
+  def __init__(self, path, columns=("ProductID", "Name", "StandardCost"), refreshSeconds=300):
+    self.path = path
+    self.columns = list(columns)
+    self.refreshSeconds = refreshSeconds
+    self.df = spark.read.parquet(path).select(*self.columns).cache()
+    self._load()
+    self._stopped = threading.Event()
+    if refreshSeconds:
+      self._thread = threading.Thread(target=self._watch, name="product-dimension-refresh")
+      self._thread.daemon = True
+      self._thread.start()
+
+  def _load(self):
+    self.fingerprint = listing_fingerprint(self.path)
+    self.rows = self.df.count()  # materialize the cache now, not in the first micro-batch
+    self.loadedAt = time.time()
+
+  def refresh(self, force=False):
+    """Reload the cached dimension if the files under `path` changed. Returns True if it was reloaded."""
+    if not force and listing_fingerprint(self.path) == self.fingerprint:
+      return False
+    # Re-lists the directory and re-caches every cached plan reading it, including the one running queries join against
+    spark.catalog.refreshByPath(self.path)
+    self._load()
+    return True
+
+  def _watch(self):
+    while not self._stopped.wait(self.refreshSeconds):
+      try:
+        self.refresh()
+      except Exception as e:
+        print("product dimension refresh failed: {}".format(e))
+
+  def broadcast(self):
+    """The cached dimension, marked for a broadcast hash join."""
+    return broadcast(self.df)
+
+  def stop(self):
+    self._stopped.set()
+    self.df.unpersist()
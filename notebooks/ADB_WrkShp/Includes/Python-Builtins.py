@@ -0,0 +1,20 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC # Python Builtins
+# MAGIC 
+# MAGIC The notebooks `from pyspark.sql.functions import *`, and `%run` executes every Include in the notebook's own namespace. After that import, `sum`, `min`, `max`, `abs` and `round` are the Spark column functions, not Python's, in the notebook and in every Include it runs, whichever order they run in.
+# MAGIC 
+# MAGIC Code that needs Python's versions uses these aliases instead, which the star-import can't shadow:
+# MAGIC * `py_sum`, `py_min`, `py_max`, `py_abs` and `py_round`.
+# MAGIC 
+# MAGIC Use it from another notebook with `%run ./Includes/Python-Builtins`
+
+# COMMAND ----------
+
+import builtins
+
+py_sum = builtins.sum
+py_min = builtins.min
+py_max = builtins.max
+py_abs = builtins.abs
+py_round = builtins.round
@@ -0,0 +1,93 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC # Schema Registry
+# MAGIC 
+# MAGIC `inferSchema` makes Spark read every CSV file once just to work out the column types, before any real work happens.
+# MAGIC 
+# MAGIC This notebook keeps the inferred `StructType` as JSON under `registryDir`, keyed by the source path and a fingerprint of its file listing (names, sizes, modification times).
+# MAGIC * On the first run the schema is inferred and stored.
+# MAGIC * On later runs the stored schema is handed straight to `spark.read.schema(...)`.
+# MAGIC * If a file is added, removed or rewritten the fingerprint changes and the schema is inferred again.
+# MAGIC 
+# MAGIC Use it from another notebook with `%run ./Includes/Schema-Registry`
+
+# COMMAND ----------
+
+import hashlib
+import json
+
+from pyspark.sql.types import StructType
+
+registryDir = "dbfs:/tmp/training-msft/schema-registry/"
+
+# COMMAND ----------
+
+def list_data_files(path):
+  """Recursively list the data files under `path`, skipping the `_`/`.` files Spark ignores."""
+  files = []
+  for f in dbutils.fs.ls(path):
+    if f.name.startswith("_") or f.name.startswith("."):
+      continue
+    if f.name.endswith("/"):
+      files.extend(list_data_files(f.path))
+    else:
+      files.append(f)
+  return files
+
+def listing_fingerprint(path):
+  """Hash of the name, size and modification time of every data file under `path`."""
+  digest = hashlib.sha256()
+  for f in sorted(list_data_files(path), key=lambda f: f.path):
+    # modificationTime is only reported by newer runtimes, size still catches most rewrites
+    digest.update("{}|{}|{}\n".format(f.path, f.size, getattr(f, "modificationTime", 0)).encode("utf-8"))
+  return digest.hexdigest()
+
+def _registry_entry(path):
+  key = hashlib.sha1(path.rstrip("/").encode("utf-8")).hexdigest()
+  return registryDir.rstrip("/") + "/" + key + ".json"
+
+# COMMAND ----------
+
+def cached_schema(path, header=True, refresh=False):
+  """Return the schema of the CSV data under `path`, inferring it only when the file listing has changed."""
+  entry = _registry_entry(path)
+  fingerprint = listing_fingerprint(path)
+
+  if not refresh:
+    try:
+      stored = json.loads(dbutils.fs.head(entry, 1024 * 1024))
+      if stored["fingerprint"] == fingerprint:
+        return StructType.fromJson(stored["schema"])
+    except Exception:
+      pass  # no entry yet, or an unreadable one - infer below
+
+  schema = (spark.read
+    .option("header", str(header).lower())
+    .option("inferSchema", "true")
+    .csv(path)
+    .schema)
+
+  dbutils.fs.put(entry, json.dumps({
+    "path": path,
+    "fingerprint": fingerprint,
+    "schema": schema.jsonValue()
+  }), True)
+  return schema
+
+# COMMAND ----------
+
+def _type_source(dataType):
+  # older runtimes repr atomic types as "LongType" rather than "LongType()"
+  source = repr(dataType)
+  return source if source.endswith(")") else source + "()"
+
+def schema_source(schema, name="csvSchema"):
+  """Render `schema` as the Python `StructType([...])` declaration you would otherwise write by hand."""
+  fields = ",\n".join(
+    '  StructField("{}", {}, {})'.format(f.name, _type_source(f.dataType), f.nullable) for f in schema.fields)
+  return "{} = StructType([\n{}\n ])".format(name, fields)
+
+def schema_ddl(schema):
+  """Render `schema` as a SQL column list, e.g. for `CREATE TABLE ... (<ddl>) USING CSV`."""
+  # CSV headers can hold spaces, dashes or reserved words, so every name is quoted
+  return ", ".join("`{}` {}".format(f.name.replace("`", "``"), f.dataType.simpleString()) for f in schema.fields)
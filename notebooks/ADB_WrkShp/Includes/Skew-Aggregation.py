@@ -0,0 +1,80 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC # Skew-Aware Aggregation
+# MAGIC 
+# MAGIC A streaming `groupBy("productId")` sends every order for a product to the same task for the final merge and the state store update. When a few products get most of the orders, as in a flash sale, that one task sets the batch time.
+# MAGIC 
+# MAGIC `SkewAwareTotals` keeps running per-key sums with a `foreachBatch` step instead:
+# MAGIC * each batch is summed per key with a plain batch `groupBy`. Spark's partial aggregation adds up a hot key's rows inside every task before the shuffle, so however many orders a product gets, each task sends on one row for it,
+# MAGIC * the batch's per-key totals are then merged into a Delta table at `path/table`, which only touches the keys that had orders in the batch. There is no state store, so no one task has to hold and update a hot key's state on every trigger. A key's row remembers the last batch added to it, so a batch replayed after a restart is not added twice, and the merge is a single commit, so readers never see half a batch.
+# MAGIC 
+# MAGIC Without Delta, as in a local run of `tools/notebook_bench.py`, each batch's totals are written to their own `batchId=` directory instead, which a replayed batch replaces, and `current()` adds them up when it is read.
+# MAGIC 
+# MAGIC Use it from another notebook with `%run ./Includes/Skew-Aggregation`
+
+# COMMAND ----------
+
+# MAGIC %run ./Compacting-Sink
+
+# COMMAND ----------
+
+from pyspark.sql.functions import col, lit
+from pyspark.sql.functions import sum as sum_
+
+class SkewAwareTotals(object):
+
+  def __init__(self, key, value, alias, path):
+    """Running sums of `value` (a column or expression) per `key`, as `alias`."""
+    self.key = key
+    self.value = value
+    self.alias = alias
+    self.tablePath = path.rstrip("/") + "/table"
+    self.delta = delta_available()
+
+  def batch_totals(self, batchDF):
+    """(key, total) for one batch."""
+    return batchDF.groupBy(self.key).agg(sum_(self.value).alias("total"))
+
+  def _merge(self, totals, batchId):
+    from delta.tables import DeltaTable
+    updates = totals.select(self.key, col("total").cast("double").alias(self.alias), lit(batchId).alias("batchId"))
+    if not DeltaTable.isDeltaTable(spark, self.tablePath):
+      updates.write.format("delta").save(self.tablePath)
+      return
+    (DeltaTable.forPath(spark, self.tablePath).alias("t")
+      .merge(updates.alias("s"), "t.`{0}` = s.`{0}`".format(self.key))
+      .whenMatchedUpdate(condition="t.batchId < s.batchId",
+                         set={self.alias: "t.`{0}` + s.`{0}`".format(self.alias), "batchId": "s.batchId"})
+      .whenNotMatchedInsertAll()
+      .execute())
+
+  def _write_batch(self, totals, batchId):
+    previousMode = spark.conf.get("spark.sql.sources.partitionOverwriteMode", "static")
+    spark.conf.set("spark.sql.sources.partitionOverwriteMode", "dynamic")
+    try:
+      (totals.select(self.key, col("total").cast("double").alias(self.alias), lit(batchId).alias("batchId"))
+        .write.mode("overwrite").partitionBy("batchId").parquet(self.tablePath))
+    finally:
+      spark.conf.set("spark.sql.sources.partitionOverwriteMode", previousMode)
+
+  def _process(self, batchDF, batchId):
+    totals = self.batch_totals(batchDF)
+    if self.delta:
+      self._merge(totals, batchId)
+    else:
+      self._write_batch(totals, batchId)
+
+  def start(self, df, checkpointLocation, processingTime="15 seconds"):
+    return (df.writeStream
+      .foreachBatch(self._process)
+      .option("checkpointLocation", checkpointLocation)
+      .trigger(processingTime=processingTime)
+      .start())
+
+  def current(self):
+    """The running totals as a DataFrame of `key` and `alias`, largest first."""
+    if self.delta:
+      totals = spark.read.format("delta").load(self.tablePath).select(self.key, self.alias)
+    else:
+      totals = spark.read.parquet(self.tablePath).groupBy(self.key).agg(sum_(self.alias).alias(self.alias))
+    return totals.orderBy(col(self.alias).desc())
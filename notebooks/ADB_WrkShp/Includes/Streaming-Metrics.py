@@ -0,0 +1,141 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC # Streaming Metrics
+# MAGIC 
+# MAGIC The progress of a streaming query is only shown in the notebook UI and in `recentProgress`, which keeps the last hundred or so batches and is gone after a restart.
+# MAGIC 
+# MAGIC `install_progress_exporter(path)` registers a `StreamingQueryListener` that records every progress event of every query on the cluster:
+# MAGIC * input and processed rows per second, and the input row count,
+# MAGIC * the duration of each phase (`latestOffset`, `getBatch`, `queryPlanning`, `addBatch`, `walCommit`, `commitOffsets`, `triggerExecution`),
+# MAGIC * state store rows, updated rows, memory used, rows dropped by the watermark and duplicates dropped by deduplication, summed over the stateful operators,
+# MAGIC * the watermark and how far it lags behind the batch time.
+# MAGIC 
+# MAGIC Records are buffered and flushed every `flushSeconds` as JSON lines files under `path`, so they survive restarts. Read them with `spark.read.json(path)`. To summarize p50/p95/p99 batch latency offline, copy them out and run `python tools/stream_metrics.py <dir>`.
+# MAGIC 
+# MAGIC `await_progress(query)` waits for a query's first batch with input. Cells that read a query's output right after starting it use it, so Run All doesn't read a path before anything has been written there.
+# MAGIC 
+# MAGIC Use it from another notebook with `%run ./Includes/Streaming-Metrics`
+
+# COMMAND ----------
+
+# MAGIC %run ./Python-Builtins
+
+# COMMAND ----------
+
+import datetime as _dt
+import json
+import threading
+import time
+import uuid
+
+from pyspark.sql.streaming import StreamingQueryListener
+
+phases = ["latestOffset", "getBatch", "queryPlanning", "addBatch", "walCommit", "commitOffsets", "triggerExecution"]
+
+def _epoch_seconds(isoTimestamp):
+  # Aliased so a notebook that imports its own `datetime` into the shared namespace can't rebind it
+  return (_dt.datetime.strptime(isoTimestamp[:19], "%Y-%m-%dT%H:%M:%S") - _dt.datetime(1970, 1, 1)).total_seconds()
+
+def flatten_progress(progress):
+  """One flat record from a StreamingQueryProgress JSON dict."""
+  durations = progress.get("durationMs") or {}
+  operators = progress.get("stateOperators") or []
+  eventTime = progress.get("eventTime") or {}
+  record = {
+    "queryId": progress.get("id"),
+    "runId": progress.get("runId"),
+    "name": progress.get("name"),
+    "timestamp": progress.get("timestamp"),
+    "batchId": progress.get("batchId"),
+    "numInputRows": progress.get("numInputRows"),
+    "inputRowsPerSecond": progress.get("inputRowsPerSecond"),
+    "processedRowsPerSecond": progress.get("processedRowsPerSecond"),
+    "stateRowsTotal": py_sum(op.get("numRowsTotal", 0) for op in operators),
+    "stateRowsUpdated": py_sum(op.get("numRowsUpdated", 0) for op in operators),
+    "stateMemoryBytes": py_sum(op.get("memoryUsedBytes", 0) for op in operators),
+    "rowsDroppedByWatermark": py_sum(op.get("numRowsDroppedByWatermark", 0) for op in operators),
+    "duplicatesDropped": py_sum((op.get("customMetrics") or {}).get("numDroppedDuplicateRows", 0) for op in operators),
+    "watermark": eventTime.get("watermark"),
+    "watermarkLagSeconds": None,
+  }
+  for phase in phases:
+    record[phase + "Ms"] = durations.get(phase)
+  if record["watermark"] and record["timestamp"]:
+    record["watermarkLagSeconds"] = _epoch_seconds(record["timestamp"]) - _epoch_seconds(record["watermark"])
+  return record
+
+# COMMAND ----------
+
+class ProgressExporter(StreamingQueryListener):
+
+  def __init__(self, path, flushSeconds=30):
+    self.path = path.rstrip("/")
+    self.flushSeconds = flushSeconds
+    self.buffer = []
+    self.lock = threading.Lock()
+    self._stopped = threading.Event()
+    self._thread = threading.Thread(target=self._run, name="progress-exporter")
+    self._thread.daemon = True
+    self._thread.start()
+
+  # Listener callbacks run on the listener bus, so they only buffer - writing happens on the flush thread
+  def onQueryStarted(self, event):
+    pass
+
+  def onQueryProgress(self, event):
+    record = flatten_progress(json.loads(event.progress.json))
+    with self.lock:
+      self.buffer.append(record)
+
+  def onQueryIdle(self, event):
+    pass
+
+  def onQueryTerminated(self, event):
+    pass
+
+  def flush(self):
+    with self.lock:
+      records, self.buffer = self.buffer, []
+    if records:
+      name = "{}/progress-{}-{}.jsonl".format(self.path, int(time.time() * 1000), uuid.uuid4().hex[:8])
+      dbutils.fs.put(name, "\n".join(json.dumps(r) for r in records) + "\n", True)
+
+  def _run(self):
+    while not self._stopped.wait(self.flushSeconds):
+      try:
+        self.flush()
+      except Exception as e:
+        print("progress export failed: {}".format(e))
+
+  def stop(self):
+    self._stopped.set()
+    self.flush()
+
+# COMMAND ----------
+
+def install_progress_exporter(path, flushSeconds=30):
+  """Register a ProgressExporter writing under `path`, replacing one installed by an earlier run of this cell."""
+  global progressExporter
+  previous = globals().get("progressExporter")
+  if previous is not None:
+    spark.streams.removeListener(previous)
+    previous.stop()
+  progressExporter = ProgressExporter(path, flushSeconds)
+  spark.streams.addListener(progressExporter)
+  return progressExporter
+
+# COMMAND ----------
+
+def await_progress(query, batches=1, timeoutSeconds=300):
+  """
+  Wait until `query` has finished `batches` triggers that read input, so a cell reading its output right after
+  `start()` finds something there. Raises if the query stops or `timeoutSeconds` pass first.
+  """
+  deadline = time.time() + timeoutSeconds
+  while time.time() < deadline:
+    if not query.isActive:
+      raise RuntimeError("query {} stopped: {}".format(query.name or query.id, query.exception()))
+    if len([p for p in query.recentProgress if p["numInputRows"] > 0]) >= batches:
+      return query
+    time.sleep(1)
+  raise RuntimeError("query {} has not finished {} batches with input after {}s".format(query.name or query.id, batches, timeoutSeconds))
@@ -0,0 +1,135 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC # Streaming Top-N
+# MAGIC 
+# MAGIC `groupBy(...).agg(...).orderBy(desc(...))` needs complete output mode, which re-emits and re-sorts every key in the aggregate state on every trigger. The cost grows with the catalog, not with the batch.
+# MAGIC 
+# MAGIC `TopN` splits the work instead:
+# MAGIC * the running total per key stays in Spark's state store, and the aggregate runs in **update** mode, so a trigger only emits the keys whose total changed,
+# MAGIC * a `foreachBatch` step merges those changed keys with the current top K. Totals only grow, so a key that neither changed nor was in the top K cannot enter it, and a changed key below the current Kth total is dropped on the executors before anything is collected,
+# MAGIC * each trigger writes the top K to a new directory under `path/top`, and readers take the newest complete one, so a failed write never replaces a good top K. The keys whose rank changed are appended to `path/changes`.
+# MAGIC 
+# MAGIC The cost of each trigger depends on the batch size and K, not on the number of products.
+# MAGIC 
+# MAGIC A restarted query picks the top K up again from `path`. `path` belongs to the query of one checkpoint: starting a new checkpoint against a `path` written by another one fails, instead of skipping the new query's first batches.
+# MAGIC 
+# MAGIC Use it from another notebook with `%run ./Includes/Streaming-TopN`
+
+# COMMAND ----------
+
+import heapq
+import json
+
+from pyspark.sql.functions import col
+
+class TopN(object):
+
+  topSchema = "batchId long, rank long, key string, total double"
+  changesSchema = "batchId long, key string, total double, rank long, previousRank long"
+
+  def __init__(self, k, key, value, path):
+    self.k = k
+    self.key = key
+    self.value = value
+    self.topPath = path.rstrip("/") + "/top"
+    self.changesPath = path.rstrip("/") + "/changes"
+    self.ownerPath = path.rstrip("/") + "/_query"
+    self.checkpointLocation = None
+    self.queryId = None
+    self.top = {}
+    self.lastBatchId = -1
+
+  def _versions(self):
+    """(batchId, path) of the complete top K versions, oldest first."""
+    try:
+      entries = dbutils.fs.ls(self.topPath)
+    except Exception:
+      return []
+    versions = sorted((int(f.name.rstrip("/").split("=")[1]), f.path) for f in entries if f.name.startswith("batch="))
+    return [(batchId, path) for batchId, path in versions
+            if any(f.name == "_SUCCESS" for f in dbutils.fs.ls(path))]
+
+  def _restore(self):
+    # The checkpoint's metadata file holds the query id, and is there before the first batch runs
+    metadata = spark.read.text(self.checkpointLocation.rstrip("/") + "/metadata").first()[0]
+    self.queryId = json.loads(metadata)["id"]
+    try:
+      owner = json.loads(dbutils.fs.head(self.ownerPath))
+    except Exception:
+      owner = None
+
+    versions = self._versions()
+    if owner is None and not versions:
+      dbutils.fs.put(self.ownerPath, json.dumps({"queryId": self.queryId, "checkpointLocation": self.checkpointLocation}), True)
+      return
+    if owner is None or owner["queryId"] != self.queryId:
+      # A new checkpoint numbers its batches from 0 again, and they would all look like batches already applied
+      raise ValueError("{} holds the top K of another query ({}), not of the one checkpointed at {}. "
+                       "Remove it or use a new path.".format(self.topPath, owner, self.checkpointLocation))
+    if versions:
+      batchId, path = versions[-1]
+      self.top = {r["key"]: r["total"] for r in spark.read.parquet(path).collect()}
+      self.lastBatchId = batchId
+
+  @staticmethod
+  def _order(kv):
+    # Highest total first; ties broken on the key so ranks are stable between triggers
+    return (-kv[1], kv[0])
+
+  def _process(self, batchDF, batchId):
+    if self.queryId is None:
+      self._restore()
+    if batchId <= self.lastBatchId:
+      return  # batch replayed after a restart, already applied
+
+    changed = batchDF.select(col(self.key).cast("string").alias(self.key), col(self.value).cast("double").alias(self.value))
+    if len(self.top) >= self.k:
+      kth = sorted(self.top.items(), key=self._order)[self.k - 1][1]
+      changed = changed.where(col(self.value) >= kth)
+    candidates = dict(self.top)
+    for row in changed.collect():
+      candidates[row[0]] = row[1]
+    newTop = heapq.nsmallest(self.k, candidates.items(), key=self._order)
+
+    oldRanks = {key: rank for rank, (key, _) in enumerate(sorted(self.top.items(), key=self._order), 1)}
+    newRanks = {key: rank for rank, (key, _) in enumerate(newTop, 1)}
+    changes = [(batchId, key, candidates[key], newRanks.get(key), oldRanks.get(key))
+               for key in set(oldRanks) | set(newRanks)
+               if newRanks.get(key) != oldRanks.get(key)]
+
+    # Changes first and the top K last: the new top K directory is what marks the batch as applied
+    if changes:
+      (spark.createDataFrame(changes, self.changesSchema)
+        .coalesce(1).write.mode("append").parquet(self.changesPath))
+    (spark.createDataFrame([(batchId, rank, key, total) for rank, (key, total) in enumerate(newTop, 1)], self.topSchema)
+      .coalesce(1).write.mode("overwrite").parquet("{}/batch={}".format(self.topPath, batchId)))
+
+    # Keep the previous version too, for readers that listed it just before this one landed
+    for _, path in self._versions()[:-2]:
+      dbutils.fs.rm(path, True)
+    self.top = dict(newTop)
+    self.lastBatchId = batchId
+
+  def start(self, aggregatedDF, checkpointLocation, processingTime="15 seconds"):
+    """Run the top-N over `aggregatedDF`, a streaming `groupBy(key).agg(... .alias(value))` with no `orderBy`."""
+    self.checkpointLocation = checkpointLocation
+    return (aggregatedDF.writeStream
+      .outputMode("update")
+      .foreachBatch(self._process)
+      .option("checkpointLocation", checkpointLocation)
+      .trigger(processingTime=processingTime)
+      .start())
+
+  def current(self):
+    """The current top K as a DataFrame, best first. Empty until the first trigger has written one."""
+    versions = self._versions()
+    if not versions:
+      return spark.createDataFrame([], self.topSchema)
+    return spark.read.parquet(versions[-1][1]).orderBy("rank")
+
+  def changes(self):
+    """Every rank change so far. A batch replayed after a crash may have appended its changes twice, so they are deduplicated."""
+    try:
+      return spark.read.schema(self.changesSchema).parquet(self.changesPath).distinct()
+    except Exception:
+      return spark.createDataFrame([], self.changesSchema)
@@ -0,0 +1,46 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC # Windowed Aggregates
+# MAGIC 
+# MAGIC A streaming `groupBy("productId")` over all time keeps one state entry per key forever, and the checkpoint keeps growing with it.
+# MAGIC 
+# MAGIC `windowed_totals(..)` groups by an event-time window as well as the key, with a watermark on the event time:
+# MAGIC * `window_` alone gives tumbling windows, and `window_` plus `slide` gives sliding windows,
+# MAGIC * `watermark` is how late an order may arrive and still be counted. Once the watermark passes the end of a window, Spark drops its state,
+# MAGIC * in **append** output mode each window is emitted once, when it closes, and never updated again.
+# MAGIC 
+# MAGIC Use it from another notebook with `%run ./Includes/Windowed-Aggregates`
+
+# COMMAND ----------
+
+from pyspark.sql.functions import col, window
+from pyspark.sql.functions import sum as sum_
+
+def windowed_totals(df, key, value, alias, window_="1 hour", slide=None, watermark="10 minutes", timeColumn="orderTimestamp"):
+  """
+  Sum `value` (a column or expression) per `key` per event-time window, as `alias`.
+
+  The result has `window_start` and `window_end` columns instead of the `window` struct so it can be written to Parquet as is.
+  Pass `watermark=None` when `df` already has a watermark on `timeColumn`, e.g. from `dedupe_orders`.
+  """
+  slide = slide or window_
+  if watermark:
+    df = df.withWatermark(timeColumn, watermark)
+  return (df
+    .groupBy(window(col(timeColumn), window_, slide), key)
+    .agg(sum_(value).alias(alias))
+    .select(col("window.start").alias("window_start"), col("window.end").alias("window_end"), key, alias))
+
+def start_windowed_sink(windowedDF, path, checkpointLocation, processingTime="15 seconds"):
+  """Write closed windows to Parquet in append mode - each window lands once, after the watermark passes it."""
+  return (windowedDF.writeStream
+    .outputMode("append")
+    .format("parquet")
+    .option("path", path)
+    .option("checkpointLocation", checkpointLocation)
+    .trigger(processingTime=processingTime)
+    .start())
+
+def read_windowed_sink(windowedDF, path):
+  """The windows written to `path` so far. Empty, rather than an error, until the first window has closed."""
+  return spark.read.schema(windowedDF.schema).parquet(path)
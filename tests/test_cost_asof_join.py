@@ -0,0 +1,124 @@
+"""
+The per-product step of Includes/Cost-AsOf-Join, driven the way applyInPandasWithState drives it.
+
+The step is plain pandas, so it runs without Spark: the test executes the Include's cell that defines it,
+and plays the watermark that Spark would compute from the orders alone.
+"""
+
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+INCLUDE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                       "notebooks", "ADB_WrkShp", "Includes", "Cost-AsOf-Join.py")
+ORDER_COLUMNS = ["orderUUID", "productId", "quantity", "orderTimestamp"]
+COLUMN_KINDS = ["other", "int", "int", "timestamp"]
+MINUTE_MS = 60 * 1000
+T0 = datetime(2019, 3, 1, 10, 0)
+
+
+def _step_namespace():
+    with open(INCLUDE) as f:
+        cells = f.read().split("\n# COMMAND ----------\n")
+    ns = {}
+    exec([c for c in cells if "def _as_of_step" in c][0], ns)
+    return ns
+
+
+class FakeState(object):
+    """The parts of GroupState the step uses, checking the state holds only plain typed values, as Spark requires."""
+
+    def __init__(self):
+        self.value = None
+        self.timeout = None
+        self.watermark = 0
+
+    @property
+    def exists(self):
+        return self.value is not None
+
+    @property
+    def get(self):
+        return self.value
+
+    def update(self, value):
+        for column in value:
+            assert isinstance(column, list)
+            assert all(v is None or isinstance(v, (int, float, str, datetime)) for v in column), column
+        self.value = value
+
+    def remove(self):
+        self.value = None
+
+    def setTimeoutTimestamp(self, ms):
+        assert ms > self.watermark
+        self.timeout = ms
+
+    def getCurrentWatermarkMs(self):
+        return self.watermark
+
+
+def _ms(t):
+    return int(pd.Timestamp(t).value // 10 ** 6)
+
+
+def _orders(*times):
+    return pd.DataFrame({
+        "_product": [7] * len(times),
+        "orderUUID": ["order-{}".format(i) for i in range(len(times))],
+        "productId": [7] * len(times),
+        "quantity": [1] * len(times),
+        "orderTimestamp": list(times),
+        "_timeMs": [float(_ms(t)) for t in times],
+        "_cost": [np.nan] * len(times),
+        "_costMs": [np.nan] * len(times)})
+
+
+def _cost(effective, cost):
+    return pd.DataFrame({
+        "_product": [7], "orderUUID": [None], "productId": [np.nan], "quantity": [np.nan],
+        "orderTimestamp": [pd.NaT], "_timeMs": [np.nan], "_cost": [cost], "_costMs": [float(_ms(effective))]})
+
+
+def _run(step, state, *batches):
+    out = list(step(7, iter(batches), state))
+    return pd.concat(out, ignore_index=True) if out else None
+
+
+def test_orders_are_emitted_while_the_cost_feed_is_idle():
+    step = _step_namespace()["_as_of_step"](ORDER_COLUMNS, COLUMN_KINDS, "_timeMs", 10 * MINUTE_MS)
+    state = FakeState()
+
+    assert _run(step, state, _cost(T0, 5.0)) is None
+    assert _run(step, state, _orders(T0 + timedelta(minutes=5), T0 + timedelta(minutes=6))) is None
+
+    # No cost change arrives from here on. The orders' watermark alone moves past their timestamps plus the cost delay
+    state.watermark = _ms(T0 + timedelta(minutes=20))
+    out = _run(step, state, _orders(T0 + timedelta(minutes=30)))
+    assert list(out["orderUUID"]) == ["order-0", "order-1"]
+    assert list(out["StandardCost"]) == [5.0, 5.0]
+    assert list(out["costEffectiveMs"]) == [_ms(T0), _ms(T0)]
+    assert state.timeout == _ms(T0 + timedelta(minutes=40))
+
+    # The timeout fires with no new rows at all
+    state.watermark = _ms(T0 + timedelta(minutes=41))
+    out = _run(step, state)
+    assert list(out["orderTimestamp"]) == [pd.Timestamp(T0 + timedelta(minutes=30))]
+    assert list(out["StandardCost"]) == [5.0]
+
+
+def test_each_order_gets_the_cost_in_effect_at_its_timestamp():
+    step = _step_namespace()["_as_of_step"](ORDER_COLUMNS, COLUMN_KINDS, "_timeMs", 10 * MINUTE_MS)
+    state = FakeState()
+    _run(step, state, _orders(T0 - timedelta(minutes=1), T0 + timedelta(minutes=1), T0 + timedelta(minutes=3)),
+         pd.concat([_cost(T0, 5.0), _cost(T0 + timedelta(minutes=2), 6.0)], ignore_index=True))
+
+    state.watermark = _ms(T0 + timedelta(minutes=15))
+    out = _run(step, state)
+    assert out["StandardCost"].isna().tolist() == [True, False, False]
+    assert list(out["StandardCost"])[1:] == [5.0, 6.0]
+    # Nothing is waiting, and only the change still in effect is kept
+    assert state.value[0] == [_ms(T0 + timedelta(minutes=2))]
+    assert state.value[-1] == []
@@ -0,0 +1,197 @@
+"""
+Synthetic stand-ins for the Initech datasets under /mnt/training-sources/initech/.
+
+The layout and column names match what the workshop notebooks read, so a local
+run can point /mnt/training-sources/ at the generated directory:
+
+    initech/productsCsv/product.csv
+    initech/productsFull/                  (parquet)
+    initech/productsShort/                 (parquet)
+    initech/productRatings/                (parquet)
+    initech/streaming/orders/data/part-*   (headerless csv)
+
+    python tools/initech_data.py data/10x --scale 10x --seed 7 --zipf 1.1 --orders-per-second 200
+
+Sizes are multiplied by `scale` ("1x", "10x", "100x" or any number, including
+fractions for quick runs). Output is deterministic for a given seed. Product
+popularity in ratings and orders follows a Zipf distribution with exponent
+`zipf` (0 is uniform), and orders arrive at `orders_per_second`, each part
+file holding `file_seconds` of them in time order like a real drop directory.
+"""
+
+import argparse
+import os
+import shutil
+
+from pyspark.sql import SparkSession
+from pyspark.sql import functions as F
+
+# Row counts at scale 1 - roughly the size of the workshop datasets
+BASE_PRODUCTS = 1000
+BASE_PRODUCTS_FULL = 300
+BASE_RATINGS = 900000
+BASE_USERS = 50000
+BASE_ORDERS = 100000
+
+FIRST_FULL_PRODUCT_ID = 680  # productsFull ids start here, like the AdventureWorks product table
+PERMUTATION_PRIME = 1000003  # spreads popular ranks over the id range instead of the lowest ids
+# rand(seed) is only reproducible for a fixed partitioning, so every range gets this many partitions
+# instead of the default parallelism, which follows the core count
+RANGE_PARTITIONS = 8
+
+CATEGORIES = ["Laptops", "Tablets", "Desktops", "Monitors", "Phones"]
+BRANDS = ["Contoso", "Fabrikam", "Litware", "Northwind", "Proseware", "Tailspin"]
+PROCESSORS = ["Intel Core i3", "Intel Core i5", "Intel Core i7", "AMD Ryzen 5", "AMD Ryzen 7"]
+COLORS = ["Black", "Silver", "Red", "Blue", "Yellow", "Multi"]
+
+
+def parse_scale(scale):
+    """Accept 10, 10.0, "10" or "10x"."""
+    return float(str(scale).lower().rstrip("x"))
+
+
+def _scaled(base, scale):
+    return max(1, int(base * scale))
+
+
+def _pick(values, col):
+    """Map an integer column onto one of `values`."""
+    return F.element_at(F.array(*[F.lit(v) for v in values]), (col % len(values)).cast("int") + 1)
+
+
+def _uniform_id(n, seed, first=1):
+    return (F.floor(F.rand(seed) * n) + first).cast("int")
+
+
+def _zipf_id(n, s, seed, first=1):
+    """
+    Draw ids in [first, first + n) with Zipf(s) popularity.
+
+    Uses the inverse CDF of the continuous bounded power law, which is close to
+    Zipf for the catalog sizes used here and stays a plain column expression.
+    The drawn rank is then permuted so the hot products are spread over the ids.
+    """
+    if s <= 0:
+        return _uniform_id(n, seed, first)
+    u = F.rand(seed)
+    if abs(s - 1.0) < 1e-9:
+        rank = F.floor(F.pow(F.lit(float(n + 1)), u))
+    else:
+        rank = F.floor(F.pow((F.lit((n + 1) ** (1 - s)) - 1) * u + 1, F.lit(1.0 / (1 - s))))
+    rank = F.least(F.greatest(rank, F.lit(1)), F.lit(n)) - 1
+    return ((rank * PERMUTATION_PRIME) % n + first).cast("int")
+
+
+def _uuid(seed, col):
+    """A deterministic uuid-formatted string - `uuid()` would differ on every run."""
+    h = F.sha2(F.concat_ws(":", F.lit(str(seed)), col.cast("string")), 256)
+    return F.concat_ws("-", h.substr(1, 8), h.substr(9, 4), h.substr(13, 4), h.substr(17, 4), h.substr(21, 12))
+
+
+def _write_single_csv(df, path):
+    """Write `df` as one headed csv file at `path` rather than a directory of parts."""
+    tmp = path + ".parts"
+    df.coalesce(1).write.mode("overwrite").option("header", "true").csv(tmp)
+    part = [f for f in os.listdir(tmp) if f.startswith("part-")][0]
+    shutil.move(os.path.join(tmp, part), path)
+    shutil.rmtree(tmp)
+
+
+def products(spark, scale, seed=0):
+    n = _scaled(BASE_PRODUCTS, scale)
+    return (spark.range(1, n + 1, numPartitions=RANGE_PARTITIONS).withColumnRenamed("id", "product_id")
+            .withColumn("category", _pick(CATEGORIES, F.col("product_id")))
+            .withColumn("brand", _pick(BRANDS, F.col("product_id") * 7))
+            .withColumn("model", F.concat(F.lit("M-"), F.col("product_id")))
+            .withColumn("price", F.round(F.rand(seed + 1) * 1900 + 99, 2))
+            .withColumn("processor", _pick(PROCESSORS, F.col("product_id") * 3))
+            .withColumn("size", F.concat((F.col("product_id") % 8 + 10).cast("string"), F.lit("in")))
+            .withColumn("display", F.when(F.col("product_id") % 2 == 0, "LED").otherwise("IPS")))
+
+
+def products_full(spark, scale, seed=0):
+    n = _scaled(BASE_PRODUCTS_FULL, scale)
+    ids = spark.range(FIRST_FULL_PRODUCT_ID, FIRST_FULL_PRODUCT_ID + n, numPartitions=RANGE_PARTITIONS)
+    return (ids.select(F.col("id").cast("int").alias("ProductID"))
+            .withColumn("Name", F.concat(_pick(BRANDS, F.col("ProductID")), F.lit(" Product "), F.col("ProductID")))
+            .withColumn("ProductNumber", F.concat(F.lit("PN-"), F.col("ProductID")))
+            .withColumn("Color", _pick(COLORS, F.col("ProductID")))
+            .withColumn("StandardCost", F.round(F.rand(seed + 2) * 1500 + 5, 4))
+            .withColumn("ListPrice", F.round(F.col("StandardCost") * 1.6, 4))
+            .withColumn("Size", (F.col("ProductID") % 20 + 38).cast("string"))
+            .withColumn("Weight", F.round(F.rand(seed + 3) * 20, 2))
+            .withColumn("ProductCategoryID", (F.col("ProductID") % 40 + 1).cast("int"))
+            .withColumn("ProductModelID", (F.col("ProductID") % 120 + 1).cast("int")))
+
+
+def products_short(spark, scale, seed=0):
+    return products(spark, scale, seed).select("product_id", "category", "brand", "model", "price")
+
+
+def product_ratings(spark, scale, seed=0, zipf=1.0):
+    n = _scaled(BASE_RATINGS, scale)
+    users = _scaled(BASE_USERS, scale)
+    items = _scaled(BASE_PRODUCTS, scale)
+    return (spark.range(0, n, numPartitions=RANGE_PARTITIONS)
+            .select(_zipf_id(items, zipf, seed + 4).alias("product_id"),
+                    _uniform_id(users, seed + 5).alias("user_id"),
+                    (F.floor(F.rand(seed + 6) * 5) + 1).cast("int").alias("rating"))
+            .dropDuplicates(["product_id", "user_id"]))
+
+
+def orders(spark, scale, seed=0, zipf=1.0, orders_per_second=100.0, start="2018-03-01 00:00:00"):
+    """Orders arriving at `orders_per_second` on average, with up to one inter-arrival gap of jitter."""
+    n = _scaled(BASE_ORDERS, scale)
+    users = _scaled(BASE_USERS, scale)
+    items = _scaled(BASE_PRODUCTS_FULL, scale)
+    arrival = (F.col("id") + F.rand(seed + 11)) / float(orders_per_second)
+    return (spark.range(0, n, numPartitions=RANGE_PARTITIONS)
+            .select(_uuid(seed, F.col("id")).alias("orderUUID"),
+                    _zipf_id(items, zipf, seed + 7, FIRST_FULL_PRODUCT_ID).alias("productId"),
+                    _uniform_id(users, seed + 8).alias("userId"),
+                    (F.floor(F.rand(seed + 9) * 5) + 1).cast("int").alias("quantity"),
+                    F.round(F.rand(seed + 10) * 0.3, 2).alias("discount"),
+                    (F.unix_timestamp(F.lit(start)) + arrival).cast("timestamp").alias("orderTimestamp")))
+
+
+def write_orders(df, path, orders_per_second, file_seconds):
+    """Write orders as time-ordered part files, each covering `file_seconds` of arrivals."""
+    count = df.count()
+    files = max(1, int(count / (orders_per_second * file_seconds)))
+    (df.repartitionByRange(files, "orderTimestamp")
+     .sortWithinPartitions("orderTimestamp")
+     .write.mode("overwrite")
+     .csv(path))
+
+
+def generate(spark, root, scale=1.0, seed=0, zipf=1.0, orders_per_second=100.0, file_seconds=10.0):
+    """Write every Initech dataset under `root`, laid out like /mnt/training-sources/."""
+    scale = parse_scale(scale)
+    initech = os.path.join(root, "initech")
+    os.makedirs(os.path.join(initech, "productsCsv"), exist_ok=True)
+
+    _write_single_csv(products(spark, scale, seed), os.path.join(initech, "productsCsv", "product.csv"))
+    products_full(spark, scale, seed).write.mode("overwrite").parquet(os.path.join(initech, "productsFull"))
+    products_short(spark, scale, seed).write.mode("overwrite").parquet(os.path.join(initech, "productsShort"))
+    product_ratings(spark, scale, seed, zipf).write.mode("overwrite").parquet(os.path.join(initech, "productRatings"))
+    write_orders(orders(spark, scale, seed, zipf, orders_per_second),
+                 os.path.join(initech, "streaming", "orders", "data"), orders_per_second, file_seconds)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate synthetic Initech datasets.")
+    parser.add_argument("root", help="output directory, used in place of /mnt/training-sources/")
+    parser.add_argument("--scale", default="1x", help="1x, 10x, 100x or any factor")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--zipf", type=float, default=1.0, help="product popularity skew, 0 for uniform")
+    parser.add_argument("--orders-per-second", type=float, default=100.0)
+    parser.add_argument("--file-seconds", type=float, default=10.0, help="seconds of orders per part file")
+    parser.add_argument("--cores", default="*")
+    args = parser.parse_args(argv)
+
+    spark = SparkSession.builder.master("local[{}]".format(args.cores)).appName("initech-data").getOrCreate()
+    generate(spark, args.root, args.scale, args.seed, args.zipf, args.orders_per_second, args.file_seconds)
+
+
+if __name__ == "__main__":
+    main()
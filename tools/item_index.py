@@ -0,0 +1,213 @@
+"""
+Approximate nearest-neighbour index over ALS item factors, for similar-product lookups.
+
+    python tools/item_index.py build /dbfs/tmp/training-msft/als/current --out /dbfs/tmp/training-msft/als/item-index
+    python tools/item_index.py bench --synthetic 1000000 --rank 10 --nprobe 1,4,16,64
+    python tools/item_index.py bench --model /dbfs/tmp/training-msft/als/current --k 10
+
+An IVF (inverted file) index on cosine similarity. Spherical k-means splits
+the normalized item vectors into `n_lists` clusters, and the vectors are
+stored grouped by cluster. A query compares itself with the centroids and
+scans only the `nprobe` closest clusters, so it reads about nprobe / n_lists
+of the catalog. Raising `nprobe` trades latency for recall.
+
+`save` writes plain .npy files and `ItemIndex.load(path)` memory-maps them.
+Opening an index is then instant, only the probed clusters are paged in, and
+several processes on one machine share the pages.
+
+`bench` reports the build time and, for each `nprobe`, the recall@K against
+an exact scan and the mean and p99 query latency next to the exact scan's.
+Needs numpy, plus pyarrow to read a saved model.
+"""
+
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+CHUNK_ROWS = 65536
+
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def _assign(vectors, centroids):
+    """Index of the most similar centroid for every row, computed a chunk of rows at a time."""
+    out = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), CHUNK_ROWS):
+        out[start:start + CHUNK_ROWS] = vectors[start:start + CHUNK_ROWS].dot(centroids.T).argmax(axis=1)
+    return out
+
+
+def spherical_kmeans(vectors, n_lists, iterations=10, sample=200000, seed=0):
+    rng = np.random.RandomState(seed)
+    train = vectors[rng.choice(len(vectors), min(sample, len(vectors)), replace=False)]
+    centroids = train[rng.choice(len(train), n_lists, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = _assign(train, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, train)
+        empty = np.flatnonzero(np.bincount(assignment, minlength=n_lists) == 0)
+        sums[empty] = train[rng.choice(len(train), len(empty), replace=False)]
+        centroids = normalize(sums)
+    return centroids
+
+
+def top_k(scores, k):
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    idx = np.argpartition(-scores, k - 1)[:k]
+    return idx[np.argsort(-scores[idx])]
+
+
+class ItemIndex(object):
+
+    def __init__(self, ids, vectors, centroids, offsets, nprobe=8):
+        self.ids = ids
+        self.vectors = vectors
+        self.centroids = centroids
+        self.offsets = offsets
+        self.nprobe = nprobe
+
+    @classmethod
+    def build(cls, ids, factors, n_lists=None, iterations=10, nprobe=8, seed=0):
+        """Index `factors` (one row per id). `n_lists` defaults to about 4 x sqrt(number of items)."""
+        vectors = normalize(factors)
+        n_lists = min(len(vectors), n_lists or int(4 * np.sqrt(len(vectors))) or 1)
+        centroids = spherical_kmeans(vectors, n_lists, iterations, seed=seed)
+        assignment = _assign(vectors, centroids)
+        order = np.argsort(assignment, kind="stable")
+        offsets = np.r_[0, np.cumsum(np.bincount(assignment, minlength=n_lists))].astype(np.int64)
+        return cls(np.asarray(ids, dtype=np.int64)[order], np.ascontiguousarray(vectors[order]), centroids, offsets, nprobe)
+
+    def search(self, query, k=10, nprobe=None, exclude=None):
+        """(ids, cosine similarities) of the `k` items closest to `query`, best first, skipping id `exclude`."""
+        query = normalize(query)
+        probe = top_k(self.centroids.dot(query), nprobe or self.nprobe)
+        ids, scores = [], []
+        for c in probe:
+            start, end = self.offsets[c], self.offsets[c + 1]
+            if start < end:
+                ids.append(self.ids[start:end])
+                scores.append(self.vectors[start:end].dot(query))
+        if not ids:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        ids, scores = np.concatenate(ids), np.concatenate(scores)
+        if exclude is not None:
+            scores[ids == exclude] = -np.inf
+        best = [i for i in top_k(scores, k + (exclude is not None)) if np.isfinite(scores[i])][:k]
+        return ids[best], scores[best]
+
+    def save(self, path):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for name in ("ids", "vectors", "centroids", "offsets"):
+            np.save(os.path.join(path, name + ".npy"), getattr(self, name))
+        with open(os.path.join(path, "index.json"), "w") as f:
+            json.dump({"items": len(self.ids), "lists": len(self.centroids), "rank": self.vectors.shape[1],
+                       "nprobe": self.nprobe}, f)
+
+    @classmethod
+    def load(cls, path, mmap=True, nprobe=None):
+        mode = "r" if mmap else None
+        with open(os.path.join(path, "index.json")) as f:
+            meta = json.load(f)
+        arrays = [np.load(os.path.join(path, name + ".npy"), mmap_mode=mode)
+                  for name in ("ids", "vectors", "centroids", "offsets")]
+        return cls(*arrays, nprobe=nprobe or meta["nprobe"])
+
+
+def exact_search(ids, unit_vectors, query, k, exclude=None):
+    scores = unit_vectors.dot(normalize(query))
+    if exclude is not None:
+        scores[ids == exclude] = -np.inf
+    best = top_k(scores, k)
+    return ids[best], scores[best]
+
+
+def synthetic_factors(n, rank, clusters=1000, seed=0):
+    """Clustered random factors, a rough stand-in for a real catalog's item factors."""
+    rng = np.random.RandomState(seed)
+    centres = rng.normal(size=(clusters, rank)).astype(np.float32)
+    return np.arange(n, dtype=np.int64), centres[rng.randint(clusters, size=n)] + \
+        0.5 * rng.normal(size=(n, rank)).astype(np.float32)
+
+
+def load_item_factors(model_path):
+    import recommendation_service
+    return recommendation_service._factors(os.path.join(model_path, "itemFactors"))
+
+
+def benchmark(ids, factors, k=10, nprobes=(1, 4, 16, 64), n_lists=None, queries=1000, seed=0):
+    started = time.time()
+    index = ItemIndex.build(ids, factors, n_lists=n_lists, seed=seed)
+    report = {"items": len(ids), "lists": len(index.centroids), "buildSeconds": round(time.time() - started, 2),
+              "k": k, "runs": []}
+    unit = normalize(factors)
+    rng = np.random.RandomState(seed + 1)
+    sample = rng.choice(len(ids), min(queries, len(ids)), replace=False)
+
+    exact, exact_ms = [], []
+    for i in sample:
+        t = time.perf_counter()
+        found, _ = exact_search(ids, unit, factors[i], k, exclude=ids[i])
+        exact_ms.append((time.perf_counter() - t) * 1000)
+        exact.append(set(found.tolist()))
+    report["exactMeanMs"] = round(float(np.mean(exact_ms)), 3)
+
+    for nprobe in nprobes:
+        hits, latency = 0, []
+        for truth, i in zip(exact, sample):
+            t = time.perf_counter()
+            found, _ = index.search(factors[i], k, nprobe=nprobe, exclude=ids[i])
+            latency.append((time.perf_counter() - t) * 1000)
+            hits += len(truth.intersection(found.tolist()))
+        report["runs"].append({"nprobe": nprobe, "recallAtK": round(hits / float(k * len(sample)), 4),
+                               "meanMs": round(float(np.mean(latency)), 3),
+                               "p99Ms": round(float(np.percentile(latency, 99)), 3)})
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build or benchmark an ANN index over ALS item factors.")
+    sub = parser.add_subparsers(dest="command")
+    build = sub.add_parser("build", help="build an index from a saved ALS model and save it")
+    build.add_argument("model")
+    build.add_argument("--out", required=True)
+    build.add_argument("--lists", type=int)
+    build.add_argument("--nprobe", type=int, default=8)
+    bench = sub.add_parser("bench", help="recall@K and latency against an exact scan")
+    bench.add_argument("--model")
+    bench.add_argument("--synthetic", type=int, help="number of synthetic items instead of a model")
+    bench.add_argument("--rank", type=int, default=10)
+    bench.add_argument("--lists", type=int)
+    bench.add_argument("--k", type=int, default=10)
+    bench.add_argument("--nprobe", default="1,4,16,64")
+    bench.add_argument("--queries", type=int, default=1000)
+    bench.add_argument("--out", help="also write the report as JSON here")
+    args = parser.parse_args(argv)
+
+    if args.command == "build":
+        ids, factors = load_item_factors(args.model)
+        index = ItemIndex.build(ids, factors, n_lists=args.lists, nprobe=args.nprobe)
+        index.save(args.out)
+        print("indexed {} items in {} lists to {}".format(len(ids), len(index.centroids), args.out))
+    elif args.command == "bench":
+        ids, factors = synthetic_factors(args.synthetic, args.rank) if args.synthetic else load_item_factors(args.model)
+        report = benchmark(ids, factors, args.k, [int(n) for n in args.nprobe.split(",")], args.lists, args.queries)
+        print(json.dumps(report, indent=2))
+        if args.out:
+            with open(args.out, "w") as f:
+                json.dump(report, f, indent=2)
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,414 @@
+"""
+Replay the workshop notebooks in Spark local mode and time every cell.
+
+    python tools/notebook_bench.py --scale 0.1 --out bench/baseline
+    python tools/notebook_bench.py "notebooks/ADB_WrkShp/03 Reading Data.py" --out bench/after
+
+Notebooks are read in the Databricks source format (`# COMMAND ----------`
+between cells). `dbutils`, `display`, `table` and the `%fs`, `%sql` and `%run`
+magics are replaced by local stand-ins, and every /mnt/training-sources/ path
+is pointed at synthetic data from `initech_data` (generated on first use).
+Markdown and Scala cells are skipped.
+
+Per-cell wall time, input rows and shuffle bytes are written to
+<out>.json and <out>.csv. Rows and shuffle bytes come from the stages
+the cell ran, read off the Spark UI REST API.
+"""
+
+import argparse
+import csv
+import glob
+import json
+import os
+import re
+import shutil
+import sys
+import time
+import traceback
+import urllib.request
+from collections import namedtuple
+
+from pyspark.sql import DataFrame, SparkSession
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import initech_data  # noqa: E402
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+NOTEBOOK_DIR = os.path.join(REPO, "notebooks", "ADB_WrkShp")
+CELL_SEPARATOR = "\n# COMMAND ----------\n"
+
+Cell = namedtuple("Cell", ["index", "kind", "source"])
+FileInfo = namedtuple("FileInfo", ["path", "name", "size", "modificationTime"])
+
+
+# ---------------------------------------------------------------------------
+# Notebook parsing
+# ---------------------------------------------------------------------------
+
+def parse_notebook(path):
+    """Split a Databricks source notebook into cells of kind python, sql, fs, run, md or other."""
+    with open(path) as f:
+        text = f.read()
+    if not path.endswith(".py"):
+        return [Cell(0, "other", text)]
+
+    text = text.split("\n", 1)[1] if text.startswith("# Databricks notebook source") else text
+    cells = []
+    for index, chunk in enumerate(text.split(CELL_SEPARATOR)):
+        source = chunk.strip("\n")
+        if not source.strip():
+            continue
+        if source.startswith("# MAGIC"):
+            source = "\n".join(re.sub(r"^# MAGIC ?", "", line) for line in source.split("\n"))
+            magic, _, body = source.partition("\n")
+            kind = magic.split()[0].lstrip("%").split("-")[0]
+            body = (magic.split(None, 1)[1] + "\n" if len(magic.split(None, 1)) > 1 else "") + body
+            cells.append(Cell(index, kind if kind in ("md", "sql", "fs", "run", "python") else "other", body))
+        else:
+            cells.append(Cell(index, "python", source))
+    return cells
+
+
+# ---------------------------------------------------------------------------
+# Local stand-ins
+# ---------------------------------------------------------------------------
+
+class Paths(object):
+    """Maps workspace paths (dbfs:/mnt/training-sources/..., /tmp/...) onto local directories."""
+
+    def __init__(self, data_dir, work_dir):
+        self.mounts = {"/mnt/training-sources": os.path.abspath(data_dir)}
+        self.root = os.path.abspath(os.path.join(work_dir, "dbfs"))
+
+    def local(self, path):
+        path = re.sub(r"^(dbfs:|file://)", "", path)
+        if path.startswith(self.root) or any(path.startswith(v) for v in self.mounts.values()):
+            return path
+        for mount, target in self.mounts.items():
+            if path.rstrip("/") == mount or path.startswith(mount + "/"):
+                return target + path[len(mount):]
+        return self.root + "/" + path.lstrip("/")
+
+    def rewrite(self, source):
+        """Point every quoted dbfs/mount/tmp path literal in `source` at its local directory."""
+        return re.sub(r"""(["'])((?:dbfs:)?/(?:mnt|tmp)/[^"']*)""",
+                      lambda m: m.group(1) + self.local(m.group(2)), source)
+
+
+class LocalFs(object):
+    """The subset of `dbutils.fs` the notebooks and Includes use."""
+
+    def __init__(self, paths):
+        self.paths = paths
+
+    def _info(self, path):
+        is_dir = os.path.isdir(path)
+        stat = os.stat(path)
+        name = os.path.basename(path.rstrip("/")) + ("/" if is_dir else "")
+        uri = "file://" + path + ("/" if is_dir else "")
+        return FileInfo(uri, name, 0 if is_dir else stat.st_size, int(stat.st_mtime * 1000))
+
+    def ls(self, path):
+        local = self.paths.local(path)
+        if not os.path.exists(local):
+            raise IOError("java.io.FileNotFoundException: File {} does not exist.".format(path))
+        if not os.path.isdir(local):
+            return [self._info(local)]
+        return [self._info(os.path.join(local, n)) for n in sorted(os.listdir(local))]
+
+    def head(self, path, maxBytes=65536):
+        with open(self.paths.local(path), "rb") as f:
+            return f.read(maxBytes).decode("utf-8", "replace")
+
+    def put(self, path, contents, overwrite=False):
+        local = self.paths.local(path)
+        if os.path.exists(local) and not overwrite:
+            raise IOError("File already exists: " + path)
+        os.makedirs(os.path.dirname(local), exist_ok=True)
+        with open(local, "w") as f:
+            f.write(contents)
+        return True
+
+    def mkdirs(self, path):
+        os.makedirs(self.paths.local(path), exist_ok=True)
+        return True
+
+    def rm(self, path, recurse=False):
+        local = self.paths.local(path)
+        if os.path.isdir(local):
+            if not recurse:
+                raise IOError("Directory not empty: " + path)
+            shutil.rmtree(local)
+        elif os.path.exists(local):
+            os.remove(local)
+        else:
+            return False
+        return True
+
+    def mv(self, src, dst, recurse=False):
+        dst = self.paths.local(dst)
+        os.makedirs(os.path.dirname(dst.rstrip("/")), exist_ok=True)
+        shutil.move(self.paths.local(src), dst)
+        return True
+
+    def cp(self, src, dst, recurse=False):
+        src, dst = self.paths.local(src), self.paths.local(dst)
+        if os.path.isdir(src):
+            shutil.copytree(src, dst)
+        else:
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            shutil.copy(src, dst)
+        return True
+
+    def mount(self, source, mount_point, extra_configs=None):
+        # The mount already points at the synthetic data
+        return True
+
+    def mounts(self):
+        return list(self.paths.mounts.items())
+
+    def help(self, *args):
+        print("local dbutils.fs stand-in")
+
+
+class LocalWidgets(object):
+    """Widgets keep their default unless the run overrides them with --widget name=value."""
+
+    def __init__(self, overrides):
+        self.overrides = dict(overrides)
+        self.values = {}
+
+    def _define(self, name, defaultValue, *args, **kwargs):
+        self.values[name] = self.overrides.get(name, defaultValue)
+
+    text = dropdown = combobox = multiselect = _define
+
+    def get(self, name):
+        if name in self.values:
+            return self.values[name]
+        if name in self.overrides:
+            return self.overrides[name]
+        raise ValueError("No input widget named {} is defined".format(name))
+
+    getArgument = get
+
+    def remove(self, name):
+        self.values.pop(name, None)
+
+    def removeAll(self):
+        self.values.clear()
+
+
+class LocalDbutils(object):
+
+    def __init__(self, paths, widgets=None):
+        self.fs = LocalFs(paths)
+        self.widgets = LocalWidgets(widgets or {})
+
+    def help(self, *args):
+        print("local dbutils stand-in: fs.ls, head, put, mkdirs, rm, mv, cp, mount, widgets")
+
+
+# ---------------------------------------------------------------------------
+# Runner
+# ---------------------------------------------------------------------------
+
+class StageMetrics(object):
+    """Sums input rows and shuffle bytes over the stages completed since the last call."""
+
+    def __init__(self, spark):
+        self.url = spark.sparkContext.uiWebUrl
+        self.app = spark.sparkContext.applicationId
+        self.seen = set()
+        self.delta()
+
+    def _stages(self):
+        if not self.url:
+            return []
+        url = "{}/api/v1/applications/{}/stages?status=complete".format(self.url, self.app)
+        try:
+            with urllib.request.urlopen(url, timeout=10) as r:
+                return json.loads(r.read().decode("utf-8"))
+        except Exception:
+            return []
+
+    def delta(self):
+        totals = {"rows": 0, "shuffle_read_bytes": 0, "shuffle_write_bytes": 0}
+        for stage in self._stages():
+            key = (stage["stageId"], stage["attemptId"])
+            if key in self.seen:
+                continue
+            self.seen.add(key)
+            totals["rows"] += stage.get("inputRecords", 0)
+            totals["shuffle_read_bytes"] += stage.get("shuffleReadBytes", 0)
+            totals["shuffle_write_bytes"] += stage.get("shuffleWriteBytes", 0)
+        return totals
+
+
+class NotebookRunner(object):
+
+    def __init__(self, spark, paths, stream_seconds=60, display_rows=1000, widgets=None):
+        self.spark = spark
+        self.paths = paths
+        self.widgets = widgets or {}
+        self.stream_seconds = stream_seconds
+        self.display_rows = display_rows
+        self.metrics = StageMetrics(spark)
+
+    def namespace(self):
+        dbutils = LocalDbutils(self.paths, self.widgets)
+        return {
+            "__name__": "__notebook__",
+            "spark": self.spark,
+            "sc": self.spark.sparkContext,
+            "sqlContext": self.spark,
+            "table": self.spark.table,
+            "dbutils": dbutils,
+            "display": self.display,
+            "displayHTML": lambda html: None,
+        }
+
+    def drain(self, query):
+        """Let a streaming query work through the data available now, then stop it."""
+        deadline = time.time() + self.stream_seconds
+        while query.isActive and time.time() < deadline:
+            status = query.status
+            if query.lastProgress is not None and not status["isDataAvailable"] and not status["isTriggerActive"]:
+                break
+            time.sleep(0.5)
+        query.stop()
+
+    def display(self, df, *args, **kwargs):
+        if not isinstance(df, DataFrame):
+            return
+        if not df.isStreaming:
+            df.limit(self.display_rows).collect()
+            return
+        for mode in ("append", "complete", "update"):
+            try:
+                query = df.writeStream.format("memory").queryName("display_{}".format(id(df))).outputMode(mode).start()
+                break
+            except Exception:
+                continue
+        else:
+            raise RuntimeError("no output mode supports this streaming query")
+        self.drain(query)
+
+    def run_cell(self, cell, ns, notebook_dir):
+        if cell.kind == "python":
+            exec(compile(self.paths.rewrite(cell.source), "<cell {}>".format(cell.index), "exec"), ns)
+        elif cell.kind == "sql":
+            for statement in self.paths.rewrite(cell.source).split(";"):
+                if statement.strip():
+                    self.display(self.spark.sql(statement))
+        elif cell.kind == "fs":
+            command, _, arg = cell.source.strip().partition(" ")
+            if command == "ls":
+                ns["dbutils"].fs.ls(arg.strip())
+            elif command == "head":
+                ns["dbutils"].fs.head(arg.strip())
+        elif cell.kind == "run":
+            target = cell.source.strip().strip('"')
+            path = os.path.normpath(os.path.join(notebook_dir, target)) + ".py"
+            for included in parse_notebook(path):
+                self.run_cell(included, ns, os.path.dirname(path))
+
+    def run(self, path):
+        """Run every cell of one notebook and return a result row per cell."""
+        results = []
+        ns = self.namespace()
+        name = os.path.basename(path)
+        for cell in parse_notebook(path):
+            if cell.kind in ("md", "other"):
+                if cell.kind == "other":
+                    results.append(self._result(name, cell, "skipped", 0.0, {}))
+                continue
+            self.spark.sparkContext.setJobGroup("{}:{}".format(name, cell.index), cell.source[:80])
+            self.metrics.delta()
+            started = time.time()
+            status, error = "ok", None
+            try:
+                self.run_cell(cell, ns, os.path.dirname(path))
+            except Exception as e:
+                status, error = "error", "{}: {}".format(type(e).__name__, str(e).split("\n")[0])
+                traceback.print_exc(limit=1)
+            finally:
+                for query in self.spark.streams.active:
+                    self.drain(query)
+            elapsed = time.time() - started
+            results.append(self._result(name, cell, status, elapsed, self.metrics.delta(), error))
+            print("{:<48} cell {:>3} {:<6} {:>8.2f}s {}".format(name[:48], cell.index, status, elapsed, error or ""))
+        return results
+
+    @staticmethod
+    def _result(notebook, cell, status, elapsed, metrics, error=None):
+        first = next((line for line in cell.source.split("\n") if line.strip()), "")
+        return {
+            "notebook": notebook,
+            "cell": cell.index,
+            "kind": cell.kind,
+            "first_line": first.strip()[:100],
+            "status": status,
+            "wall_seconds": round(elapsed, 3),
+            "rows": metrics.get("rows", 0),
+            "shuffle_read_bytes": metrics.get("shuffle_read_bytes", 0),
+            "shuffle_write_bytes": metrics.get("shuffle_write_bytes", 0),
+            "error": error,
+        }
+
+
+def write_report(results, out):
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out + ".json", "w") as f:
+        json.dump(results, f, indent=2)
+    with open(out + ".csv", "w") as f:
+        writer = csv.DictWriter(f, fieldnames=list(results[0].keys()) if results else ["notebook"])
+        writer.writeheader()
+        writer.writerows(results)
+
+
+def local_session(cores, work_dir):
+    return (SparkSession.builder
+            .master("local[{}]".format(cores))
+            .appName("notebook-bench")
+            .config("spark.sql.warehouse.dir", os.path.join(os.path.abspath(work_dir), "warehouse"))
+            .config("spark.ui.retainedStages", 100000)
+            .config("spark.ui.retainedJobs", 100000)
+            .getOrCreate())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("notebooks", nargs="*", help="notebooks to run (default: every workshop notebook)")
+    parser.add_argument("--scale", default="0.1", help="synthetic data scale factor, e.g. 0.1, 1x, 10x")
+    parser.add_argument("--seed", type=int, default=0, help="synthetic data seed")
+    parser.add_argument("--zipf", type=float, default=1.0, help="synthetic product popularity skew")
+    parser.add_argument("--data-dir", default=None,
+                        help="synthetic data directory (default: <work-dir>/data-<scale>-<seed>-<zipf>)")
+    parser.add_argument("--work-dir", default="bench-work", help="local dbfs root, warehouse and data")
+    parser.add_argument("--cores", default="*", help="local[N] cores")
+    parser.add_argument("--stream-seconds", type=float, default=60, help="max time to drain each streaming query")
+    parser.add_argument("--widget", action="append", default=[], metavar="NAME=VALUE",
+                        help="override a notebook widget, e.g. eventSource=local")
+    parser.add_argument("--out", default="bench/report", help="report path prefix (.json and .csv are added)")
+    args = parser.parse_args(argv)
+
+    spark = local_session(args.cores, args.work_dir)
+    data_dir = args.data_dir or os.path.join(
+        args.work_dir, "data-{}-{}-{}".format(initech_data.parse_scale(args.scale), args.seed, args.zipf))
+    if not os.path.isdir(os.path.join(data_dir, "initech")):
+        print("generating scale {} data in {}".format(args.scale, data_dir))
+        initech_data.generate(spark, data_dir, args.scale, seed=args.seed, zipf=args.zipf)
+
+    widgets = dict(w.split("=", 1) for w in args.widget)
+    runner = NotebookRunner(spark, Paths(data_dir, args.work_dir), stream_seconds=args.stream_seconds, widgets=widgets)
+    notebooks = args.notebooks or sorted(glob.glob(os.path.join(NOTEBOOK_DIR, "[0-9]*")))
+    results = []
+    for path in notebooks:
+        results.extend(runner.run(path))
+    write_report(results, args.out)
+    print("wrote {}.json and {}.csv".format(args.out, args.out))
+
+
+if __name__ == "__main__":
+    main()
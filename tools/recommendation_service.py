@@ -0,0 +1,265 @@
+"""
+In-process recommendation serving from a saved ALS model, without Spark.
+
+    python tools/recommendation_service.py /dbfs/tmp/training-msft/als/current \
+        --products /dbfs/mnt/training-sources/initech/productsShort \
+        --ratings /dbfs/mnt/training-sources/initech/productRatings --user 0 --k 10
+
+Loads the model's userFactors and itemFactors (the Parquet tables written by
+`ALSModel.write().save(..)`) and the product metadata into NumPy arrays once.
+It then answers:
+
+  * recommend(user_id, k, exclude_rated=True): the k products with the highest
+    predicted rating, skipping what the user has already rated,
+  * similar_items(product_id, k): the k products whose factors are closest by
+    cosine similarity. The lookup is an exact scan, or with `index_lists` set
+    it uses an approximate IVF index (tools/item_index.py) built at load.
+
+Answers are kept in an LRU cache of `cache_size` requests. A background thread
+watches the model directory and, once a newly written model has stopped
+changing, loads it next to the old one and swaps it in with a single
+assignment. Requests in flight finish on the model they started with, and the
+cache is dropped together with the old model. Needs numpy and pyarrow.
+
+Run as a script, it loads a model, answers `--requests` random requests and
+prints latency percentiles.
+"""
+
+import argparse
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+import pyarrow.parquet as pq
+
+from item_index import ItemIndex
+
+
+def _factors(path):
+    table = pq.read_table(path, columns=["id", "features"])
+    ids = table.column("id").to_numpy().astype(np.int64)
+    flat = table.column("features").combine_chunks().flatten().to_numpy().astype(np.float32)
+    return ids, np.ascontiguousarray(flat.reshape(len(ids), -1))
+
+
+def _signature(path):
+    """(relative path, size, mtime) of every file under `path`, to tell when a model has been rewritten."""
+    files = []
+    for root, _, names in os.walk(path):
+        for name in names:
+            full = os.path.join(root, name)
+            stat = os.stat(full)
+            files.append((os.path.relpath(full, path), stat.st_size, stat.st_mtime))
+    return tuple(sorted(files))
+
+
+def _top_k(scores, k):
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    idx = np.argpartition(-scores, k - 1)[:k]
+    return idx[np.argsort(-scores[idx])]
+
+
+class Snapshot(object):
+    """One loaded model: factor matrices, id lookups and the rated-items index. Never modified once built."""
+
+    def __init__(self, model_path, products=None, ratings=None, index_lists=None):
+        self.user_ids, self.users = _factors(os.path.join(model_path, "userFactors"))
+        self.item_ids, self.items = _factors(os.path.join(model_path, "itemFactors"))
+        self.user_row = {int(u): i for i, u in enumerate(self.user_ids)}
+        self.item_row = {int(p): i for i, p in enumerate(self.item_ids)}
+        norms = np.linalg.norm(self.items, axis=1, keepdims=True)
+        self.unit_items = self.items / np.maximum(norms, 1e-12)
+        self.index = ItemIndex.build(self.item_ids, self.items, n_lists=index_lists) if index_lists else None
+        self.products = products or {}
+        self.rated = ratings or {}
+        self.loaded_at = time.time()
+
+    def rated_rows(self, user_id):
+        return [self.item_row[p] for p in self.rated.get(user_id, ()) if p in self.item_row]
+
+
+class LRUCache(object):
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+def load_products(path):
+    """product_id -> metadata dict from the productsShort Parquet table."""
+    rows = pq.read_table(path).to_pylist()
+    return {row["product_id"]: row for row in rows}
+
+
+def load_rated(path, user_col="user_id", item_col="product_id"):
+    """user_id -> array of rated product ids, from a ratings Parquet table."""
+    table = pq.read_table(path, columns=[user_col, item_col])
+    users = table.column(user_col).to_numpy()
+    items = table.column(item_col).to_numpy()
+    order = np.argsort(users, kind="stable")
+    users, items = users[order], items[order]
+    starts = np.flatnonzero(np.r_[True, users[1:] != users[:-1]])
+    ends = np.r_[starts[1:], len(users)]
+    return {int(users[s]): items[s:e] for s, e in zip(starts, ends)}
+
+
+class RecommendationService(object):
+
+    def __init__(self, model_path, products_path=None, ratings_path=None, cache_size=100000, reload_seconds=30,
+                 index_lists=None):
+        self.model_path = model_path
+        self.index_lists = index_lists
+        self.cache_size = cache_size
+        self.reload_seconds = reload_seconds
+        self.products = load_products(products_path) if products_path else {}
+        self.rated = load_rated(ratings_path) if ratings_path else {}
+        self._signature = _signature(model_path)
+        self._state = (Snapshot(model_path, self.products, self.rated, index_lists), LRUCache(cache_size))
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @property
+    def snapshot(self):
+        return self._state[0]
+
+    def _describe(self, snapshot, rows, scores):
+        return [dict(snapshot.products.get(int(snapshot.item_ids[r]), {}), product_id=int(snapshot.item_ids[r]),
+                     score=float(s)) for r, s in zip(rows, scores)]
+
+    def recommend(self, user_id, k=10, exclude_rated=True):
+        """The `k` products with the highest predicted rating for `user_id`, best first. [] for unknown users."""
+        snapshot, cache = self._state
+        key = ("user", user_id, k, exclude_rated)
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+        row = snapshot.user_row.get(user_id)
+        if row is None:
+            return []
+        scores = snapshot.items.dot(snapshot.users[row])
+        if exclude_rated:
+            scores[snapshot.rated_rows(user_id)] = -np.inf
+        top = [r for r in _top_k(scores, k) if np.isfinite(scores[r])]
+        result = self._describe(snapshot, top, scores[top])
+        cache.put(key, result)
+        return result
+
+    def similar_items(self, product_id, k=10):
+        """The `k` products closest to `product_id` by cosine similarity of their factors, itself excluded."""
+        snapshot, cache = self._state
+        key = ("item", product_id, k)
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+        row = snapshot.item_row.get(product_id)
+        if row is None:
+            return []
+        if snapshot.index is not None:
+            ids, scores = snapshot.index.search(snapshot.items[row], k, exclude=product_id)
+            top = [snapshot.item_row[int(i)] for i in ids]
+        else:
+            scores = snapshot.unit_items.dot(snapshot.unit_items[row])
+            scores[row] = -np.inf
+            top = _top_k(scores, k)
+            scores = scores[top]
+        result = self._describe(snapshot, top, scores)
+        cache.put(key, result)
+        return result
+
+    def reload(self):
+        """Load the model at `model_path` if it changed and has stopped changing. Returns True if swapped."""
+        first = _signature(self.model_path)
+        if first == self._signature or not first:
+            return False
+        time.sleep(1)
+        if _signature(self.model_path) != first:
+            return False  # still being written, try again next time
+        snapshot = Snapshot(self.model_path, self.products, self.rated, self.index_lists)
+        self._state = (snapshot, LRUCache(self.cache_size))
+        self._signature = first
+        return True
+
+    def _watch(self):
+        while not self._stopped.wait(self.reload_seconds):
+            try:
+                if self.reload():
+                    print("reloaded model from {}".format(self.model_path))
+            except Exception as e:
+                print("model reload failed, keeping the current one: {}".format(e))
+
+    def start(self):
+        self._thread = threading.Thread(target=self._watch, name="model-watcher")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100.0 * len(values)))]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve recommendations from a saved ALS model.")
+    parser.add_argument("model", help="directory written by ALSModel.write().save(..)")
+    parser.add_argument("--products", help="productsShort Parquet directory")
+    parser.add_argument("--ratings", help="ratings Parquet directory, to exclude already rated products")
+    parser.add_argument("--user", type=int, help="print this user's recommendations")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--requests", type=int, default=10000, help="random requests to time")
+    parser.add_argument("--index-lists", type=int, help="serve similar_items from an IVF index with this many lists")
+    args = parser.parse_args(argv)
+
+    started = time.time()
+    service = RecommendationService(args.model, args.products, args.ratings, index_lists=args.index_lists)
+    snapshot = service.snapshot
+    print("loaded {} users x {} items in {:.2f}s".format(len(snapshot.user_ids), len(snapshot.item_ids),
+                                                         time.time() - started))
+    if args.user is not None:
+        for rec in service.recommend(args.user, args.k):
+            print(rec)
+
+    # Zipf-ish request mix, so the cache sees the repeat visitors a storefront would
+    users = snapshot.user_ids
+    latencies = []
+    for _ in range(args.requests):
+        user = int(users[min(len(users) - 1, int(random.paretovariate(1.2)) - 1)]) if random.random() < 0.5 \
+            else int(random.choice(users))
+        t = time.perf_counter()
+        service.recommend(user, args.k)
+        latencies.append((time.perf_counter() - t) * 1000)
+    cache = service._state[1]
+    print("recommend: p50 {:.3f} ms, p99 {:.3f} ms, max {:.3f} ms, cache hit rate {:.0%}".format(
+        _percentile(latencies, 50), _percentile(latencies, 99), max(latencies),
+        cache.hits / float(max(1, cache.hits + cache.misses))))
+
+
+if __name__ == "__main__":
+    main()
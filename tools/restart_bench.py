@@ -0,0 +1,319 @@
+"""
+Kill-and-restart benchmark for the order pipeline's checkpoint recovery.
+
+    python tools/restart_bench.py --source files --kill-after-batches 3,10,25 --out bench/restart-files
+    python tools/restart_bench.py --source eventhubs --kill-after-seconds 20,60 --out bench/restart-eh
+
+Runs the order pipeline in a separate driver process and SIGKILLs it at each
+kill point, which is either a number of committed batches or seconds of
+runtime. After each kill it starts the driver again on the same checkpoint.
+For each kill it measures:
+
+  * the batches that were planned (offsets/) but not committed (commits/) when
+    the driver died, and how many rows were read again replaying them,
+  * seconds from the relaunch that followed to its first batch committed in
+    the checkpoint.
+
+The first launch starts on an empty checkpoint and pays for JVM start-up and
+query planning without any recovery, so its time to first commit is reported
+on its own, as coldStartToFirstCommitSeconds.
+
+After the last restart the pipeline runs until the source is drained. The
+output is then checked for duplicate orderUUIDs: once as readers see it
+(through the file sink's _spark_metadata log, or CompactingSink.read()), and
+once over every Parquet file on disk, which also counts files left by killed
+batches. The
+checkpoint's size and file count are sampled every second for the growth
+curve.
+
+`--source files` streams the synthetic orders CSV through a product join into
+a Parquet file sink. `--source eventhubs` runs the writer 04b ships: the same
+orders replayed through the local Event Hubs stand-in (Includes/Local-Event-Hub,
+file-backed so replays are deterministic), read and routed once by
+OrderDecoder.start (Includes/Order-Decoding), joined to the products and
+written by CompactingSink.append (Includes/Compacting-Sink). Without Delta on
+the classpath that sink writes its Parquet fallback.
+
+Results go to <out>.json and the growth curve to <out>-checkpoint.csv.
+"""
+
+import argparse
+import csv
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+ORDER_SCHEMA = ("orderUUID string, productId int, userId int, quantity int, discount double, "
+                "orderTimestamp timestamp")
+
+
+# ---------------------------------------------------------------------------
+# Worker: one driver process running the pipeline
+# ---------------------------------------------------------------------------
+
+def _eventhub_namespace(spark, data_dir, work_dir):
+    """Load the Includes of 04b's order writer the way the notebook's %run would."""
+    import notebook_bench
+    runner = notebook_bench.NotebookRunner(spark, notebook_bench.Paths(data_dir, work_dir))
+    ns = runner.namespace()
+    includes = os.path.join(notebook_bench.NOTEBOOK_DIR, "Includes")
+    for name in ("Local-Event-Hub", "Order-Decoding", "Compacting-Sink"):
+        for cell in notebook_bench.parse_notebook(os.path.join(includes, name + ".py")):
+            runner.run_cell(cell, ns, includes)
+    return ns
+
+
+def start_pipeline(spark, args):
+    from pyspark.sql.functions import broadcast
+    initech = os.path.join(args.data_dir, "initech")
+    products = broadcast(spark.read.parquet(os.path.join(initech, "productsFull"))
+                         .select("ProductID", "Name", "StandardCost"))
+    trigger = "{} seconds".format(args.trigger_seconds)
+    if args.source == "files":
+        orders = (spark.readStream
+                  .schema(ORDER_SCHEMA)
+                  .option("maxFilesPerTrigger", args.files_per_trigger)
+                  .csv(os.path.join(initech, "streaming", "orders", "data", "part-*")))
+        return (orders.join(products, "ProductID")
+                .writeStream
+                .format("parquet")
+                .option("path", args.sink)
+                .option("checkpointLocation", args.checkpoint)
+                .trigger(processingTime=trigger)
+                .start())
+
+    ns = _eventhub_namespace(spark, args.data_dir, args.work_dir)
+    events = ns["read_local_event_hub"](path=args.events_dir, maxFilesPerTrigger=args.files_per_trigger)
+    decoder = ns["OrderDecoder"](spark.createDataFrame([], ORDER_SCHEMA).schema, args.quarantine)
+    sink = ns["CompactingSink"](args.sink)
+    return decoder.start(events, args.checkpoint,
+                         writeOrders=lambda orders, batchId: sink.append(orders.join(products, "ProductID"), batchId),
+                         processingTime=trigger)
+
+
+def worker(args):
+    from pyspark.sql import SparkSession
+    spark = SparkSession.builder.master("local[{}]".format(args.cores)).appName("restart-bench").getOrCreate()
+    query = start_pipeline(spark, args)
+    seen = -1
+    with open(args.progress_log, "a") as log:
+        while query.isActive:
+            for p in query.recentProgress:
+                if p["batchId"] > seen:
+                    seen = p["batchId"]
+                    log.write(json.dumps({"pid": os.getpid(), "time": time.time(), "batchId": p["batchId"],
+                                          "numInputRows": p["numInputRows"]}) + "\n")
+                    log.flush()
+            status = query.status
+            if args.until_drained and query.lastProgress is not None \
+                    and not status["isDataAvailable"] and not status["isTriggerActive"]:
+                break
+            time.sleep(0.2)
+    query.stop()
+
+
+# ---------------------------------------------------------------------------
+# Controller
+# ---------------------------------------------------------------------------
+
+def _batch_ids(directory):
+    if not os.path.isdir(directory):
+        return set()
+    return {int(n) for n in os.listdir(directory) if n.isdigit()}
+
+
+def _dir_size(path):
+    files, size = 0, 0
+    for root, _, names in os.walk(path):
+        for name in names:
+            files += 1
+            size += os.path.getsize(os.path.join(root, name))
+    return files, size
+
+
+def _progress(log_path, pid=None):
+    if not os.path.exists(log_path):
+        return []
+    with open(log_path) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    return [r for r in records if pid is None or r["pid"] == pid]
+
+
+class Controller(object):
+
+    def __init__(self, args):
+        self.args = args
+        self.commits = os.path.join(args.checkpoint, "commits")
+        self.offsets = os.path.join(args.checkpoint, "offsets")
+        self.growth = []
+        self.started = time.time()
+
+    def _sample(self):
+        files, size = _dir_size(self.args.checkpoint)
+        self.growth.append({"seconds": round(time.time() - self.started, 1), "committedBatches": len(_batch_ids(self.commits)),
+                            "checkpointFiles": files, "checkpointBytes": size})
+
+    def launch(self, until_drained=False):
+        cmd = [sys.executable, os.path.abspath(__file__), "--worker"] + self.args.passthrough
+        if until_drained:
+            cmd.append("--until-drained")
+        return subprocess.Popen(cmd)
+
+    def wait(self, proc, condition, timeout):
+        deadline = time.time() + timeout
+        while proc.poll() is None and not condition() and time.time() < deadline:
+            self._sample()
+            time.sleep(1)
+
+    def _first_commit_seconds(self, committed_before, launched):
+        # The commit file's mtime is when the batch committed, independent of how often we poll
+        committed = sorted(_batch_ids(self.commits) - committed_before)
+        if not committed:
+            return None
+        return round(os.path.getmtime(os.path.join(self.commits, str(committed[0]))) - launched, 2)
+
+    def run_kill_point(self, kind, value):
+        committed_before = _batch_ids(self.commits)
+        launched = time.time()
+        proc = self.launch()
+
+        def reached():
+            new = _batch_ids(self.commits) - committed_before
+            return len(new) >= value if kind == "batches" else time.time() - launched >= value
+
+        self.wait(proc, reached, self.args.timeout)
+        os.kill(proc.pid, signal.SIGKILL)
+        proc.wait()
+
+        in_flight = sorted(_batch_ids(self.offsets) - _batch_ids(self.commits))
+        return {
+            "killAfter": "{} {}".format(value, kind),
+            "batchesCommitted": len(_batch_ids(self.commits) - committed_before),
+            "uncommittedAtKill": in_flight,
+            "pid": proc.pid,
+            "firstCommitSeconds": self._first_commit_seconds(committed_before, launched),
+        }
+
+    def run(self):
+        """Returns the cold start's time to first commit, one record per kill, and how long the final run took to drain."""
+        kind, points = ("batches", self.args.kill_after_batches) if self.args.kill_after_batches \
+            else ("seconds", self.args.kill_after_seconds)
+        runs = [self.run_kill_point(kind, v) for v in points]
+
+        committed_before = _batch_ids(self.commits)
+        launched = time.time()
+        proc = self.launch(until_drained=True)
+        self.wait(proc, lambda: False, self.args.timeout)
+        proc.wait()
+        runs.append({"pid": proc.pid, "firstCommitSeconds": self._first_commit_seconds(committed_before, launched)})
+
+        # Each kill is followed by a restart: the rows it read again are its first batches that
+        # re-execute batch ids left uncommitted, and its time to first commit is the recovery time
+        kills = runs[:-1]
+        for kill, restart in zip(kills, runs[1:]):
+            replayed = [p for p in _progress(self.args.progress_log, restart["pid"]) if p["batchId"] in kill["uncommittedAtKill"]]
+            kill["reprocessedRows"] = sum(p["numInputRows"] for p in replayed)
+            kill["restartToFirstCommitSeconds"] = restart["firstCommitSeconds"]
+        cold_start = runs[0]["firstCommitSeconds"]
+        for kill in kills:
+            del kill["firstCommitSeconds"]
+        return cold_start, kills, round(time.time() - launched, 2)
+
+
+def check_output(args):
+    from pyspark.sql import SparkSession, functions as F
+    spark = SparkSession.builder.master("local[{}]".format(args.cores)).appName("restart-bench-check").getOrCreate()
+    if args.source == "files":
+        visible = spark.read.parquet(args.sink)  # resolved through _spark_metadata
+    else:
+        visible = _eventhub_namespace(spark, args.data_dir, args.work_dir)["CompactingSink"](args.sink).read()
+    # Every file, committed or not, including what a killed batch left in a staging directory
+    on_disk = (spark.read.option("recursiveFileLookup", "true").option("pathGlobFilter", "*.parquet")
+               .parquet(args.sink).select("orderUUID"))
+
+    def duplicates(df):
+        return df.groupBy("orderUUID").count().where("count > 1").agg(F.sum(F.col("count") - 1)).first()[0] or 0
+
+    source = spark.read.schema(ORDER_SCHEMA).csv(os.path.join(args.data_dir, "initech", "streaming", "orders", "data"))
+    return {
+        "sourceRows": source.count(),
+        "outputRows": visible.count(),
+        "duplicateRows": duplicates(visible),
+        "rowsOnDisk": on_disk.count(),
+        "duplicateRowsOnDisk": duplicates(on_disk),
+    }
+
+
+def prepare(args):
+    from pyspark.sql import SparkSession
+    import initech_data
+    spark = SparkSession.builder.master("local[{}]".format(args.cores)).appName("restart-bench-setup").getOrCreate()
+    if not os.path.isdir(os.path.join(args.data_dir, "initech")):
+        initech_data.generate(spark, args.data_dir, args.scale, seed=args.seed)
+    if args.source == "eventhubs" and not os.path.isdir(args.events_dir):
+        ns = _eventhub_namespace(spark, args.data_dir, args.work_dir)
+        orders = spark.read.schema(ORDER_SCHEMA).csv(os.path.join(args.data_dir, "initech", "streaming", "orders", "data"))
+        ns["write_event_files"](orders, args.events_dir, partitions=2, eventsPerFile=1000)
+    spark.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--source", choices=["files", "eventhubs"], default="files")
+    parser.add_argument("--kill-after-batches", type=lambda s: [int(v) for v in s.split(",")], default=None)
+    parser.add_argument("--kill-after-seconds", type=lambda s: [float(v) for v in s.split(",")], default=None)
+    parser.add_argument("--scale", default="0.1")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--files-per-trigger", type=int, default=1)
+    parser.add_argument("--trigger-seconds", type=int, default=1)
+    parser.add_argument("--cores", default="*")
+    parser.add_argument("--timeout", type=float, default=600, help="max seconds to wait at each kill point")
+    parser.add_argument("--work-dir", default="bench-work/restart")
+    parser.add_argument("--out", default="bench/restart")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--until-drained", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    args.work_dir = os.path.abspath(args.work_dir)
+    args.data_dir = os.path.join(os.path.dirname(args.work_dir), "data-{}-{}".format(args.scale, args.seed))
+    args.events_dir = os.path.join(args.data_dir, "eventhub-orders")
+    run_dir = os.path.join(args.work_dir, args.source)
+    args.sink = os.path.join(run_dir, "data")
+    args.checkpoint = os.path.join(run_dir, "checkpoint")
+    args.quarantine = os.path.join(run_dir, "quarantine")
+    args.progress_log = os.path.join(run_dir, "progress.jsonl")
+
+    if args.worker:
+        worker(args)
+        return
+
+    if not args.kill_after_batches and not args.kill_after_seconds:
+        parser.error("one of --kill-after-batches or --kill-after-seconds is required")
+    shutil.rmtree(run_dir, ignore_errors=True)
+    os.makedirs(run_dir)
+    prepare(args)
+
+    args.passthrough = list(argv if argv is not None else sys.argv[1:])
+    controller = Controller(args)
+    cold_start, restarts, drain_seconds = controller.run()
+    report = {"source": args.source, "coldStartToFirstCommitSeconds": cold_start, "restarts": restarts,
+              "drainSeconds": drain_seconds, "output": check_output(args)}
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+    with open(args.out + ".json", "w") as f:
+        json.dump(report, f, indent=2)
+    with open(args.out + "-checkpoint.csv", "w") as f:
+        writer = csv.DictWriter(f, fieldnames=["seconds", "committedBatches", "checkpointFiles", "checkpointBytes"])
+        writer.writeheader()
+        writer.writerows(controller.growth)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+Summarize the streaming progress records written by Includes/Streaming-Metrics.
+
+    databricks fs cp -r dbfs:/tmp/streaming/training-msft/initech/metrics/ metrics/
+    python tools/stream_metrics.py metrics/
+    python tools/stream_metrics.py metrics/ --since 2018-03-01T10:00:00 --json
+
+Prints, per query, the number of batches, p50/p95/p99 batch latency
+(triggerExecution), p95 of every phase, the mean processing rate and the
+peak state size and watermark lag, and the duplicates dropped by deduplication. Only the standard library is needed.
+"""
+
+import argparse
+import glob
+import json
+import math
+import os
+from collections import OrderedDict, defaultdict
+
+PHASES = ["latestOffset", "getBatch", "queryPlanning", "addBatch", "walCommit", "commitOffsets", "triggerExecution"]
+
+
+def load_records(path, since=None):
+    files = [path] if os.path.isfile(path) else sorted(glob.glob(os.path.join(path, "**", "*.jsonl"), recursive=True))
+    records = []
+    for name in files:
+        with open(name) as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                record = json.loads(line)
+                if since and (record.get("timestamp") or "") < since:
+                    continue
+                records.append(record)
+    return records
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of `values`, None if there are none."""
+    values = sorted(v for v in values if v is not None)
+    if not values:
+        return None
+    rank = max(1, int(math.ceil(p / 100.0 * len(values))))
+    return values[rank - 1]
+
+
+def summarize(records):
+    by_query = defaultdict(list)
+    for record in records:
+        by_query[record.get("name") or record.get("queryId")].append(record)
+
+    summary = OrderedDict()
+    for query, batches in sorted(by_query.items(), key=lambda kv: str(kv[0])):
+        # The listener reports idle triggers too - only batches that read something count towards latency
+        active = [b for b in batches if b.get("numInputRows")] or batches
+        latency = [b.get("triggerExecutionMs") for b in active]
+        rates = [b.get("processedRowsPerSecond") for b in active if b.get("processedRowsPerSecond") is not None]
+        summary[str(query)] = OrderedDict([
+            ("batches", len(active)),
+            ("p50Ms", percentile(latency, 50)),
+            ("p95Ms", percentile(latency, 95)),
+            ("p99Ms", percentile(latency, 99)),
+            ("phaseP95Ms", OrderedDict((p, percentile([b.get(p + "Ms") for b in active], 95)) for p in PHASES)),
+            ("meanProcessedRowsPerSecond", sum(rates) / len(rates) if rates else None),
+            ("maxStateRows", max([b.get("stateRowsTotal") or 0 for b in active] or [0])),
+            ("maxStateMemoryBytes", max([b.get("stateMemoryBytes") or 0 for b in active] or [0])),
+            ("maxWatermarkLagSeconds", max([b.get("watermarkLagSeconds") or 0 for b in active] or [0])),
+            ("duplicatesDropped", sum(b.get("duplicatesDropped") or 0 for b in batches)),
+        ])
+    return summary
+
+
+def _fmt(value):
+    return "-" if value is None else "{:,.0f}".format(value)
+
+
+def print_summary(summary):
+    header = "{:<40} {:>8} {:>10} {:>10} {:>10} {:>12} {:>14}".format(
+        "query", "batches", "p50 ms", "p95 ms", "p99 ms", "rows/s", "state rows")
+    print(header)
+    print("-" * len(header))
+    for query, s in summary.items():
+        print("{:<40} {:>8} {:>10} {:>10} {:>10} {:>12} {:>14}".format(
+            query[:40], s["batches"], _fmt(s["p50Ms"]), _fmt(s["p95Ms"]), _fmt(s["p99Ms"]),
+            _fmt(s["meanProcessedRowsPerSecond"]), _fmt(s["maxStateRows"])))
+        print("    p95 by phase: " + ", ".join("{} {}".format(p, _fmt(v)) for p, v in s["phaseP95Ms"].items()))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Summarize streaming progress records.")
+    parser.add_argument("path", help="directory (searched recursively for *.jsonl) or a single file")
+    parser.add_argument("--since", help="only records at or after this ISO timestamp")
+    parser.add_argument("--json", action="store_true", help="print the summary as JSON")
+    args = parser.parse_args(argv)
+
+    summary = summarize(load_records(args.path, args.since))
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        print_summary(summary)
+
+
+if __name__ == "__main__":
+    main()